@@ -0,0 +1,439 @@
+#! /usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import Queue
+import errno
+import string
+import hashlib
+import logging
+import argparse
+import threading
+import seekable
+
+MANIFEST = 'manifest.jsonl'
+# longest sanitized URL kept in a file name; with the hash, the trial and a
+# suffix, names stay well below the usual 255 byte limit
+MAX_PREFIX = 100
+HASH_CHARS = 10
+
+# output layouts: everything in the output directory, or one directory per
+# run, URL (hash) and trial
+LAYOUTS = ('flat', 'sharded')
+
+# deduplicated artifacts and bodies, in the manifest's directory
+BLOBS = 'blobs'
+# smallest response body moved to a blob
+MIN_DEDUP_BODY = 1024
+
+# the characters file names never get (shell and URL syntax)
+UNSAFE_CHARACTERS = '/\\;,><&*:%=+@!#^()|?'
+_UNSAFE = re.compile('[%s]' % re.escape(UNSAFE_CHARACTERS))
+_UNSAFE_TABLE = string.maketrans(UNSAFE_CHARACTERS, '-' * len(UNSAFE_CHARACTERS))
+
+
+################################################################################
+#                                                                              #
+#   ARTIFACT NAMES                                                             #
+#                                                                              #
+################################################################################
+
+def sanitize_url(url):
+    '''Returns a version of the URL suitable for use in a file name (may be
+    the same for different URLs, see :func:`artifact_name`).'''
+    if isinstance(url, str):
+        return url.translate(_UNSAFE_TABLE)
+    return _UNSAFE.sub('-', url)
+
+def url_hash(url):
+    '''A short, stable hash of `url`.'''
+    if not isinstance(url, str):
+        url = url.encode('utf-8')
+    return hashlib.sha1(url).hexdigest()[:HASH_CHARS]
+
+def artifact_name(name, max_prefix=MAX_PREFIX):
+    '''A file name (without trial or suffix) for `name`, a URL or a name
+    chosen in a test (e.g., `har_file_name`). Names that are safe and short
+    are used as they are; others are sanitized, cut to `max_prefix`
+    characters and get a hash of the whole name, so different URLs never
+    share a file (`a?b` and `a/b` both sanitize to `a-b`).'''
+    sanitized = sanitize_url(name)
+    if sanitized == name and len(name) <= max_prefix:
+        return name
+    return '%s.%s' % (sanitized[:max_prefix], url_hash(name))
+
+def shard_dir(root, name, trial=None):
+    '''The directory of the artifacts of `name` (and `trial`) in the sharded
+    layout: <root>/<2 hash chars>/<hash>/<trial>, so no directory holds more
+    than a few hundred entries however many URLs a run loads.'''
+    digest = url_hash(name)
+    path = os.path.join(root, digest[:2], digest)
+    if trial is not None:
+        path = os.path.join(path, str(trial))
+    return path
+
+def makedirs(path):
+    '''Like os.makedirs, but fine if `path` exists (e.g., made by another
+    worker at the same time).'''
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+################################################################################
+#                                                                              #
+#   COMPRESSED ARTIFACTS                                                       #
+#                                                                              #
+################################################################################
+
+def find_artifact(path):
+    '''`path`, or its compressed version if only that exists (e.g., it was
+    compressed after its path was recorded).'''
+    if not os.path.exists(path):
+        for suffix in seekable.SUFFIXES.values():
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+def is_compressed(path):
+    return seekable.codec_of(find_artifact(path)) is not None
+
+def has_suffix(name, suffix):
+    '''Whether file `name` is a `suffix` file (e.g., '.har'), compressed or
+    not.'''
+    return name.endswith(suffix) or\
+        any(name.endswith(suffix + s) for s in seekable.SUFFIXES.values())
+
+def open_artifact(path):
+    '''Open an artifact for reading (binary), compressed or not; compressed
+    ones can seek (see :mod:`seekable`).'''
+    path = find_artifact(path)
+    if seekable.codec_of(path):
+        return seekable.SeekableReader(path)
+    return open(path, 'rb')
+
+def load_har(path):
+    '''Read a HAR (as parsed JSON), compressed or not, with the response
+    bodies that were moved out by :class:`Compressor` put back.'''
+    with open_artifact(path) as f:
+        har = json.load(f)
+    directory = os.path.dirname(path)
+    for entry in har.get('log', {}).get('entries', []):
+        content = entry.get('response', {}).get('content', {})
+        if '_blob' in content:
+            with open_artifact(os.path.join(directory, content.pop('_blob'))) as f:
+                content['text'] = f.read().decode('utf-8')
+    return har
+
+def _write_compressed(chunks, path, codec, level):
+    # to a temporary file, so readers never see half a file; returns the
+    # SHA-1 of the data
+    digest = hashlib.sha1()
+    tmp = '%s.%d-%s.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'wb') as f:
+        with seekable.SeekableWriter(f, codec, level) as writer:
+            for chunk in chunks:
+                digest.update(chunk)
+                writer.write(chunk)
+    return tmp, digest.hexdigest()
+
+def _file_chunks(path, size=seekable.FRAME_SIZE):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+def _link(source, destination):
+    # the other name of a deduplicated file; another worker may be first
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+class Compressor(object):
+    '''Compresses finished artifacts with a pool of background threads, off
+    the load path, and records the compressed files in `manifest`.
+    :meth:`close` waits for the backlog. zlib and zstd release the GIL while
+    they compress, so the threads use as many cores.
+
+    Files are compressed in seekable frames (see :mod:`seekable`). With
+    `dedup`, artifacts are also stored by content hash in `blobs/` of the
+    manifest's directory: an artifact with the same content as an earlier
+    one becomes a hard link to it, and response bodies in HARs of at least
+    `min_body` bytes are moved to a blob of their own, referenced by
+    `_blob` in their `content` (:func:`load_har` puts them back).
+
+    :param manifest: the :class:`Manifest` of the artifacts
+    :param codec: 'gzip' or 'zstd' (default: zstd if installed)
+    :param level: compression level (default: the codec's)
+    :param workers: number of threads
+    :param dedup: deduplicate by content hash
+    '''
+
+    def __init__(self, manifest, codec=None, level=None, workers=2, dedup=False,\
+        min_body=MIN_DEDUP_BODY):
+        self._manifest = manifest
+        self._codec = codec or seekable.default_codec()
+        if self._codec not in seekable.CODECS:
+            raise ValueError('Unknown codec %s' % self._codec)
+        self._suffix = seekable.SUFFIXES[self._codec]
+        self._level = level
+        self._dedup = dedup
+        self._min_body = min_body
+        self._blobs = os.path.join(manifest.outdir, BLOBS)
+        self._stats = dict.fromkeys(('files', 'bytes_in', 'bytes_out', 'duplicates', 'bodies'), 0)
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(max(1, workers)):
+            thread = threading.Thread(name='compressor%d' % i, target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def stats(self):
+        '''Files compressed, bytes in and out, and duplicates and bodies
+        deduplicated so far.'''
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+    def submit(self, url, trial, kind, path):
+        '''Compress artifact `path` (already in the manifest) soon.'''
+        self._queue.put((url, trial, kind, path))
+
+    def _blob_path(self, digest, suffix):
+        directory = os.path.join(self._blobs, digest[:2])
+        makedirs(directory)
+        return os.path.join(directory, digest + suffix + self._suffix)
+
+    def _strip_bodies(self, path):
+        # move large bodies to blobs; returns the HAR without them
+        with open(path, 'rb') as f:
+            har = json.load(f)
+        directory = os.path.dirname(path)
+        bodies = 0
+        for entry in har.get('log', {}).get('entries', []):
+            content = entry.get('response', {}).get('content', {})
+            text = content.get('text')
+            if not text or len(text) < self._min_body:
+                continue
+            data = text.encode('utf-8')
+            blob = self._blob_path(hashlib.sha1(data).hexdigest(), '.body')
+            if not os.path.exists(blob):
+                tmp, _ = _write_compressed([data], blob, self._codec, self._level)
+                os.rename(tmp, blob)
+            content['_blob'] = os.path.relpath(blob, directory)
+            del content['text']
+            bodies += 1
+        self._count(bodies=bodies)
+        return json.dumps(har)
+
+    def compress(self, path, kind=None):
+        '''Replace file `path` by its compressed version (deduplicated, if
+        enabled); returns the new path and the SHA-1 of the content.'''
+        compressed = path + self._suffix
+        if self._dedup and kind == 'har':
+            chunks = [self._strip_bodies(path)]
+        else:
+            chunks = _file_chunks(path)
+        tmp, digest = _write_compressed(chunks, compressed, self._codec, self._level)
+        size = os.path.getsize(path)
+        self._count(files=1, bytes_in=size)
+        if self._dedup:
+            blob = self._blob_path(digest, os.path.splitext(path)[1])
+            if os.path.exists(blob):
+                os.remove(tmp)
+                _link(blob, compressed)
+                self._count(duplicates=1)
+            else:
+                os.rename(tmp, compressed)
+                _link(compressed, blob)
+                self._count(bytes_out=os.path.getsize(compressed))
+        else:
+            os.rename(tmp, compressed)
+            self._count(bytes_out=os.path.getsize(compressed))
+        os.remove(path)
+        return compressed, digest
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            url, trial, kind, path = job
+            try:
+                compressed, digest = self.compress(path, kind)
+                self._manifest.add(url, trial, kind, compressed, compressed=self._codec,\
+                    sha1=digest)
+            except (IOError, OSError, ValueError) as e:
+                logging.warning('Error compressing %s: %s', path, e)
+
+    def close(self):
+        '''Compress what was submitted, then stop.'''
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        logging.debug('Compressed artifacts: %s', self.stats)
+
+
+################################################################################
+#                                                                              #
+#   MANIFEST                                                                   #
+#                                                                              #
+################################################################################
+
+def has_manifest(outdir):
+    return os.path.exists(os.path.join(outdir, MANIFEST))
+
+class Manifest(object):
+    '''The artifacts of an output directory: one JSON line per file in
+    `manifest.jsonl` with the URL, trial, artifact type ('har', 'pcap',
+    'png', ...) and path relative to the directory.
+
+    Workers sharing a directory append to the same manifest; each line is a
+    single O_APPEND write, so lines never interleave. Lookups read the
+    manifest once into a dict.
+
+    :param outdir: the output directory
+    '''
+
+    def __init__(self, outdir):
+        self._outdir = outdir
+        self._path = os.path.join(outdir, MANIFEST)
+        self._index = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def outdir(self):
+        return self._outdir
+
+    def __getstate__(self):
+        # the lock and index stay with the process
+        return {'outdir': self._outdir}
+
+    def __setstate__(self, state):
+        self.__init__(state['outdir'])
+
+    def add(self, url, trial, kind, path, **extra):
+        '''Record artifact `path` (absolute or relative to the working
+        directory) of one trial.'''
+        entry = dict(extra, url=url, trial=trial, type=kind,\
+            path=os.path.relpath(path, self._outdir))
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        return entry
+
+    def entries(self):
+        '''Yield the manifest's entries in the order they were added.'''
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, 'r') as f:
+            for line in f:
+                if line.endswith('\n'):
+                    yield json.loads(line)
+
+    def _refresh(self):
+        # read only what was appended since the last lookup
+        if self._index is None:
+            self._index = {}
+            self._size = 0
+        if not os.path.exists(self._path) or os.path.getsize(self._path) == self._size:
+            return
+        with open(self._path, 'r') as f:
+            f.seek(self._size)
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                self._size += len(line)
+                entry = json.loads(line)
+                self._index[(entry['url'], entry['trial'], entry['type'])] = entry
+
+    def lookup(self, url, trial, kind):
+        '''The path of an artifact (None if there is none); the latest wins
+        if a trial was recorded more than once.'''
+        with self._lock:
+            self._refresh()
+            entry = self._index.get((url, trial, kind))
+        return os.path.join(self._outdir, entry['path']) if entry else None
+
+    def artifacts(self, kind):
+        '''Yield (url, trial, path) of each artifact of type `kind`.'''
+        with self._lock:
+            self._refresh()
+            found = [(url, trial, os.path.join(self._outdir, entry['path']))\
+                for (url, trial, entry_kind), entry in self._index.items() if entry_kind == kind]
+        for artifact in sorted(found):
+            yield artifact
+
+    def trials(self, url):
+        '''A dict mapping each trial of `url` to a dict of its artifacts'
+        paths by type.'''
+        with self._lock:
+            self._refresh()
+            found = {}
+            for (entry_url, trial, kind), entry in self._index.items():
+                if entry_url == url:
+                    found.setdefault(trial, {})[kind] = os.path.join(self._outdir, entry['path'])
+        return found
+
+
+
+def main():
+    manifest = Manifest(args.outdir)
+    if args.url is None:
+        for entry in manifest.entries():
+            print json.dumps(entry, sort_keys=True)
+        return
+    if args.trial is not None and args.type:
+        path = manifest.lookup(args.url, args.trial, args.type)
+        if not path:
+            sys.exit(1)
+        print path
+        return
+    for trial, paths in sorted(manifest.trials(args.url).items()):
+        if args.trial is None or trial == args.trial:
+            for kind, path in sorted(paths.items()):
+                if not args.type or kind == args.type:
+                    print '%d\t%s\t%s' % (trial, kind, path)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Find the artifacts (HARs, pcaps, screenshots) of trials in an output directory.')
+    parser.add_argument('outdir', help='output directory (with a manifest.jsonl)')
+    parser.add_argument('-u', '--url', help='only this URL (default: print the whole manifest)')
+    parser.add_argument('-t', '--trial', type=int, help='only this trial')
+    parser.add_argument('-y', '--type', help='only this artifact type (har, pcap, png)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
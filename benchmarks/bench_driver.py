@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+from server import PageServer
+import spans
+
+TEST_DRIVER = os.path.join(BENCHMARKS, '..', 'test_driver.py')
+STUBS = os.path.join(BENCHMARKS, 'stubs')
+
+
+################################################################################
+#                                                                              #
+#   END-TO-END THROUGHPUT                                                      #
+#                                                                              #
+################################################################################
+
+# test_driver.py runs unchanged; only the browser side is replaced by the
+# stand-ins in stubs/ (google-chrome, chrome-har-capturer, Xvfb), which
+# fetch pages from a local PageServer. So the numbers are the harness's
+# own overhead plus the stubs' fixed render time, no internet involved.
+
+def make_tests(server, urls, trials, objects, size, parallel):
+    return {'default': {'browser': 'chrome', 'parallel': parallel, 'headless': True,
+                        'num_trials': trials, 'save_har': True, 'save_screenshot': False,
+                        'save_packet_capture': False, 'save_trace': True},
+            'tests': [{'url': server.url(objects, size, 'url%d' % i)} for i in range(urls)]}
+
+def run_driver(server, parallel, args):
+    '''Run test_driver.py once; returns the measurements.'''
+    workdir = tempfile.mkdtemp(prefix='webloader-bench-')
+    try:
+        tests_path = os.path.join(workdir, 'tests.json')
+        with open(tests_path, 'w') as f:
+            json.dump(make_tests(server, args.urls, args.trials, args.objects,\
+                args.size, parallel), f)
+        env = dict(os.environ, PATH=STUBS + os.pathsep + os.environ.get('PATH', ''),\
+            BENCH_RENDER_MS=str(args.render_ms))
+
+        start = time.time()
+        with open(os.path.join(workdir, 'driver.log'), 'w') as log:
+            returncode = subprocess.call([sys.executable, TEST_DRIVER, tests_path, '-q'],\
+                cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        wall_time = time.time() - start
+        if returncode:
+            logging.warning('test_driver.py exited with %d (see %s)', returncode,\
+                os.path.join(workdir, 'driver.log'))
+            args.keep = True
+
+        jobs = args.urls * args.trials
+        hars = len(glob.glob(os.path.join(workdir, '*.har')))
+        traces = sorted(glob.glob(os.path.join(workdir, 'loader_trace_*.json')))
+        trace = spans.merge_traces(traces)
+        phases = {}
+        for event in trace['traceEvents']:
+            if event.get('ph') == 'X':
+                phase = phases.setdefault(event['name'], {'count': 0, 'total': 0.0})
+                phase['count'] += 1
+                phase['total'] += event['dur'] / 1e6
+        worker_time = trace['otherData']['wall_time']
+        page_load = phases.get('page_load', {}).get('total', 0)
+        return {'parallel': parallel, 'jobs': jobs, 'loaded': hars,
+                'wall_time': wall_time, 'jobs_per_second': hars / wall_time,
+                'worker_time': worker_time, 'phases': phases,
+                # the part of the workers' time not spent loading pages
+                'overhead': 1 - page_load / worker_time if worker_time else None}
+    finally:
+        if args.keep:
+            logging.info('Kept %s', workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+
+def main():
+    server = PageServer(delay_ms=args.server_delay_ms)
+    server.start()
+    logging.info('Page server on port %d', server.port)
+
+    results = []
+    for parallel in [int(p) for p in args.parallel.split(',')]:
+        logging.info('parallel=%d: %d jobs', parallel, args.urls * args.trials)
+        result = run_driver(server, parallel, args)
+        result['speedup'] = result['jobs_per_second'] / results[0]['jobs_per_second']\
+            if results and results[0]['jobs_per_second'] else 1.0
+        results.append(result)
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+
+    if args.json:
+        return
+    names = sorted(set(name for r in results for name in r['phases']))
+    print '%8s %6s %8s %9s %8s %9s  %s' % ('parallel', 'loaded', 'wall s', 'jobs/s',\
+        'speedup', 'overhead', '  '.join('%14s' % ('ms/' + n) for n in names))
+    for r in results:
+        per_phase = ['%14.1f' % (r['phases'][n]['total'] / r['phases'][n]['count'] * 1000)\
+            if n in r['phases'] else '%14s' % '-' for n in names]
+        print '%8d %6d %8.1f %9.2f %8.2f %8.1f%%  %s' % (r['parallel'], r['loaded'],\
+            r['wall_time'], r['jobs_per_second'], r['speedup'],\
+            (r['overhead'] or 0) * 100, '  '.join(per_phase))
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Measure the throughput and overhead of test_driver.py without a browser or the internet.')
+    parser.add_argument('-p', '--parallel', default='1,2,4,8,16,32,64', help='comma separated numbers of workers to run with')
+    parser.add_argument('-u', '--urls', type=int, default=64, help='number of distinct URLs')
+    parser.add_argument('-t', '--trials', type=int, default=2, help='trials per URL')
+    parser.add_argument('-o', '--objects', type=int, default=10, help='objects per page')
+    parser.add_argument('-s', '--size', type=int, default=10000, help='bytes per object')
+    parser.add_argument('-r', '--render_ms', type=float, default=100, help='time the stub browser spends per page')
+    parser.add_argument('-d', '--server_delay_ms', type=float, default=0, help='server delay per request')
+    parser.add_argument('-k', '--keep', action='store_true', default=False, help='keep the output directories')
+    parser.add_argument('-j', '--json', action='store_true', default=False, help='print JSON lines')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
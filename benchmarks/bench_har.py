@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from har import Har
+import hargen
+
+
+################################################################################
+#                                                                              #
+#   HAR MICRO-BENCHMARKS                                                       #
+#                                                                              #
+################################################################################
+
+def timed(function, repeat):
+    '''Best and median of `repeat` runs of `function`, in seconds.'''
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+def run(sizes, repeat):
+    results = []
+    for entries in sizes:
+        data = hargen.generate(entries, seed=0)
+        text = json.dumps(data)
+        har = Har(data)
+        for name, function in (('json.loads', lambda: json.loads(text)),\
+                               ('Har.__init__', lambda: Har(data)),\
+                               ('Har.profile', lambda: har.profile)):
+            best, median = timed(function, repeat)
+            results.append({'benchmark': name, 'entries': entries, 'best': best,
+                            'median': median, 'entries_per_second': entries / best if best else None})
+    return results
+
+
+
+def main():
+    results = run([int(s) for s in args.sizes.split(',')], args.repeat)
+    if args.json:
+        for result in results:
+            print json.dumps(result, sort_keys=True)
+        return
+    print '%-14s %8s %12s %12s %14s' % ('benchmark', 'entries', 'best ms', 'median ms', 'entries/s')
+    for r in results:
+        print '%-14s %8d %12.3f %12.3f %14.0f' % (r['benchmark'], r['entries'],\
+            r['best'] * 1000, r['median'] * 1000, r['entries_per_second'] or 0)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Time HAR parsing and profiling on generated HARs.')
+    parser.add_argument('-s', '--sizes', default='10,100,1000,10000', help='comma separated numbers of entries')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='runs per benchmark')
+    parser.add_argument('-j', '--json', action='store_true', default=False, help='print JSON lines')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    # Har logs a warning per odd object, which would be timed too
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.ERROR
+    )
+
+    main()
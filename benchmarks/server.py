@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+
+import sys
+import time
+import logging
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+# MIME types the objects of a page cycle through
+OBJECT_TYPES = (('img', 'image/png', 'png'), ('script', 'application/javascript', 'js'),\
+    ('link', 'text/css', 'css'), ('img', 'image/jpeg', 'jpg'))
+
+
+################################################################################
+#                                                                              #
+#   SYNTHETIC PAGES                                                            #
+#                                                                              #
+################################################################################
+
+# /page/<objects>/<size>/<anything>: an HTML page referencing <objects>
+#   objects of <size> bytes each (<anything> makes distinct URLs)
+# /object/<size>/<i>.<ext>: <size> bytes of the type of object i
+
+def page_html(objects, size, name=''):
+    tags = []
+    for i in range(objects):
+        tag, _, ext = OBJECT_TYPES[i % len(OBJECT_TYPES)]
+        src = '/object/%d/%d.%s' % (size, i, ext)
+        if tag == 'link':
+            tags.append('<link rel="stylesheet" href="%s">' % src)
+        elif tag == 'script':
+            tags.append('<script src="%s"></script>' % src)
+        else:
+            tags.append('<img src="%s">' % src)
+    return '<!DOCTYPE html>\n<html><head><title>%s</title></head><body>\n%s\n</body></html>\n'\
+        % (name, '\n'.join(tags))
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        try:
+            if parts[0] == 'page' and len(parts) >= 3:
+                body = page_html(int(parts[1]), int(parts[2]), '/'.join(parts[3:]))
+                mime_type = 'text/html'
+                cache_control = 'no-cache'
+            elif parts[0] == 'object' and len(parts) == 3:
+                i, ext = parts[2].split('.')
+                mime_type = [t for _, t, e in OBJECT_TYPES if e == ext][0]
+                body = 'x' * int(parts[1])
+                # half the objects are cacheable
+                cache_control = 'max-age=3600' if int(i) % 2 else 'no-store'
+            else:
+                raise ValueError(self.path)
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', mime_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logging.debug('%s %s', self.client_address[0], fmt % args)
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Serves synthetic pages (see :func:`page_html`) on `address`, after
+    waiting `delay_ms` per request.'''
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 256
+
+    def __init__(self, address=('127.0.0.1', 0), delay_ms=0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PageHandler)
+        self.delay = delay_ms / 1000.0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        '''Serve in a background thread.'''
+        thread = threading.Thread(name='page-server', target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def url(self, objects, size, name):
+        return 'http://%s:%d/page/%d/%d/%s' % (self.server_address[0], self.port,\
+            objects, size, name)
+
+
+
+def main():
+    server = PageServer((args.address, args.port), args.delay_ms)
+    logging.info('Serving synthetic pages on %s:%d, e.g. %s', args.address,\
+        server.port, server.url(10, 1000, 'example'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Serve synthetic pages: /page/<objects>/<size>/<name>.')
+    parser.add_argument('-a', '--address', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('-d', '--delay_ms', type=float, default=0, help='server delay per request')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
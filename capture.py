@@ -0,0 +1,254 @@
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+from time import time
+
+
+################################################################################
+#                                                                              #
+#   IN-PROCESS PACKET CAPTURE                                                  #
+#                                                                              #
+################################################################################
+
+ETH_P_ALL = 0x0003
+PACKET_OUTGOING = 4
+ARPHRD_ETHER = 1
+ARPHRD_LOOPBACK = 772
+LINKTYPE_ETHERNET = 1
+SNAPLEN = 65535
+
+# the per-trial tcpdump used to capture 'port not 22'
+EXCLUDED_PORTS = frozenset([22])
+
+PCAP_HEADER = struct.Struct('=IHHiIII')
+PCAP_RECORD = struct.Struct('=IIII')
+
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+
+def _transport(frame):
+    '''(protocol, offset of the L4 header) of an IP Ethernet frame, or None.'''
+    ethertype = struct.unpack_from('!H', frame, 12)[0]
+    offset = 14
+    if ethertype == 0x8100:  # 802.1Q
+        ethertype = struct.unpack_from('!H', frame, 16)[0]
+        offset = 18
+    if ethertype == 0x0800:
+        version_ihl, = struct.unpack_from('!B', frame, offset)
+        protocol, = struct.unpack_from('!B', frame, offset + 9)
+        fragment, = struct.unpack_from('!H', frame, offset + 6)
+        if fragment & 0x1fff:
+            return None  # no L4 header in later fragments
+        return protocol, offset + (version_ihl & 0xf) * 4
+    elif ethertype == 0x86dd:
+        protocol, = struct.unpack_from('!B', frame, offset + 6)
+        return protocol, offset + 40
+    return None
+
+def packet_ports(frame):
+    '''(src port, dst port) of a TCP/UDP Ethernet frame, or None.'''
+    try:
+        transport = _transport(frame)
+        if not transport or transport[0] not in (6, 17):
+            return None
+        return struct.unpack_from('!HH', frame, transport[1])
+    except struct.error:
+        return None
+
+def syn_port(frame):
+    '''Source port of a TCP SYN (not SYN/ACK) Ethernet frame, or None.'''
+    try:
+        transport = _transport(frame)
+        if not transport or transport[0] != 6:
+            return None
+        flags, = struct.unpack_from('!B', frame, transport[1] + 13)
+        if flags & (TCP_SYN | TCP_ACK) != TCP_SYN:
+            return None
+        return struct.unpack_from('!H', frame, transport[1])[0]
+    except struct.error:
+        return None
+
+
+def write_pcap(path, packets):
+    '''Write (timestamp, frame) pairs to a classic pcap file.'''
+    with open(path, 'wb') as f:
+        f.write(PCAP_HEADER.pack(0xa1b2c3d4, 2, 4, 0, 0, SNAPLEN, LINKTYPE_ETHERNET))
+        for ts, frame in packets:
+            f.write(PCAP_RECORD.pack(int(ts), int((ts % 1) * 1000000),\
+                len(frame), len(frame)))
+            f.write(frame)
+
+
+class PacketCapture(object):
+    '''A capture service that is started once per worker and replaces the
+    per-trial tcpdump.
+
+    A background thread reads every frame from an AF_PACKET socket into a
+    rolling buffer. :meth:`begin_trial` and :meth:`end_trial` cut the frames
+    seen in between into a pcap file. If a trial is given a `port_source`,
+    it is polled while the trial runs, and only frames to or from the ports
+    it returns are kept, so parallel workers don't capture each other's
+    traffic. Every SYN from a port not seen yet triggers a poll
+    right away, while the new socket surely exists. Still, a connection
+    that closes before that poll reads /proc is missed (its socket no
+    longer has an owner); :meth:`end_trial` logs how many frames it left
+    out. Capturing on an interface of the browser's own (see
+    :mod:`netns`) needs no `port_source` and misses nothing.
+
+    Needs CAP_NET_RAW, just like tcpdump.
+
+    :param interface: capture only on this interface; by default, capture on
+        every non-loopback interface
+    :param buffer_bytes: size of the rolling buffer
+    :param port_poll_interval: how often to call a trial's `port_source`
+        (seconds)
+    '''
+
+    def __init__(self, interface=None, buffer_bytes=64 * 1024 * 1024,\
+        port_poll_interval=0.2):
+        self._interface = interface
+        self._buffer_bytes = buffer_bytes
+        self._port_source = None
+        self._port_poll_interval = port_poll_interval
+
+        self._socket = None
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._dropped_since = None  # timestamp of the newest dropped frame
+
+        self._trial_start = None
+        self._trial_ports = set()
+        self._sampler = None
+        self._sample_now = threading.Event()
+
+    def start(self):
+        '''Open the socket and start buffering. Returns False if that is not
+        possible (e.g., no permission), so callers can fall back to tcpdump.'''
+        try:
+            self._socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,\
+                socket.htons(ETH_P_ALL))
+            if self._interface:
+                self._socket.bind((self._interface, 0))
+            self._socket.settimeout(0.5)
+        except (socket.error, AttributeError) as e:
+            logging.warning('Cannot open packet socket: %s', e)
+            self._socket = None
+            return False
+        self._running = True
+        self._thread = threading.Thread(name='capture', target=self._capture_loop)
+        self._thread.daemon = True
+        self._thread.start()
+        logging.debug('Packet capture started on %s', self._interface or 'all interfaces')
+        return True
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        with self._lock:
+            self._buffer.clear()
+            self._buffered_bytes = 0
+
+    def _capture_loop(self):
+        while self._running:
+            try:
+                frame, address = self._socket.recvfrom(SNAPLEN)
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if self._running:
+                    logging.error('Packet capture failed: %s', e)
+                return
+            ts = time()
+            _, _, pkttype, hatype = address[:4]
+            if hatype not in (ARPHRD_ETHER, ARPHRD_LOOPBACK):
+                continue  # no Ethernet header, would not fit our pcaps
+            if hatype == ARPHRD_LOOPBACK and (not self._interface\
+                or pkttype == PACKET_OUTGOING):
+                continue  # skip lo unless asked for; it sees every frame twice
+            if self._sampler:
+                port = syn_port(frame)
+                if port is not None and port not in self._trial_ports:
+                    self._sample_now.set()
+            with self._lock:
+                self._buffer.append((ts, frame))
+                self._buffered_bytes += len(frame)
+                while self._buffered_bytes > self._buffer_bytes:
+                    old_ts, old = self._buffer.popleft()
+                    self._buffered_bytes -= len(old)
+                    self._dropped_since = old_ts
+
+    def _sample_ports(self):
+        try:
+            ports = self._port_source()
+        except Exception as e:
+            logging.debug('Error listing browser ports: %s', e)
+            return
+        with self._lock:
+            self._trial_ports.update(ports)
+
+    def _sampler_loop(self, start):
+        while self._trial_start == start:
+            self._sample_now.clear()
+            self._sample_ports()
+            self._sample_now.wait(self._port_poll_interval)
+
+    def begin_trial(self, port_source=None):
+        '''Mark the start of a trial (no startup delay, unlike tcpdump).
+
+        :param port_source: callable returning the set of local ports that
+            belong to the browser; if None, keep all frames
+        '''
+        start = time()
+        with self._lock:
+            self._trial_ports = set()
+        self._port_source = port_source
+        self._trial_start = start
+        if self._port_source:
+            self._sampler = threading.Thread(name='capture-ports',\
+                target=self._sampler_loop, args=(start,))
+            self._sampler.daemon = True
+            self._sampler.start()
+
+    def end_trial(self, path):
+        '''Write the frames of the current trial to `path` (pcap).'''
+        start, end = self._trial_start, time()
+        self._trial_start = None
+        if self._sampler:
+            self._sample_now.set()
+            self._sampler.join()
+            self._sampler = None
+        if start is None:
+            return
+        if self._port_source:
+            self._sample_ports()  # catch sockets opened at the very end
+
+        with self._lock:
+            if self._dropped_since and self._dropped_since >= start:
+                logging.warning('Capture buffer too small, lost the start of the trial')
+            frames = [(ts, frame) for ts, frame in self._buffer if start <= ts <= end]
+            ports = set(self._trial_ports)
+
+        packets = []
+        excluded = 0
+        for ts, frame in frames:
+            frame_ports = packet_ports(frame)
+            if frame_ports and EXCLUDED_PORTS.intersection(frame_ports):
+                continue
+            if self._port_source and not (frame_ports and ports.intersection(frame_ports)):
+                # someone else's, or a browser connection we never saw open
+                excluded += 1
+                continue
+            packets.append((ts, frame))
+        write_pcap(path, packets)
+        logging.debug('Wrote %d packets to %s (%d left out as not the browser\'s)',\
+            len(packets), path, excluded)
@@ -1,19 +1,57 @@
 import os
+import json
+import base64
 import subprocess
 import logging
-from time import sleep
+import threading
+import urlparse
+from time import sleep, time
 from loader import Loader, LoadResult, Timeout, TimeoutError
+from timeouts import remaining
+from devtools import DevToolsSession, DevToolsError, HarRecorder, browser_version
+from netem import NetworkProfile
 
 CHROME = '/usr/bin/env google-chrome'
 CHROME_HAR_CAPTURER = '/usr/bin/env chrome-har-capturer'
 XVFB = '/usr/bin/env Xvfb'
+DEVTOOLS_TIMEOUT = 10
+# keep recording this long after onload, like 'chrome-har-capturer -d 500'
+TAB_SETTLE_SECONDS = 0.5
+# chrome.benchmarking is exposed because we launch with --enable-net-benchmarking
+CLOSE_CONNECTIONS_JAVASCRIPT = '''
+if (window.chrome && chrome.benchmarking) {
+    chrome.benchmarking.closeConnections();
+    chrome.benchmarking.clearHostResolverCache();
+}
+'''
 #DISPLAY = ':%s'%os.geteuid()
 
+# http://www.w3.org/TR/navigation-timing/ and https://www.w3.org/TR/paint-timing/
+TIMINGS_JAVASCRIPT = '''
+(function() {
+    var performance = window.performance || {};
+    var timings = performance.timing || {};
+    var getEntries = performance.getEntriesByType ?
+        function(t) { return performance.getEntriesByType(t); } :
+        function(t) { return []; };
+    var fcp = null;
+    getEntries('paint').forEach(function(e) {
+        if (e.name == 'first-contentful-paint') fcp = e.startTime;
+    });
+    var size = 0;
+    getEntries('navigation').concat(getEntries('resource')).forEach(function(e) {
+        size += e.transferSize || 0;
+    });
+    return {navigationStart: timings.navigationStart, fetchStart: timings.fetchStart,
+            domContentLoadedEventEnd: timings.domContentLoadedEventEnd,
+            loadEventEnd: timings.loadEventEnd, firstContentfulPaint: fcp,
+            size: size, url: location.href};
+})()
+'''
+
 # TODO: test if isntalled chrome can support HTTP2
 # TODO: pick different display if multiple instances are used at once
-# TODO: get load time
 # TODO: screenshot?
-# TODO: final URL?
 # TODO: pass timeout to chrome?
 # TODO: FAILURE_NO_200?
 # TODO: Cache-Control header
@@ -21,12 +59,14 @@ XVFB = '/usr/bin/env Xvfb'
 class ChromeLoader(Loader):
     '''Subclass of :class:`Loader` that loads pages using Chrome.
 
-    .. note:: The :class:`ChromeLoader` currently does not time page load.
     .. note:: The :class:`ChromeLoader` currently does not support single-object loading (i.e., it always loads the full page).
     .. note:: The :class:`ChromeLoader` currently does not support disabling network caches.
+
+    :param max_tabs: how many pages :meth:`load_page_in_tab` may load at once,
+        each in its own browser context
     '''
 
-    def __init__(self, **kwargs):
+    def __init__(self, max_tabs=1, **kwargs):
         super(ChromeLoader, self).__init__(**kwargs)
         if not self._full_page:
             raise NotImplementedError('ChromeLoader does not support loading only an object')
@@ -37,15 +77,168 @@ class ChromeLoader(Loader):
         self._chrome_proc = None
         self.DISPLAY = None
         self.debug_port = None
+        self.debug_host = 'localhost'
         self._devnull = None
 
-    def _preload_objects(self, preloads, fresh):
+        # origins whose storage should be wiped when resetting the browser
+        self._visited_origins = set()
+
+        # concurrent tab loads: cap, browser target session and its lock
+        self._max_tabs = max_tabs
+        self._tab_slots = threading.BoundedSemaphore(max_tabs)
+        self._browser_session = None
+        self._browser_lock = threading.Lock()
+
+        # DevTools network emulation lasts only as long as the session that
+        # set it up, so it is kept open while a profile is in effect
+        self._emulation_session = None
+        self._results_lock = threading.Lock()
+
+    def _remember_origin(self, url):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme and parsed.netloc:
+            self._visited_origins.add('%s://%s' % (parsed.scheme, parsed.netloc))
+
+    def _reset(self, deadline=None):
+        '''Clear cache, cookies, storage, service workers and sockets over the
+        DevTools protocol and park the tab on about:blank (giving up at
+        `deadline`).'''
+        session = None
+        try:
+            with Timeout(None, 'Timeout resetting Chrome', deadline) as timeout:
+                session = DevToolsSession.for_page(self.debug_port, self.debug_host,\
+                    timeout=remaining(DEVTOOLS_TIMEOUT, deadline))
+                timeout.guard(session.close)
+                session.send('Network.clearBrowserCache')
+                session.send('Network.clearBrowserCookies')
+                for origin in self._visited_origins:
+                    try:
+                        session.send('Storage.clearDataForOrigin', origin=origin,\
+                            storageTypes='all')
+                    except DevToolsError as e:
+                        # older Chromes lack the Storage domain; cache and cookies
+                        # are still gone, so keep going
+                        logging.debug('Could not clear storage for %s: %s', origin, e)
+                self._visited_origins.clear()
+                session.evaluate(CLOSE_CONNECTIONS_JAVASCRIPT)
+                session.send('Page.navigate', url='about:blank')
+        except Exception as e:
+            logging.warning('Error resetting Chrome over DevTools: %s', e)
+            return False
+        finally:
+            if session:
+                session.close()
+        logging.debug('Chrome state reset')
+        return True
+
+    def _browser_pids(self):
+        return [self._chrome_proc.pid] if self._chrome_proc else []
+
+    @staticmethod
+    def _emulation_params(profile):
+        # DevTools wants bytes per second, -1 for unlimited; no loss or queues
+        def rate(kbps):
+            return kbps * 1000 / 8.0 if kbps else -1
+        return {'offline': False, 'latency': profile.rtt_ms,\
+                'downloadThroughput': rate(profile.down_kbps),\
+                'uploadThroughput': rate(profile.up_kbps)}
+
+    def _emulate_network(self, profile):
+        '''Throttle the tab with DevTools network emulation. Loss and queue
+        size are not supported there (they need tc, see isolate_network).'''
+        if self._emulation_session:
+            self._emulation_session.close()
+            self._emulation_session = None
+        if profile is None:
+            return None
+        try:
+            session = DevToolsSession.for_page(self.debug_port, self.debug_host,\
+                timeout=DEVTOOLS_TIMEOUT)
+            session.send('Network.emulateNetworkConditions',\
+                **self._emulation_params(profile))
+        except Exception as e:
+            logging.warning('Error setting up network emulation: %s', e)
+            return None
+        if profile.loss or profile.queue_packets:
+            logging.warning('DevTools emulation ignores loss and queue size of %s',\
+                profile.name)
+        self._emulation_session = session
+        return 'devtools'
+
+    def _check_health(self):
+        '''Chrome (and Xvfb) are alive and the debugger answers.'''
+        if not self._chrome_proc or self._chrome_proc.poll() is not None:
+            return False
+        if self._xvfb_proc and self._xvfb_proc.poll() is not None:
+            return False
+        try:
+            browser_version(self.debug_port, self.debug_host, timeout=DEVTOOLS_TIMEOUT)
+        except Exception as e:
+            logging.debug('Chrome debugger not responding: %s', e)
+            return False
+        return True
+
+    def _page_timings(self, session=None, deadline=None):
+        '''Read Navigation/Paint Timing and the final URL from the page that
+        was just loaded. Returns a dict of :class:`LoadResult` kwargs, or an
+        empty dict if the page can't be queried (by `deadline`).'''
+        own_session = session is None
+        try:
+            if own_session:
+                session = DevToolsSession.for_page(self.debug_port, self.debug_host,\
+                    timeout=remaining(DEVTOOLS_TIMEOUT, deadline))
+            timings = session.evaluate(TIMINGS_JAVASCRIPT,\
+                timeout=remaining(DEVTOOLS_TIMEOUT, deadline))
+        except Exception as e:
+            logging.debug('Could not read page timings: %s', e)
+            return {}
+        finally:
+            if own_session and session:
+                session.close()
+        if not timings or not timings.get('loadEventEnd'):
+            return {}
+
+        fetch_start = timings['fetchStart']
+        stats = {'time': (timings['loadEventEnd'] - fetch_start) / 1000.0,
+                 'dom_content_loaded': (timings['domContentLoadedEventEnd'] - fetch_start) / 1000.0,
+                 'final_url': timings['url'],
+                 'size': timings['size'] or None}
+        if timings['firstContentfulPaint'] is not None:
+            # paint entries are relative to navigationStart
+            stats['first_contentful_paint'] = (timings['firstContentfulPaint'] -\
+                (fetch_start - timings['navigationStart'])) / 1000.0
+        return stats
+
+    def _har_timings(self, harpath):
+        '''Fallback for :meth:`_page_timings`: page timings from the HAR.'''
+        try:
+            with open(harpath, 'r') as f:
+                har = json.load(f)
+            page_timings = har['log']['pages'][0]['pageTimings']
+            if page_timings.get('onLoad', -1) < 0:
+                return {}
+            stats = {'time': page_timings['onLoad'] / 1000.0,
+                     'size': sum(max(0, e['response']['bodySize'])\
+                        for e in har['log']['entries']) or None}
+            if page_timings.get('onContentLoad', -1) >= 0:
+                stats['dom_content_loaded'] = page_timings['onContentLoad'] / 1000.0
+            return stats
+        except Exception as e:
+            logging.debug('Could not read page timings from %s: %s', harpath, e)
+            return {}
+
+    def _preload_objects(self, preloads, fresh, deadline=None):
         logging.debug('preloading objects')
 
         # no need to save HAR
         harpath = '/dev/null'
 
+        # clear state ourselves so the capturer does not have to
+        if fresh and self._reset(deadline):
+            fresh = False
+
         for url in preloads:
+            self._remember_origin(url)
             logging.debug('preloading %s', url)
             try:
                 # tell har capturer not to clean cache or connections
@@ -59,17 +252,16 @@ class ChromeLoader(Loader):
                 # load objects as if there are pages
                 # delay 10ms could be even smaller
                 capturer_cmd = '%s -d 10 ' % CHROME_HAR_CAPTURER + preload_flag +\
-                               ' -p %d '%(self.debug_port) + ' -o %s %s' % (harpath, url)
+                               ' -p %d -t %s '%(self.debug_port, self.debug_host) + ' -o %s %s' % (harpath, url)
 
                 logging.debug('Running capturer: %s', capturer_cmd)
-                with Timeout(seconds=self._timeout+5):
-                    subprocess.check_call(capturer_cmd.split(),\
-                        stdout=self._stdout_file, stderr=subprocess.STDOUT)
+                with Timeout(seconds=self._timeout+5, deadline=deadline) as timeout:
+                    self._call(capturer_cmd.split(), timeout)
             except TimeoutError:
                 logging.exception('* Timeout fetching %s', url)
                 return LoadResult(LoadResult.FAILURE_TIMEOUT, url)
             except subprocess.CalledProcessError as e:
-                logging.exception('Error loading %s: %s\n%s', url, e, e.output)
+                logging.exception('Error loading %s: %s', url, e)
                 return LoadResult(LoadResult.FAILURE_UNKNOWN, url)
             except Exception as e:
                 logging.exception('Error loading %s: %s', url, e)
@@ -78,7 +270,7 @@ class ChromeLoader(Loader):
 
 
 
-    def _load_page(self, test, _, trial_num=-1):
+    def _load_page(self, test, _, trial_num=-1, deadline=None):
 
         url = test['url']
 
@@ -93,32 +285,153 @@ class ChromeLoader(Loader):
         # load the specified URL
         logging.info('Fetching page %s', url)
 
+        self._remember_origin(url)
+
         try:
             repeat_flag = '-r'
-            if test['fresh_view']:
+            if test['fresh_view'] and not self._reset(deadline):
+                # could not reset over DevTools, let the capturer clear the cache
                 repeat_flag = ''
             # wait 0.5s between pages, could be smaller
             capturer_cmd = '%s -d 500 ' % CHROME_HAR_CAPTURER + repeat_flag +\
-                           ' -p %d'%self.debug_port +\
+                           ' -p %d -t %s'%(self.debug_port, self.debug_host) +\
                            ' -o %s %s' % (harpath, url)
             logging.debug('Running capturer: %s', capturer_cmd)
-            with Timeout(seconds=self._timeout+5):
-                subprocess.check_call(capturer_cmd.split(),\
-                    stdout=self._stdout_file, stderr=subprocess.STDOUT)
+            with Timeout(seconds=self._timeout+5, deadline=deadline) as timeout:
+                self._call(capturer_cmd.split(), timeout)
         except TimeoutError:
             logging.exception('* Timeout fetching %s', url)
             return LoadResult(LoadResult.FAILURE_TIMEOUT, url)
         except subprocess.CalledProcessError as e:
-            logging.exception('Error loading %s: %s\n%s', url, e, e.output)
+            logging.exception('Error loading %s: %s', url, e)
             return LoadResult(LoadResult.FAILURE_UNKNOWN, url)
         except Exception as e:
             logging.exception('Error loading %s: %s', url, e)
             return LoadResult(LoadResult.FAILURE_UNKNOWN, url)
         logging.debug('Page loaded.')
 
-        return LoadResult(LoadResult.SUCCESS, url, har=harpath)
+        # the capturer leaves the page in the tab, so ask it how long it took
+        stats = self._page_timings(deadline=deadline)
+        if not stats and test['save_har']:
+            stats = self._har_timings(harpath)
+        return LoadResult(LoadResult.SUCCESS, url, har=harpath, **stats)
 
 
+    def _browser_command(self, method, **params):
+        '''Send a command to the browser target; sessions are not thread-safe'''
+        with self._browser_lock:
+            if not self._browser_session:
+                self._browser_session = DevToolsSession.for_browser(self.debug_port,\
+                    self.debug_host, timeout=DEVTOOLS_TIMEOUT)
+            try:
+                return self._browser_session.send(method, **params)
+            except Exception:
+                # drop the session so the next command reconnects
+                self._browser_session.close()
+                self._browser_session = None
+                raise
+
+    def _load_page_in_context(self, test, trial_num, deadline):
+        '''Load one page in a fresh browser context and record its HAR from
+        that target's own DevTools events.'''
+        url = test['url']
+        context_id = self._browser_command('Target.createBrowserContext')['browserContextId']
+        session = None
+        try:
+            # the loop stops at the deadline by itself; this only cuts off a
+            # session that hangs in a command (past the time commands get)
+            with Timeout(None, 'Timeout in tab', deadline + DEVTOOLS_TIMEOUT) as timeout:
+                target_id = self._browser_command('Target.createTarget', url='about:blank',\
+                    browserContextId=context_id)['targetId']
+                session = DevToolsSession('ws://%s:%d/devtools/page/%s'\
+                    % (self.debug_host, self.debug_port, target_id), timeout=DEVTOOLS_TIMEOUT)
+                timeout.guard(session.close)
+                session.send('Network.enable')
+                session.send('Page.enable')
+                # tabs share the browser (and its link), so each one is
+                # throttled on its own target; no tc in this mode
+                profile = NetworkProfile.from_setting(test.get('network_profile'))
+                if profile:
+                    session.send('Network.emulateNetworkConditions',\
+                        **self._emulation_params(profile))
+
+                recorder = HarRecorder(url)
+                session.send('Page.navigate', url=url)
+                while not recorder.loaded:
+                    if time() > deadline:
+                        return LoadResult(LoadResult.FAILURE_TIMEOUT, url), None
+                    event = session.read_event(deadline - time())
+                    if event:
+                        recorder.feed(event)
+                settle = time() + TAB_SETTLE_SECONDS
+                while time() < settle:
+                    event = session.read_event(settle - time())
+                    if event:
+                        recorder.feed(event)
+
+                if test['save_har']:
+                    prefix = test['har_file_name'] if test['har_file_name'] else url
+                    harpath = self._outfile_path(prefix, suffix='.har', trial=trial_num)
+                    with open(harpath, 'w') as f:
+                        json.dump(recorder.har(), f)
+                else:
+                    harpath = None
+
+                stats = self._page_timings(session)
+
+                sspath = None
+                if test['save_screenshot']:
+                    prefix = test['screenshot_name'] if test['screenshot_name'] else url
+                    sspath = self._outfile_path(prefix, suffix='.png', trial=trial_num)
+                    with open(sspath, 'wb') as f:
+                        f.write(base64.b64decode(session.send('Page.captureScreenshot')['data']))
+
+                if profile:
+                    stats['network_profile'] = dict(profile.to_dict(), method='devtools')
+                return LoadResult(LoadResult.SUCCESS, url, har=harpath, img=sspath, **stats),\
+                    recorder
+        finally:
+            if session:
+                session.close()
+            try:
+                self._browser_command('Target.disposeBrowserContext',\
+                    browserContextId=context_id)
+            except Exception as e:
+                logging.warning('Error disposing browser context: %s', e)
+
+    def load_page_in_tab(self, the_test, trial_number):
+        '''Like :meth:`load_page`, but safe to call from several threads: each
+        call loads the page in its own isolated browser context, and at most
+        `max_tabs` of them run at once. Meant for throughput-oriented crawls;
+        there is no per-trial packet capture or preloading in this mode.'''
+        test = dict(the_test)
+        url = self._check_url(test['url'])
+        test['url'] = url
+
+        phases = {}
+        waiting = time()
+        with self._tab_slots:
+            self._spans.add('tab_wait', waiting, time() - waiting, phases)
+            logging.info('Fetching page %s in a new tab', url)
+            try:
+                with self._spans.span('page_load', phases, url=url, trial=trial_number):
+                    result, _ = self._load_page_in_context(test, trial_number,\
+                        time() + self._timeout)
+            except TimeoutError:
+                logging.exception('* Timeout fetching %s in tab', url)
+                result = LoadResult(LoadResult.FAILURE_TIMEOUT, url)
+            except Exception as e:
+                logging.exception('Error loading %s in tab: %s', url, e)
+                result = LoadResult(LoadResult.FAILURE_UNKNOWN, url)
+        result.phases = phases
+        self._record_artifacts(url, trial_number, result)
+
+        logging.debug('Trial %d (tab): %s', trial_number, result)
+        with self._results_lock:
+            self._urls.append(url)
+            self._load_results[url].append(result)
+        return result
+
     def _setup(self, my_id=0):
         stdout = self._stdout_file
         self._devnull = open(os.devnull, 'w')
@@ -129,6 +442,8 @@ class ChromeLoader(Loader):
         # valid port number 1000~65536
         # NOTE: this simple formula does not guarantee conflict-free
         self.debug_port = (os.getuid()*10+my_id)%64536 + 1000
+        # in a network namespace the debugger is only reachable on its link
+        self.debug_host = self._netns.namespace_address if self._netns else 'localhost'
         if self._headless:
             # start a virtual display
             try:
@@ -138,7 +453,7 @@ class ChromeLoader(Loader):
                 xvfb_command = '%s %s -screen 0 1366x768x24 -ac' % (XVFB, self.DISPLAY)
 
                 logging.debug('Starting XVFB: %s', xvfb_command)
-                self._xvfb_proc = subprocess.Popen(xvfb_command.split(),\
+                self._xvfb_proc = self._spawn('xvfb', xvfb_command.split(),\
                     stdout=stdout, stderr=self._devnull)
                 sleep(0.5)
 
@@ -151,11 +466,6 @@ class ChromeLoader(Loader):
                 return False
             logging.debug('Started XVFB (DISPLAY=%s)', os.environ['DISPLAY'])
 
-        if self._log_ssl_keys:
-            # the browser appends new keys to this file without overwrite the old content
-            keylog_file = os.path.join(self._outdir, 'ssl_keylog')
-            os.environ['SSLKEYLOGFILE'] = keylog_file
-
 
         # launch chrome with no cache and remote debug on
         try:
@@ -170,6 +480,15 @@ class ChromeLoader(Loader):
                 options += ' --use-spdy=off'
             if self._ignore_certificate_errors:
                 options += ' --ignore-certificate-errors'
+            if self._proxy:
+                # <-loopback> sends local URLs through the proxy, too
+                options += ' --proxy-server=%s --proxy-bypass-list=<-loopback>'\
+                    % self._proxy_address()
+            if self._netns:
+                options += ' --remote-debugging-address=%s' % self.debug_host
+                if os.geteuid() == 0:
+                    # namespaces need root, and Chrome won't sandbox as root
+                    options += ' --no-sandbox'
             # options for chrome-har-capturer
             # options += ' about:blank --remote-debugging-port=9222 --enable-benchmarking --enable-net-benchmarking --disk-cache-dir=/tmp'
             # --user-data-dir allows multiple chromes to launch under the same user
@@ -180,8 +499,8 @@ class ChromeLoader(Loader):
 
             chrome_command = '%s %s' % (CHROME, options)
             logging.debug('Starting Chrome: %s', chrome_command)
-            self._chrome_proc = subprocess.Popen(chrome_command.split(),\
-                stdout=stdout, stderr=self._devnull)
+            self._chrome_proc = self._spawn('chrome', chrome_command.split(),\
+                in_netns=True, stdout=stdout, stderr=self._devnull)
             sleep(2)
 
             # check if Xvfb failed to start and process terminated
@@ -196,20 +515,22 @@ class ChromeLoader(Loader):
 
 
     def _teardown(self):
+        if self._emulation_session:
+            self._emulation_session.close()
+            self._emulation_session = None
+
+        if self._browser_session:
+            self._browser_session.close()
+            self._browser_session = None
+
         if self._chrome_proc:
             logging.debug('Stopping Chrome')
-            self._chrome_proc.terminate()
-            #self._chrome_proc.kill()
-            self._chrome_proc.wait()
-
-        # kill any subprocesses chrome might have opened
-        #try:
-        #    subprocess.check_output('killall chrome'.split(), stderr=self._devnull)
-        #except Exception as e:
-        #    logging.info('Cannot Kill all remaining chrome processes (maybe there were none): %s', e)
+            # renderers, GPU and zygote processes go with the process group
+            self._reap('chrome', self._chrome_proc)
+            self._chrome_proc = None
 
         if self._xvfb_proc:
             logging.debug('Stopping XVFB')
-            self._xvfb_proc.terminate()
-            self._xvfb_proc.wait()
+            self._reap('xvfb', self._xvfb_proc)
+            self._xvfb_proc = None
         self._devnull.close()
@@ -0,0 +1,344 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import logging
+import argparse
+import numpy
+import artifacts
+from resultstore import ResultStore, RUNS_FILE
+
+# metrics where a larger value is a regression
+DEFAULT_METRICS = ('time', 'dom_content_loaded', 'first_contentful_paint', 'size')
+
+# max resampled values held in memory at once by the bootstrap
+BOOTSTRAP_CHUNK = 1 << 22
+
+
+################################################################################
+#                                                                              #
+#   LOADING SAMPLES                                                            #
+#                                                                              #
+################################################################################
+
+def _har_url(har):
+    page = har['log']['pages'][0]
+    return page['id'] if '://' in page['id'] else page['title']
+
+# the HAR equivalents of LoadResult fields (see ChromeLoader._har_timings)
+def _har_metrics(har):
+    timings = har['log']['pages'][0].get('pageTimings', {})
+    metrics = {'size': sum(max(0, e['response']['bodySize'])\
+        for e in har['log']['entries']) or None,
+        'num_objects': len(har['log']['entries'])}
+    if timings.get('onLoad', -1) >= 0:
+        metrics['time'] = timings['onLoad'] / 1000.0
+    if timings.get('onContentLoad', -1) >= 0:
+        metrics['dom_content_loaded'] = timings['onContentLoad'] / 1000.0
+    return metrics
+
+def _har_paths(directory):
+    # the manifest saves listing (possibly huge) directories
+    if artifacts.has_manifest(directory):
+        for _, _, path in artifacts.Manifest(directory).artifacts('har'):
+            yield path
+        return
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if artifacts.has_suffix(name, '.har'):
+                yield os.path.join(root, name)
+
+def har_samples(directory, metrics):
+    '''Read the HARs in `directory` (recursively) into a dict mapping each
+    metric to a dict mapping each URL to an array of its values.'''
+    values = dict((metric, {}) for metric in metrics)
+    for path in _har_paths(directory):
+        try:
+            with artifacts.open_artifact(path) as f:
+                har = json.load(f)
+            url = _har_url(har)
+            har_metrics = _har_metrics(har)
+        except (IOError, ValueError, KeyError, IndexError) as e:
+            logging.warning('Skipping %s: %s', path, e)
+            continue
+        for metric in metrics:
+            if har_metrics.get(metric) is not None:
+                values[metric].setdefault(url, []).append(har_metrics[metric])
+    return dict((metric, dict((url, numpy.array(v, dtype=numpy.float64))\
+        for url, v in by_url.items())) for metric, by_url in values.items())
+
+def store_samples(path, metrics, run=None):
+    '''Like :func:`har_samples`, for the successful loads in a
+    :class:`ResultStore` (optionally only run `run`).'''
+    store = ResultStore(path)
+    samples = {}
+    for metric in metrics:
+        samples[metric] = dict((url, v[~numpy.isnan(v)])\
+            for url, v in store.by_url(metric, run).items())
+    return samples
+
+def load_samples(path, metrics, run=None):
+    '''Samples from a result store or a directory of HARs, whichever `path`
+    is. `path` may end with ':<run>' to pick a run of a result store.'''
+    if run is None and ':' in path and not os.path.exists(path):
+        path, run = path.rsplit(':', 1)
+        run = int(run)
+    if os.path.exists(os.path.join(path, RUNS_FILE)):
+        return store_samples(path, metrics, run)
+    if run is not None:
+        raise ValueError('%s is not a result store; it has no runs' % path)
+    return har_samples(path, metrics)
+
+
+################################################################################
+#                                                                              #
+#   STATISTICS                                                                 #
+#                                                                              #
+################################################################################
+
+# all tests work on a matrix per sample set: one row per URL, NaN padded
+
+def pad(arrays):
+    '''Stack 1D arrays into a NaN-padded matrix; returns (matrix, lengths).'''
+    lengths = numpy.array([len(a) for a in arrays], dtype=numpy.int64)
+    matrix = numpy.full((len(arrays), lengths.max() if len(arrays) else 0), numpy.nan)
+    mask = numpy.arange(matrix.shape[1]) < lengths[:, None]
+    if len(arrays):
+        matrix[mask] = numpy.concatenate(arrays)
+    return matrix, lengths
+
+def row_medians(matrix, lengths):
+    # padding sorts last, so the median is at the middle of each row's values
+    ordered = numpy.sort(matrix, axis=1)
+    rows = numpy.arange(len(lengths))
+    low = ordered[rows, numpy.maximum(lengths - 1, 0) // 2]
+    high = ordered[rows, lengths // 2]
+    return numpy.where(lengths > 0, (low + high) / 2.0, numpy.nan)
+
+def _norm_sf(z):
+    return 0.5 * numpy.array([math.erfc(x / math.sqrt(2)) for x in z.ravel()]).reshape(z.shape)
+
+def mann_whitney(a, a_lengths, b, b_lengths):
+    '''Two-sided Mann-Whitney U test of each row of `a` against the same row
+    of `b` (normal approximation with tie and continuity correction).
+    Returns (U of a, p values); p is NaN for rows with an empty side.'''
+    both = numpy.concatenate([a, b], axis=1)
+    from_a = numpy.zeros(both.shape, dtype=numpy.bool_)
+    from_a[:, :a.shape[1]] = True
+
+    # average ranks, ties included: the rank of a value is the middle of the
+    # positions of its tie group in the sorted row
+    order = numpy.argsort(both, axis=1, kind='mergesort')
+    ordered = numpy.take_along_axis(both, order, axis=1)
+    positions = numpy.broadcast_to(numpy.arange(both.shape[1]), both.shape)
+    starts = numpy.ones(both.shape, dtype=numpy.bool_)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = numpy.ones(both.shape, dtype=numpy.bool_)
+    ends[:, :-1] = starts[:, 1:]
+    first = numpy.maximum.accumulate(numpy.where(starts, positions, 0), axis=1)
+    last = numpy.minimum.accumulate(numpy.where(ends, positions, both.shape[1])[:, ::-1],\
+        axis=1)[:, ::-1]
+    valid = ~numpy.isnan(ordered)
+    ranks = numpy.where(valid, (first + last) / 2.0 + 1, 0)
+    group_sizes = numpy.where(valid, last - first + 1, 1).astype(numpy.float64)
+
+    rank_sum = (ranks * numpy.take_along_axis(from_a, order, axis=1)).sum(axis=1)
+    n1 = a_lengths.astype(numpy.float64)
+    n2 = b_lengths.astype(numpy.float64)
+    n = n1 + n2
+    u = rank_sum - n1 * (n1 + 1) / 2.0
+    # sum over tie groups of t^3 - t, as a sum over their members of t^2 - 1
+    ties = (group_sizes ** 2 - 1).sum(axis=1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sigma = numpy.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+        delta = numpy.abs(u - n1 * n2 / 2.0)
+        z = numpy.maximum(delta - 0.5, 0) / sigma
+    p = numpy.where(sigma > 0, numpy.minimum(1.0, 2 * _norm_sf(numpy.nan_to_num(z))), 1.0)
+    p[(a_lengths == 0) | (b_lengths == 0)] = numpy.nan
+    return u, p
+
+def _resampled_medians(matrix, lengths, resamples, random):
+    # medians of `resamples` resamples (with replacement) of every row. With
+    # the row sorted, the median of a resample is the value at the median of
+    # the positions drawn, so only small ints are drawn and sorted
+    ordered = numpy.sort(matrix, axis=1)
+    width = ordered.shape[1]
+    medians = numpy.empty((len(lengths), resamples))
+    chunk = max(1, BOOTSTRAP_CHUNK // max(1, resamples * width))
+    for start in range(0, len(lengths), chunk):
+        rows = slice(start, start + chunk)
+        n = lengths[rows][:, None, None]
+        size = (len(n), resamples, width)
+        if width < 1 << 15:
+            # 16 random bits scaled to [0, n) are plenty for a few thousand
+            # trials and several times faster than drawing floats
+            picks = (random.randint(0, 1 << 16, size=size, dtype=numpy.uint16)\
+                .astype(numpy.int32) * n.astype(numpy.int32) >> 16).astype(numpy.int16)
+        else:
+            picks = (random.random_sample(size) * n).astype(numpy.int64)
+        # draws past a row's length sort last and are never looked at
+        picks = numpy.where(numpy.arange(width) < n, picks, picks.dtype.type(width))
+        picks.sort(axis=2)
+        low = numpy.take_along_axis(picks, (n - 1) // 2, axis=2)[:, :, 0]
+        high = numpy.take_along_axis(picks, n // 2, axis=2)[:, :, 0]
+        values = ordered[rows]
+        medians[rows] = (numpy.take_along_axis(values, low, axis=1) +\
+            numpy.take_along_axis(values, high, axis=1)) / 2.0
+    return medians
+
+def bootstrap_median_difference(a, a_lengths, b, b_lengths, resamples=1000,\
+    confidence=0.95, seed=None):
+    '''Percentile bootstrap confidence interval of median(b) - median(a),
+    per row. Returns (low, high); NaN for rows with an empty side.'''
+    random = numpy.random.RandomState(seed)
+    nonempty = (a_lengths > 0) & (b_lengths > 0)
+    low = numpy.full(len(a_lengths), numpy.nan)
+    high = numpy.full(len(a_lengths), numpy.nan)
+    if nonempty.any():
+        differences = _resampled_medians(b[nonempty], b_lengths[nonempty], resamples, random) -\
+            _resampled_medians(a[nonempty], a_lengths[nonempty], resamples, random)
+        tail = (1 - confidence) / 2.0 * 100
+        low[nonempty], high[nonempty] = numpy.percentile(differences, [tail, 100 - tail], axis=1)
+    return low, high
+
+def benjamini_hochberg(p):
+    '''False discovery rate adjusted p values (q values); NaNs stay NaN.'''
+    q = numpy.full(p.shape, numpy.nan)
+    tested = numpy.flatnonzero(~numpy.isnan(p))
+    if not len(tested):
+        return q
+    order = tested[numpy.argsort(p[tested])]
+    adjusted = p[order] * len(order) / numpy.arange(1, len(order) + 1)
+    q[order] = numpy.minimum(1.0, numpy.minimum.accumulate(adjusted[::-1])[::-1])
+    return q
+
+
+################################################################################
+#                                                                              #
+#   COMPARISON                                                                 #
+#                                                                              #
+################################################################################
+
+def compare(baseline, candidate, metrics=DEFAULT_METRICS, alpha=0.05,\
+    min_change=0.0, resamples=1000, min_samples=5, seed=None):
+    '''Compare two sample sets (see :func:`load_samples`) per URL and metric.
+
+    Every (URL, metric) with at least `min_samples` samples on both sides is
+    tested with Mann-Whitney, and the p values of all of them together are
+    corrected with Benjamini-Hochberg. Where the q value is below `alpha`
+    and the median moved by more than `min_change` (a fraction of the
+    baseline median), the bootstrap gives a confidence interval of the
+    difference of medians (elsewhere it is NaN): the comparison is a
+    regression if the interval is above 0, an improvement if it is below.
+
+    Returns a list of dicts, regressions first, largest relative change
+    first.'''
+    tests = []
+    for metric in metrics:
+        base, cand = baseline.get(metric, {}), candidate.get(metric, {})
+        urls = sorted(url for url in set(base) & set(cand)\
+            if len(base[url]) >= min_samples and len(cand[url]) >= min_samples)
+        if not urls:
+            continue
+        a, a_lengths = pad([base[url] for url in urls])
+        b, b_lengths = pad([cand[url] for url in urls])
+        _, p = mann_whitney(a, a_lengths, b, b_lengths)
+        tests.append((metric, urls, a, a_lengths, b, b_lengths, p))
+    if not tests:
+        return []
+
+    # correct across every test of the comparison, not per metric
+    q = benjamini_hochberg(numpy.concatenate([test[-1] for test in tests]))
+    comparisons = []
+    offset = 0
+    for metric, urls, a, a_lengths, b, b_lengths, p in tests:
+        a_median, b_median = row_medians(a, a_lengths), row_medians(b, b_lengths)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            change = (b_median - a_median) / a_median
+        metric_q = q[offset:offset + len(urls)]
+        offset += len(urls)
+
+        # the bootstrap is by far the most expensive part, and only matters
+        # for the comparisons that passed the test
+        significant = (metric_q < alpha) & ~(numpy.abs(change) <= min_change)
+        low = numpy.full(len(urls), numpy.nan)
+        high = numpy.full(len(urls), numpy.nan)
+        if significant.any():
+            low[significant], high[significant] = bootstrap_median_difference(\
+                a[significant], a_lengths[significant], b[significant],\
+                b_lengths[significant], resamples, 1 - alpha, seed)
+
+        for i, url in enumerate(urls):
+            if significant[i] and low[i] > 0:
+                verdict = 'regression'
+            elif significant[i] and high[i] < 0:
+                verdict = 'improvement'
+            else:
+                verdict = 'unchanged'
+            comparisons.append({'url': url, 'metric': metric, 'verdict': verdict,
+                'baseline_samples': int(a_lengths[i]), 'candidate_samples': int(b_lengths[i]),
+                'baseline_median': float(a_median[i]), 'candidate_median': float(b_median[i]),
+                'change': float(change[i]), 'p': float(p[i]), 'q': float(metric_q[i]),
+                'difference_low': float(low[i]), 'difference_high': float(high[i])})
+
+    rank = {'regression': 0, 'improvement': 1, 'unchanged': 2}
+    comparisons.sort(key=lambda c: (rank[c['verdict']],\
+        -abs(c['change']) if not math.isnan(c['change']) else 0))
+    return comparisons
+
+
+def main():
+    metrics = args.metrics.split(',')
+    baseline = load_samples(args.baseline, metrics)
+    candidate = load_samples(args.candidate, metrics)
+    comparisons = compare(baseline, candidate, metrics, args.alpha, args.min_change,\
+        args.resamples, args.min_samples, args.seed)
+
+    regressions = [c for c in comparisons if c['verdict'] == 'regression']
+    for c in comparisons:
+        if args.all or c['verdict'] != 'unchanged':
+            if args.json:
+                print json.dumps(c, sort_keys=True)
+            else:
+                print '%-11s %-22s %+7.1f%%  %10.4g -> %-10.4g q=%.2g  %s' % (c['verdict'],\
+                    c['metric'], c['change'] * 100, c['baseline_median'],\
+                    c['candidate_median'], c['q'], c['url'])
+    logging.info('%d comparisons, %d regressions, %d improvements', len(comparisons),\
+        len(regressions), len([c for c in comparisons if c['verdict'] == 'improvement']))
+    # a gate: fail if anything regressed
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Compare two sets of page load results and rank the regressions. Exits with 1 if there are any.')
+    parser.add_argument('baseline', help='result store (optionally <store>:<run>) or directory of HARs')
+    parser.add_argument('candidate', help='result store (optionally <store>:<run>) or directory of HARs')
+    parser.add_argument('-m', '--metrics', default=','.join(DEFAULT_METRICS), help='comma separated metrics to compare (higher is worse)')
+    parser.add_argument('-a', '--alpha', type=float, default=0.05, help='false discovery rate')
+    parser.add_argument('-c', '--min_change', type=float, default=0.0, help='ignore changes of the median smaller than this fraction')
+    parser.add_argument('-n', '--min_samples', type=int, default=5, help='skip URLs with fewer samples on either side')
+    parser.add_argument('-r', '--resamples', type=int, default=1000, help='bootstrap resamples')
+    parser.add_argument('-s', '--seed', type=int, help='random seed for the bootstrap')
+    parser.add_argument('-j', '--json', action='store_true', default=False, help='print JSON lines')
+    parser.add_argument('--all', action='store_true', default=False, help='also print unchanged comparisons')
+    parser.add_argument('-q', '--quiet', action='store_true', default=False, help='only print errors')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info. --quiet wins if both are present')
+    args = parser.parse_args()
+
+    # set up logging
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = level
+    )
+
+    main()
@@ -0,0 +1,301 @@
+import json
+import logging
+import datetime
+import requests
+import websocket
+from time import time
+
+
+################################################################################
+#                                                                              #
+#   CHROME REMOTE DEBUGGING PROTOCOL                                           #
+#                                                                              #
+################################################################################
+
+class DevToolsError(Exception):
+    pass
+
+
+def list_targets(port, host='localhost', timeout=5):
+    '''Returns the list of targets (tabs, workers, ...) Chrome exposes on the
+    remote debugging port.'''
+    response = requests.get('http://%s:%d/json' % (host, port), timeout=timeout)
+    return response.json()
+
+
+def browser_version(port, host='localhost', timeout=5):
+    '''Returns Chrome's /json/version description, which also holds the
+    websocket URL of the browser target.'''
+    response = requests.get('http://%s:%d/json/version' % (host, port), timeout=timeout)
+    return response.json()
+
+
+class DevToolsSession(object):
+    '''A synchronous websocket connection to a single DevTools target.
+
+    Commands block until their reply arrives; events received in the meantime
+    are queued and can be consumed with :meth:`wait_for` or :meth:`pop_events`.
+
+    :param ws_url: the webSocketDebuggerUrl of the target
+    :param timeout: default timeout in seconds for each command
+    '''
+
+    def __init__(self, ws_url, timeout=10):
+        self._ws_url = ws_url
+        self._timeout = timeout
+        self._next_id = 0
+        self._events = []
+        self._ws = websocket.create_connection(ws_url, timeout=timeout)
+
+    @classmethod
+    def for_page(cls, port, host='localhost', timeout=10):
+        '''Connect to the first page target (i.e., the tab we drive).'''
+        for target in list_targets(port, host, timeout):
+            if target.get('type') == 'page' and 'webSocketDebuggerUrl' in target:
+                return cls(target['webSocketDebuggerUrl'], timeout)
+        raise DevToolsError('No debuggable page on port %d' % port)
+
+    @classmethod
+    def for_browser(cls, port, host='localhost', timeout=10):
+        '''Connect to the browser target (needed for Target.* commands).'''
+        version = browser_version(port, host, timeout)
+        if 'webSocketDebuggerUrl' not in version:
+            raise DevToolsError('Browser target not exposed on port %d' % port)
+        return cls(version['webSocketDebuggerUrl'], timeout)
+
+    def _recv(self, deadline):
+        remaining = deadline - time()
+        if remaining <= 0:
+            raise DevToolsError('Timed out waiting for DevTools on %s' % self._ws_url)
+        self._ws.settimeout(remaining)
+        try:
+            return json.loads(self._ws.recv())
+        except websocket.WebSocketTimeoutException:
+            raise DevToolsError('Timed out waiting for DevTools on %s' % self._ws_url)
+
+    def send(self, method, timeout=None, **params):
+        '''Issue a command and return its result dict.'''
+        self._next_id += 1
+        msg_id = self._next_id
+        self._ws.send(json.dumps({'id': msg_id, 'method': method, 'params': params}))
+
+        deadline = time() + (timeout if timeout is not None else self._timeout)
+        while True:
+            msg = self._recv(deadline)
+            if msg.get('id') == msg_id:
+                if 'error' in msg:
+                    raise DevToolsError('%s failed: %s' % (method, msg['error']))
+                return msg.get('result', {})
+            elif 'method' in msg:
+                self._events.append(msg)
+
+    def evaluate(self, expression, timeout=None):
+        '''Evaluate a JavaScript expression in the page and return its value.'''
+        result = self.send('Runtime.evaluate', timeout=timeout,\
+            expression=expression, returnByValue=True)
+        if result.get('exceptionDetails'):
+            raise DevToolsError('Exception evaluating %s: %s'\
+                % (expression, result['exceptionDetails']))
+        return result.get('result', {}).get('value')
+
+    def wait_for(self, method, timeout=None):
+        '''Block until an event named `method` arrives; returns its params.'''
+        for i, event in enumerate(self._events):
+            if event['method'] == method:
+                del self._events[i]
+                return event.get('params', {})
+
+        deadline = time() + (timeout if timeout is not None else self._timeout)
+        while True:
+            msg = self._recv(deadline)
+            if msg.get('method') == method:
+                return msg.get('params', {})
+            elif 'method' in msg:
+                self._events.append(msg)
+
+    def read_event(self, timeout):
+        '''Return the next event (queued ones first), or None if nothing
+        arrives within `timeout` seconds.'''
+        if self._events:
+            return self._events.pop(0)
+        deadline = time() + timeout
+        while True:
+            try:
+                msg = self._recv(deadline)
+            except DevToolsError:
+                return None
+            if 'method' in msg:
+                return msg
+
+    def pop_events(self):
+        '''Return and forget all queued events.'''
+        events = self._events
+        self._events = []
+        return events
+
+    def close(self):
+        try:
+            self._ws.close()
+        except Exception as e:
+            logging.debug('Error closing DevTools session: %s', e)
+
+
+################################################################################
+#                                                                              #
+#   HAR FROM DEVTOOLS EVENTS                                                   #
+#                                                                              #
+################################################################################
+
+def _har_headers(headers):
+    # DevTools joins repeated headers with newlines
+    har_headers = []
+    for name, value in headers.items():
+        for v in value.split('\n'):
+            har_headers.append({'name': name, 'value': v})
+    return har_headers
+
+def _har_datetime(wall_time):
+    return datetime.datetime.utcfromtimestamp(wall_time)\
+        .strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class HarRecorder(object):
+    '''Builds a HAR from the Network and Page events of a single target.
+
+    All events must come from one target's session, which is how loads
+    running side by side in different tabs are kept apart.
+
+    :param url: the URL of the page being recorded
+    '''
+
+    def __init__(self, url):
+        self._url = url
+        self._requests = {}  # requestId -> entry being built
+        self._entries = []  # all entries, in order
+        self._page_timestamp = None
+        self._page_wall_time = None
+        self._on_content_load = -1
+        self._on_load = -1
+
+    @property
+    def loaded(self):
+        '''True once the page's load event fired.'''
+        return self._on_load >= 0
+
+    def feed(self, event):
+        method = event.get('method')
+        params = event.get('params', {})
+        if method == 'Network.requestWillBeSent':
+            self._request_will_be_sent(params)
+        elif method == 'Network.responseReceived':
+            entry = self._requests.get(params['requestId'])
+            if entry:
+                entry['response'] = params['response']
+        elif method == 'Network.dataReceived':
+            entry = self._requests.get(params['requestId'])
+            if entry:
+                entry['data_length'] += params.get('dataLength', 0)
+        elif method == 'Network.loadingFinished':
+            entry = self._requests.pop(params['requestId'], None)
+            if entry:
+                entry['end'] = params['timestamp']
+                entry['encoded_length'] = params.get('encodedDataLength', 0)
+        elif method == 'Network.loadingFailed':
+            entry = self._requests.pop(params['requestId'], None)
+            if entry:
+                entry['end'] = params['timestamp']
+                entry['failed'] = params.get('errorText', 'failed')
+        elif method == 'Page.domContentEventFired' and self._page_timestamp:
+            self._on_content_load = (params['timestamp'] - self._page_timestamp) * 1000
+        elif method == 'Page.loadEventFired' and self._page_timestamp:
+            self._on_load = (params['timestamp'] - self._page_timestamp) * 1000
+
+    def _request_will_be_sent(self, params):
+        request_id = params['requestId']
+        if 'redirectResponse' in params and request_id in self._requests:
+            # a redirect reuses the requestId; close the previous hop
+            entry = self._requests.pop(request_id)
+            entry['response'] = params['redirectResponse']
+            entry['end'] = params['timestamp']
+
+        if self._page_timestamp is None:
+            self._page_timestamp = params['timestamp']
+            self._page_wall_time = params.get('wallTime', time())
+
+        entry = {'request': params['request'],
+                 'timestamp': params['timestamp'],
+                 'wall_time': self._page_wall_time +\
+                    (params['timestamp'] - self._page_timestamp),
+                 'response': None, 'end': None, 'data_length': 0,
+                 'encoded_length': 0, 'failed': None}
+        self._requests[request_id] = entry
+        self._entries.append(entry)
+
+    def _har_entry(self, entry):
+        request = entry['request']
+        response = entry['response'] or {}
+        timing = response.get('timing')
+
+        def span(start, end):
+            if not timing or timing.get(start, -1) < 0:
+                return -1
+            return timing[end] - timing[start]
+
+        timings = {'blocked': -1, 'dns': span('dnsStart', 'dnsEnd'),
+                   'connect': span('connectStart', 'connectEnd'),
+                   'ssl': span('sslStart', 'sslEnd'),
+                   'send': 0, 'wait': 0, 'receive': 0}
+        if timing:
+            blocked = [timing[k] for k in ('dnsStart', 'connectStart', 'sendStart')\
+                if timing.get(k, -1) >= 0]
+            timings['blocked'] = blocked[0] if blocked else -1
+            timings['send'] = timing['sendEnd'] - timing['sendStart']
+            timings['wait'] = timing['receiveHeadersEnd'] - timing['sendEnd']
+            if entry['end']:
+                headers_end = timing['requestTime'] + timing['receiveHeadersEnd'] / 1000.0
+                timings['receive'] = max(0, (entry['end'] - headers_end) * 1000)
+        elif entry['end']:
+            timings['wait'] = (entry['end'] - entry['timestamp']) * 1000
+        total = sum(t for k, t in timings.items() if k != 'ssl' and t > 0)
+
+        headers_size = response.get('encodedDataLength', -1)
+        body_size = max(0, entry['encoded_length'] - max(0, headers_size))
+        content_size = entry['data_length'] or body_size
+
+        return {'pageref': 'page_1',
+                'startedDateTime': _har_datetime(entry['wall_time']),
+                'time': total,
+                'request': {'method': request.get('method', 'GET'),
+                            'url': request['url'],
+                            'httpVersion': response.get('protocol', ''),
+                            'headers': _har_headers(request.get('headers', {})),
+                            'queryString': [], 'cookies': [],
+                            'headersSize': -1,
+                            'bodySize': len(request.get('postData', ''))},
+                'response': {'status': response.get('status', 0),
+                             'statusText': response.get('statusText', ''),
+                             'httpVersion': response.get('protocol', ''),
+                             'headers': _har_headers(response.get('headers', {})),
+                             'cookies': [], 'redirectURL': '',
+                             'headersSize': headers_size,
+                             'bodySize': body_size,
+                             'content': {'size': content_size,
+                                         'compression': content_size - body_size,
+                                         'mimeType': response.get('mimeType', '')},
+                             '_error': entry['failed']},
+                'cache': {},
+                'timings': timings,
+                'serverIPAddress': response.get('remoteIPAddress', ''),
+                'connection': str(response.get('connectionId', ''))}
+
+    def har(self):
+        '''Return the HAR (as a dict) for everything recorded so far.'''
+        started = self._page_wall_time if self._page_wall_time else time()
+        return {'log': {
+            'version': '1.2',
+            'creator': {'name': 'webloader', 'version': '0.1'},
+            'pages': [{'id': 'page_1', 'title': self._url,
+                       'startedDateTime': _har_datetime(started),
+                       'pageTimings': {'onContentLoad': self._on_content_load,
+                                       'onLoad': self._on_load}}],
+            'entries': [self._har_entry(e) for e in self._entries]}}
@@ -0,0 +1,103 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import zipfile
+import subprocess
+
+
+################################################################################
+#                                                                              #
+#   CACHED FIREFOX PROFILES                                                    #
+#                                                                              #
+################################################################################
+
+# bump when the layout of built profiles changes, to invalidate old ones
+PROFILE_FORMAT_VERSION = 1
+PROFILE_CACHE_DIR = os.path.join(tempfile.gettempdir(),\
+    'webloader-firefox-profiles-%d' % os.getuid())
+
+EXTENSION_ID_RE = re.compile(r'em:id(?:>|=")([^<"]+)')
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _user_js(prefs):
+    return ''.join('user_pref(%s, %s);\n' % (json.dumps(name), json.dumps(value))\
+        for name, value in sorted(prefs.items()))
+
+def profile_key(prefs, extensions):
+    '''Hash identifying a profile built from `prefs` and `extensions`.'''
+    digest = hashlib.sha1()
+    digest.update(('%d\n' % PROFILE_FORMAT_VERSION).encode('utf-8'))
+    digest.update(_user_js(prefs).encode('utf-8'))
+    for path in extensions:
+        digest.update(_file_digest(path).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+def _extension_id(xpi):
+    with zipfile.ZipFile(xpi) as z:
+        match = EXTENSION_ID_RE.search(z.read('install.rdf').decode('utf-8'))
+    if not match:
+        raise ValueError('No extension id in %s' % xpi)
+    return match.group(1)
+
+def build_profile(prefs, extensions, cache_dir=PROFILE_CACHE_DIR):
+    '''Return the path of a profile directory with `prefs` in its user.js and
+    `extensions` (.xpi paths) unpacked, building it only if no profile with
+    the same prefs and extensions was built before.
+
+    The returned directory is shared; never launch a browser on it directly,
+    use :func:`clone_profile`.'''
+    path = os.path.join(cache_dir, profile_key(prefs, extensions))
+    if os.path.isdir(path):
+        return path
+
+    logging.debug('Building Firefox profile %s', path)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # build next to the final location, then rename: concurrent workers
+    # building the same profile can't see a half-built one
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.build-')
+    try:
+        for xpi in extensions:
+            with zipfile.ZipFile(xpi) as z:
+                z.extractall(os.path.join(tmp, 'extensions', _extension_id(xpi)))
+        with open(os.path.join(tmp, 'user.js'), 'w') as f:
+            f.write(_user_js(prefs))
+        os.rename(tmp, path)
+    except OSError:
+        # somebody else finished first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+def clone_profile(src, dest, extra_prefs=None):
+    '''Copy a built profile to `dest` (replacing it), sharing data blocks
+    with `src` where the filesystem supports reflinks, and append
+    `extra_prefs` (e.g., per-worker directories) to the clone's user.js.'''
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    try:
+        subprocess.check_call(['cp', '-a', '--reflink=auto', src, dest])
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.debug('cp --reflink failed (%s), copying', e)
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        shutil.copytree(src, dest)
+    if extra_prefs:
+        with open(os.path.join(dest, 'user.js'), 'a') as f:
+            f.write(_user_js(extra_prefs))
+    return dest
@@ -3,23 +3,47 @@ import subprocess
 import logging
 import tempfile
 import platform
+import ffprofile
 from time import sleep
 from loader import Loader, LoadResult, Timeout, TimeoutError
+from timeouts import remaining
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.support.ui import WebDriverWait # available since 2.4.0
-import glob
+from fswatch import DirectoryWatcher
+import procutils
 
 FIREFOX = '/usr/bin/env firefox' if platform.system() != 'Darwin' else\
     '/Applications/Firefox.app/Contents/MacOS/firefox'
 XVFB = '/usr/bin/env Xvfb'
-DISPLAY = ':%s'%os.geteuid()
+#DISPLAY = ':%s'%os.geteuid()
 
 
 fireBugPath = os.path.join(os.path.dirname(__file__), './plugins/firebug-2.0.11.xpi')
 netExportPath = os.path.join(os.path.dirname(__file__), './plugins/netExport-0.9b7.xpi')
 fireStarterPath = os.path.join(os.path.dirname(__file__), './plugins/fireStarter-0.1a6.xpi')
 
+# how long NetExport may take to write the HAR after onload
+HAR_EXPORT_TIMEOUT = 30
+
+# runs with chrome privileges (marionette's chrome context)
+CLEAR_STATE_JAVASCRIPT = '''
+var Cc = Components.classes, Ci = Components.interfaces;
+Components.utils.import("resource://gre/modules/Services.jsm");
+Cc["@mozilla.org/netwerk/cache-storage-service;1"]
+    .getService(Ci.nsICacheStorageService).clear();
+try {
+    Cc["@mozilla.org/image/tools;1"].getService(Ci.imgITools)
+        .getImgCacheForDocument(null).clearCache(false);
+} catch (e) {}
+Services.cookies.removeAll();
+// DOM storage, service workers, etc. listen to this one
+Services.obs.notifyObservers(null, "browser:purge-session-history", "");
+try { Services.qms.clear(); } catch (e) {}
+// close idle and active connections
+Services.obs.notifyObservers(null, "net:prune-all-connections", null);
+'''
+
 TIMINGS_JAVASCRIPT = '''
 var performance = window.performance || {};
 var timings = performance.timing || {};
@@ -52,14 +76,83 @@ class FirefoxLoader(Loader):
         #   raise NotImplementedError('FirefoxLoader does not support saving screenshots')
 
         self._selenium = selenium
+        if self._isolate_network and selenium:
+            # selenium launches firefox itself, we can't move it into the namespace
+            logging.warning('isolate_network is not supported with selenium, ignoring it')
+            self._isolate_network = False
         self._xvfb_proc = None
         self._firefox_proc = None
-        self._profile_name = 'webloader'
+        self.DISPLAY = None
         self._profile_path = os.path.join(tempfile.gettempdir(),\
             'webloader_profile')
         self._selenium_driver = None
+        # whether the browser can be reset in place; None: not checked yet
+        self._can_reset = None
+        # NetExport writes into a directory of our own, watched for new HARs
+        self._har_watcher = None
+
+    def _marionette(self):
+        '''Whether the driver talks marionette (geckodriver, Firefox 47+),
+        which has the chrome context a reset needs. The legacy driver of the
+        Firefox versions Firebug/NetExport run on has not.'''
+        capabilities = getattr(self._selenium_driver, 'capabilities', None) or {}
+        return hasattr(self._selenium_driver, 'context') and\
+            (capabilities.get('marionette') or any(key.startswith('moz:') for key in capabilities))
+
+    def _reset(self):
+        '''Clear caches, cookies, storage and connections in the running
+        browser (needs marionette's chrome context).'''
+        if not self._selenium_driver:
+            return True  # the next load launches a fresh browser anyway
+        if self._can_reset is None:
+            # the same for every launch of this loader; check once
+            self._can_reset = self._marionette()
+            if not self._can_reset:
+                logging.info('Firefox cannot be reset in place (no marionette), '\
+                    'relaunching it for fresh views')
+        if not self._can_reset:
+            return False
+        try:
+            with self._selenium_driver.context(self._selenium_driver.CONTEXT_CHROME):
+                self._selenium_driver.execute_script(CLEAR_STATE_JAVASCRIPT)
+            self._selenium_driver.get('about:blank')
+        except Exception as e:
+            logging.debug('Could not reset Firefox in place: %s', e)
+            return False
+        logging.debug('Firefox state reset')
+        return True
+
+    def _browser_pids(self):
+        if self._firefox_proc:
+            return [self._firefox_proc.pid]
+        binary = getattr(self._selenium_driver, 'binary', None)
+        if binary and getattr(binary, 'process', None):
+            return [binary.process.pid]
+        return []
+
+    def _check_health(self):
+        '''Xvfb is alive and the browser (if any) answers.'''
+        if self._xvfb_proc and self._xvfb_proc.poll() is not None:
+            return False
+        if self._selenium_driver:
+            try:
+                self._selenium_driver.current_url
+            except Exception as e:
+                logging.debug('Firefox not responding: %s', e)
+                return False
+        return True
+
+    def _fresh_browser(self):
+        '''Make sure there is a browser with empty caches. Clearing them in
+        place is much cheaper than relaunching, which is only the fallback.'''
+        if self._selenium_driver and self._reset():
+            return True
+        if self._selenium_driver:
+            self._selenium_driver.quit()
+            self._selenium_driver = None
+        return self._setup_selenium()
 
-    def _load_page_selenium(self, test, _, trial_num):
+    def _load_page_selenium(self, test, _, trial_num, deadline=None):
         # load the specified URL (with selenium)
         url = test['url']
         logging.info('Fetching page %s', url)
@@ -72,22 +165,17 @@ class FirefoxLoader(Loader):
         try:
             # load page
             if test['fresh_view']:
-                # Start a new browser as there is no way to clear cache
-                if self._selenium_driver:
-                    self._selenium_driver.quit()
-                self._setup_selenium()
+                self._fresh_browser()
             elif not self._selenium_driver:
                 # or this is the first run, start a new browser
                 self._setup_selenium()
-            harfiles = glob.glob('./*.har')
-            if harfiles:
-                last_har = os.path.basename(max(harfiles, key=os.path.getctime))
-            else:
-                last_har = None
+            # forget HARs of earlier loads that were never picked up
+            self._har_watcher.drain()
 
-            with Timeout(seconds=self._timeout+5):
+            with Timeout(seconds=self._timeout+5, deadline=deadline) as timeout:
+                self._guard_selenium(timeout)
                 self._selenium_driver.get(url)
-                WebDriverWait(self._selenium_driver, 30000).until(\
+                WebDriverWait(self._selenium_driver, timeout.remaining()).until(\
                     lambda d: d.execute_script('return document.readyState') == 'complete')
                 logging.debug('Page loaded.')
 
@@ -96,30 +184,22 @@ class FirefoxLoader(Loader):
             timings = self._selenium_driver.execute_script(TIMINGS_JAVASCRIPT)
             load_time = (timings['loadEventEnd'] - timings['fetchStart']) / 1000.0
 
-            count = 0
-            while count < 31 - load_time:
-                harfiles = glob.glob('./*.har')
-                if harfiles:
-                    newest = os.path.basename(max(harfiles, key=os.path.getctime))
-                else:
-                    newest = None
-                if newest and newest != last_har:
-                    break
-                sleep(1)
-
-            #find the newest har file and rename it to want we want
-            harfiles = glob.glob('./*.har')
-            logging.debug('Renaming harfiles: %s', str(harfiles))
-            if harfiles:
-                newest = os.path.basename(max(harfiles, key=os.path.getctime))
+            # NetExport writes the HAR once the page settled; rename it to what
+            # we want as soon as it is closed
+            newest = self._har_watcher.wait(remaining(HAR_EXPORT_TIMEOUT, deadline))
+            logging.debug('NetExport wrote: %s', newest)
+            if newest:
+                exported = os.path.join(self._har_watcher.path, newest)
                 if harpath:
-                    p = subprocess.Popen(['mv', newest, harpath])
+                    os.rename(exported, harpath)
                 else:
-                    p = subprocess.Popen(['rm', newest])
-                p.wait()
+                    os.remove(exported)
+            else:
+                logging.warning('No HAR exported for %s', url)
 
             return LoadResult(LoadResult.SUCCESS, url, time=load_time,\
-                final_url=self._selenium_driver.current_url)
+                final_url=self._selenium_driver.current_url,\
+                har=harpath if newest else None)
 
         except TimeoutError:
             logging.exception('* Timeout fetching %s', url)
@@ -131,43 +211,39 @@ class FirefoxLoader(Loader):
             logging.exception('Error loading %s: %s', url, e)
             return LoadResult(LoadResult.FAILURE_UNKNOWN, url)
 
-    def _load_page(self, test, outdir, trial_num=-1):
-        return self._load_page_selenium(test, outdir, trial_num)
+    def _load_page(self, test, outdir, trial_num=-1, deadline=None):
+        return self._load_page_selenium(test, outdir, trial_num, deadline)
 
-    def _preload_objects(self, preloads, fresh):
+    def _guard_selenium(self, timeout):
+        '''Make the selenium calls in `timeout` end by its deadline: the
+        page load timeout ends a slow load, killing the browser a hung one.'''
+        self._selenium_driver.set_page_load_timeout(max(1, timeout.remaining()))
+        timeout.guard(lambda: [procutils.kill_tree(pid, grace=1) for pid in self._browser_pids()])
+
+    def _preload_objects(self, preloads, fresh, deadline=None):
         logging.debug('Preloading objects')
         if fresh:
-            # Start a new browser as there is no way to clear cache
-            if self._selenium_driver:
-                self._selenium_driver.quit()
-            self._setup_selenium()
+            self._fresh_browser()
         elif not self._selenium_driver:
             self._setup_selenium()
 
         for url in preloads:
             logging.debug('preloading %s', url)
             try:
-                harfiles = glob.glob('./*.har')
-                if harfiles:
-                    last_har = os.path.basename(max(harfiles, key=os.path.getctime))
-                else:
-                    last_har = None
+                self._har_watcher.drain()
 
-                with Timeout(seconds=self._timeout+5):
+                with Timeout(seconds=self._timeout+5, deadline=deadline) as timeout:
+                    self._guard_selenium(timeout)
                     self._selenium_driver.get(url)
-                    WebDriverWait(self._selenium_driver, 30000).until(\
+                    WebDriverWait(self._selenium_driver, timeout.remaining()).until(\
                         lambda d: d.execute_script('return document.readyState') == 'complete')
                     logging.debug('object loaded.')
-                    sleep(0.5)
-
-                harfiles = glob.glob('./*.har')
-                if harfiles:
-                    newest = os.path.basename(max(harfiles, key=os.path.getctime))
-                    if newest != last_har:
-                        logging.debug('Removing harfile: %s', str(newest))
-                        p = subprocess.Popen(['rm', newest])
-                        p.wait()
 
+                # don't let the preload's HAR show up during the page load
+                newest = self._har_watcher.wait(remaining(HAR_EXPORT_TIMEOUT, deadline))
+                if newest:
+                    logging.debug('Removing harfile: %s', newest)
+                    os.remove(os.path.join(self._har_watcher.path, newest))
 
             except TimeoutError:
                 logging.exception('* Timeout fetching %s', url)
@@ -187,8 +263,8 @@ class FirefoxLoader(Loader):
             firefox_cmd =  '%s %s' % (FIREFOX, url)
             #firefox_cmd =  '%s -profile %s %s' % (FIREFOX, self._profile_path, url)
             logging.debug('Loading: %s', firefox_cmd)
-            with Timeout(seconds=self._timeout+5):
-                subprocess.check_output(firefox_cmd.split())
+            with Timeout(seconds=self._timeout+5) as timeout:
+                self._call(firefox_cmd.split(), timeout)
 
             # TODO: error checking
             # TODO: try to get timing info, final URL, HAR, etc.
@@ -200,61 +276,100 @@ class FirefoxLoader(Loader):
             logging.exception('* Timeout fetching %s', url)
             return LoadResult(LoadResult.FAILURE_TIMEOUT, url)
         except subprocess.CalledProcessError as e:
-            logging.exception('Error loading %s: %s\n%s', url, e, e.output)
+            logging.exception('Error loading %s: %s', url, e)
             return LoadResult(LoadResult.FAILURE_UNKNOWN, url)
         except Exception as e:
             logging.exception('Error loading %s: %s', url, e)
             return LoadResult(LoadResult.FAILURE_UNKNOWN, url)
 
+    def _selenium_prefs(self):
+        '''Prefs of the selenium profile that are the same for all workers'''
+        prefs = {
+            "app.update.enabled": False,
+            "extensions.firebug.DBG_STARTER": True,
+            # disable firebug start screen
+            "extensions.firebug.currentVersion": "2.0.11",
+            "extensions.firebug.addonBarOpened": True,
+            "extensions.firebug.net.enableSites": True,
+            "extensions.firebug.previousPlacement": 1,
+            "extensions.firebug.allPagesActivation": "on",
+            "extensions.firebug.onByDefault": True,
+            "extensions.firebug.defaultPanelName": "net",
+            "extensions.firebug.netexport.alwaysEnableAutoExport": True,
+            "extensions.firebug.netexport.autoExportToFile": True,
+            "extensions.firebug.netexport.saveFiles": True,
+            "extensions.firebug.netexport.autoExportToServer": False,
+            "extensions.firebug.netexport.Automation": True,
+            "extensions.firebug.netexport.showPreview": False,
+            "extensions.firebug.netexport.includeResponseBodies": False,
+            "extensions.firebug.netexport.exportFromBFCache": True,
+            "extensions.firebug.net.defaultPersist": False,
+            "extensions.firebug.netexport.pageLoadedTimeout": 300,
+            "extensions.firebug.netexport.timeout": 30000,
+        }
+        """
+        if self._disable_local_cache:
+            prefs["browser.cache.disk.enable"] = False
+            prefs["browser.cache.memory.enable"] = False
+        if self._http2:
+            # As of v34, this is enabled by default anyway
+            prefs["network.http.spdy.enabled.http2draft"] = True
+            # Attempt to always negotiate http/2.0
+            prefs["network.http.proxy.version"] = "2.0"
+            prefs["network.http.version"] = "2.0"
+            # Disable validation when using our testing server (since we don't own a valid cert)
+            # prefs["network.http.spdy.enforce-tls-profile"] = False
+        """
+        if self._user_agent:
+            prefs["general.useragent.override"] = self._user_agent
+        prefs.update(self._proxy_prefs())
+        return prefs
+
+    def _proxy_prefs(self):
+        prefs = {}
+        if self._proxy:
+            host, _, port = self._proxy_address().rpartition(':')
+            prefs["network.proxy.type"] = 1
+            for scheme in ("http", "ssl"):
+                prefs["network.proxy.%s" % scheme] = host
+                prefs["network.proxy.%s_port" % scheme] = int(port)
+            prefs["network.proxy.no_proxies_on"] = ""
+            prefs["network.proxy.allow_hijacking_localhost"] = True
+        return prefs
+
+    def _native_prefs(self):
+        prefs = {}
+        if self._disable_local_cache:
+            prefs["browser.cache.disk.enable"] = False
+            prefs["browser.cache.memory.enable"] = False
+        if self._http2:
+            # As of v34, this is enabled by default anyway
+            prefs["network.http.spdy.enabled.http2draft"] = True
+        if self._user_agent:
+            prefs["general.useragent.override"] = self._user_agent
+        prefs.update(self._proxy_prefs())
+        return prefs
+
     def _setup_selenium(self):
         # prepare firefox selenium driver
         try:
-            #profile = webdriver.FirefoxProfile()
-            profile = webdriver.firefox.firefox_profile.FirefoxProfile()
-            profile.add_extension(fireBugPath)
-            profile.add_extension(netExportPath)
-            profile.add_extension(fireStarterPath)
-            profile.set_preference("app.update.enabled", False)
+            # extensions are unpacked into a cached profile only once (per
+            # prefs and extension versions); selenium copies it per launch
+            template = ffprofile.build_profile(self._selenium_prefs(),\
+                [fireBugPath, netExportPath, fireStarterPath])
+            profile = webdriver.firefox.firefox_profile.FirefoxProfile(template)
             profile.native_events_enabled = True
-            profile.set_preference("extensions.firebug.DBG_STARTER", True)
-            # disable firebug start screen
-            profile.set_preference("extensions.firebug.currentVersion", "2.0.11")
-            profile.set_preference("extensions.firebug.addonBarOpened", True)
-            profile.set_preference("extensions.firebug.net.enableSites", True)
-            profile.set_preference("extensions.firebug.previousPlacement", 1)
-            profile.set_preference("extensions.firebug.allPagesActivation", "on")
-            profile.set_preference("extensions.firebug.onByDefault", True)
-            profile.set_preference("extensions.firebug.defaultPanelName", "net")
-            profile.set_preference("extensions.firebug.netexport.alwaysEnableAutoExport", True)
-            profile.set_preference("extensions.firebug.netexport.autoExportToFile", True)
-            profile.set_preference("extensions.firebug.netexport.saveFiles", True)
-            profile.set_preference("extensions.firebug.netexport.autoExportToServer", False)
-            profile.set_preference("extensions.firebug.netexport.Automation", True)
-            profile.set_preference("extensions.firebug.netexport.showPreview", False)
-            profile.set_preference("extensions.firebug.netexport.includeResponseBodies", False)
-            profile.set_preference("extensions.firebug.netexport.exportFromBFCache", True)
-            profile.set_preference("extensions.firebug.net.defaultPersist", False)
-            profile.set_preference("extensions.firebug.netexport.pageLoadedTimeout", 300)
-            profile.set_preference("extensions.firebug.netexport.timeout", 30000)
-            profile.set_preference("extensions.firebug.netexport.defaultLogDir", os.getcwd())
-            profile.update_preferences()
-
-            """
-            if self._disable_local_cache:
-                profile.set_preference("browser.cache.disk.enable", False)
-                profile.set_preference("browser.cache.memory.enable", False)
-            if self._http2:
-                # As of v34, this is enabled by default anyway
-                profile.set_preference("network.http.spdy.enabled.http2draft", True)
-                # Attempt to always negotiate http/2.0
-                profile.set_preference("network.http.proxy.version", "2.0")
-                profile.set_preference("network.http.version", "2.0")
-                # Disable validation when using our testing server (since we don't own a valid cert)
-                # profile.set_preference("network.http.spdy.enforce-tls-profile", False)
-            """
-            if self._user_agent:
-                profile.set_preference("general.useragent.override", '"%s"' % self._user_agent)
+            profile.set_preference("extensions.firebug.netexport.defaultLogDir", self._har_watcher.path)
+            if self._ignore_certificate_errors:
+                # e.g., the self-signed certificate of a record/replay proxy
+                profile.accept_untrusted_certs = True
+                profile.assume_untrusted_cert_issuer = True
             self._selenium_driver = webdriver.Firefox(firefox_profile=profile)
+            # selenium launched firefox, so it is not in a group of ours; at
+            # least leave a pidfile for the sweep in case we get SIGKILLed
+            binary = getattr(self._selenium_driver, 'binary', None)
+            if binary and getattr(binary, 'process', None):
+                procutils.register('%d-selenium-firefox' % self._my_id, binary.process.pid)
             sleep(1)
             # load a page other than about:blank
             self._selenium_driver.get('about:config')
@@ -268,24 +383,9 @@ class FirefoxLoader(Loader):
     def _setup_native(self):
         # make firefox profile and set preferences
         try:
-            # create profile
-            create_cmd = '%s -CreateProfile "%s %s"'\
-                % (FIREFOX, self._profile_name, self._profile_path)
-            logging.debug('Creating Firefox profile: %s', create_cmd)
-            subprocess.check_output(create_cmd, shell=True)
-
-            # write prefs to user.js
-            userjs_path = os.path.join(self._profile_path, 'user.js')
-            logging.debug('Writing user.js: %s', userjs_path)
-            with open(userjs_path, 'w') as f:
-                if self._disable_local_cache:
-                    f.write('user_pref("browser.cache.disk.enable", false);\n')
-                    f.write('user_pref("browser.cache.memory.enable", false);\n')
-                if self._http2:
-                    # As of v34, this is enabled by default anyway
-                    f.write('user_pref("network.http.spdy.enabled.http2draft", true);\n')
-                if self._user_agent:
-                    f.write('user_pref("general.useragent.override", "%s");\n' % self._user_agent)
+            template = ffprofile.build_profile(self._native_prefs(), [])
+            logging.debug('Cloning Firefox profile %s to %s', template, self._profile_path)
+            ffprofile.clone_profile(template, self._profile_path)
         except Exception as _:
             logging.exception("Error creating Firefox profile")
             return False
@@ -294,7 +394,8 @@ class FirefoxLoader(Loader):
         try:
             firefox_command =  '%s -profile %s' % (FIREFOX, self._profile_path)
             logging.debug('Starting Firefox: %s', firefox_command)
-            self._firefox_proc = subprocess.Popen(firefox_command.split())
+            self._firefox_proc = self._spawn('firefox', firefox_command.split(),\
+                in_netns=True)
             sleep(5)
         except Exception as _:
             logging.exception("Error starting Firefox")
@@ -304,25 +405,34 @@ class FirefoxLoader(Loader):
 
 
 
-    def _setup(self, __=0):
+    def _setup(self, my_id=0):
+        # everything below is per worker so several firefoxes can share a host
+        self._profile_path = os.path.join(tempfile.gettempdir(),\
+            'webloader_profile_%d_%d' % (os.geteuid(), my_id))
+
+        # the export dir lives in outdir so finished HARs can be renamed into place
+        try:
+            self._har_watcher = DirectoryWatcher(os.path.abspath(os.path.join(\
+                self._outdir, '.netexport-%d' % my_id)), suffix='.har')
+        except Exception as _:
+            logging.exception("Error watching NetExport directory")
+            return False
 
         if self._headless:
             # start a virtual display
             try:
-                os.environ['DISPLAY'] = DISPLAY
-                xvfb_command = '%s %s -screen 0 1366x768x24 -ac' % (XVFB, DISPLAY)
+                # same numbering as ChromeLoader: unique per user and worker
+                self.DISPLAY = ":%s"%(os.geteuid()*10+my_id)
+                os.environ['DISPLAY'] = self.DISPLAY
+                xvfb_command = '%s %s -screen 0 1366x768x24 -ac' % (XVFB, self.DISPLAY)
                 logging.debug('Starting XVFB: %s', xvfb_command)
-                self._xvfb_proc = subprocess.Popen(xvfb_command.split())
+                self._xvfb_proc = self._spawn('xvfb', xvfb_command.split())
                 sleep(2)
             except Exception as _:
                 logging.exception("Error starting XFVB")
                 return False
             logging.debug('Started XVFB (DISPLAY=%s)', os.environ['DISPLAY'])
 
-        if self._log_ssl_keys:
-            keylog_file = './ssl_keylog'
-            os.environ['SSLKEYLOGFILE'] = keylog_file
-
         return True
 
     def _teardown(self):
@@ -331,14 +441,19 @@ class FirefoxLoader(Loader):
                 self._selenium_driver.quit()
             except Exception as e:
                 logging.error('Failed to kill selenium, %s', e)
+            procutils.unregister('%d-selenium-firefox' % self._my_id)
+            self._selenium_driver = None
         if self._firefox_proc:
             logging.debug('Stopping Firefox')
-            self._firefox_proc.terminate()
-            self._firefox_proc.wait()
+            self._reap('firefox', self._firefox_proc)
+            self._firefox_proc = None
         if self._xvfb_proc:
             logging.debug('Stopping XVFB')
-            self._xvfb_proc.terminate()
-            self._xvfb_proc.wait()
+            self._reap('xvfb', self._xvfb_proc)
+            self._xvfb_proc = None
+        if self._har_watcher:
+            self._har_watcher.close()
+            self._har_watcher = None
 
         ## remove the firefox profile
         #try:
@@ -0,0 +1,143 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+from time import sleep, time
+
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+POLL_INTERVAL = 0.1
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_inotify()
+
+
+class DirectoryWatcher(object):
+    '''Reports files as soon as they have been completely written into a
+    directory.
+
+    Uses inotify (a file counts as complete once it is closed after writing or
+    moved into the directory). Where inotify is not available (e.g., OS X),
+    falls back to polling the directory and waiting for the size of new files
+    to settle.
+
+    :param path: the directory to watch; it is created if missing
+    :param suffix: only report files whose name ends with this
+    '''
+
+    def __init__(self, path, suffix=''):
+        self._path = path
+        self._suffix = suffix
+        self._fd = None
+        self._pending = []
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        if _libc:
+            fd = _libc.inotify_init()
+            if fd >= 0 and _libc.inotify_add_watch(fd, path.encode('utf-8'),\
+                IN_CLOSE_WRITE | IN_MOVED_TO) >= 0:
+                self._fd = fd
+            else:
+                logging.warning('inotify unavailable for %s (%s), polling instead',\
+                    path, os.strerror(ctypes.get_errno()))
+                if fd >= 0:
+                    os.close(fd)
+        self._known = set(os.listdir(path))
+
+    @property
+    def path(self):
+        return self._path
+
+    def _wanted(self, name):
+        return name.endswith(self._suffix) and not name.startswith('.')
+
+    def _read_events(self, timeout):
+        try:
+            ready, _, _ = select.select([self._fd], [], [], max(0, timeout))
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        if not ready:
+            return
+        buf = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(buf):
+            _, _, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode('utf-8')
+            offset += length
+            if self._wanted(name) and name not in self._pending:
+                self._pending.append(name)
+
+    def _poll(self, timeout):
+        # a new file is complete once its size stops changing
+        deadline = time() + timeout
+        sizes = {}
+        while True:
+            current = set(os.listdir(self._path))
+            self._known &= current
+            for name in current - self._known:
+                if not self._wanted(name):
+                    continue
+                try:
+                    size = os.path.getsize(os.path.join(self._path, name))
+                except OSError:
+                    continue
+                if sizes.get(name) == size and size > 0:
+                    self._known.add(name)
+                    self._pending.append(name)
+                sizes[name] = size
+            if self._pending or time() >= deadline:
+                return
+            sleep(POLL_INTERVAL)
+
+    def wait(self, timeout):
+        '''Return the name (not path) of the next completed file, or None if
+        none shows up within `timeout` seconds.'''
+        deadline = time() + timeout
+        while not self._pending:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            if self._fd is not None:
+                self._read_events(remaining)
+            else:
+                self._poll(remaining)
+        return self._pending.pop(0)
+
+    def drain(self):
+        '''Delete completed or half-written files that were never picked up,
+        so they can't be mistaken for the next one. The directory is assumed
+        to be ours alone.'''
+        if self._fd is not None:
+            self._read_events(0)
+        self._pending = []
+        for name in os.listdir(self._path):
+            if self._wanted(name):
+                logging.debug('Removing stale file %s', name)
+                try:
+                    os.remove(os.path.join(self._path, name))
+                except OSError:
+                    pass
+        self._known = set(os.listdir(self._path))
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -1,14 +1,13 @@
 #! /usr/bin/env python
 
 import sys
-import json
-import re
 import logging
 import argparse
 import time
 import datetime
 import pprint
 import numpy
+import artifacts
 from urlparse import urlparse
 from collections import defaultdict
 
@@ -294,14 +293,12 @@ class Har(object):
 
     @classmethod
     def from_file(cls, path):
-        with open(path, 'r') as f:
-            data = json.load(f)
-        f.closed
-        return Har(data)
+        # compressed or not
+        return Har(artifacts.load_har(path))
 
     @classmethod
     def sanitize_url(cls, url):
-        return re.sub(r'[/\;,><&*:%=+@!#^()|?^]', '-', url)
+        return artifacts.sanitize_url(url)
 
     def get_by_name(self, name):
         try:
@@ -455,9 +452,7 @@ class Har(object):
 
 
 def main():
-    with open(args.har, 'r') as f:
-        data = json.load(f)
-    f.closed
+    data = artifacts.load_har(args.har)
     
     h = Har(data)
 
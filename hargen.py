@@ -0,0 +1,268 @@
+#! /usr/bin/env python
+
+import sys
+import json
+import random
+import itertools
+import logging
+import argparse
+import datetime
+
+HAR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+HTTP_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+
+
+################################################################################
+#                                                                              #
+#   DISTRIBUTIONS                                                              #
+#                                                                              #
+################################################################################
+
+# (weight, MIME type, median size in bytes, compressible); roughly the mix of
+# requests and their sizes on a typical page
+MIME_TYPES = (
+    (30, 'image/jpeg', 12000, False),
+    (20, 'image/png', 4000, False),
+    (8, 'image/gif', 400, False),
+    (3, 'image/webp', 9000, False),
+    (20, 'application/javascript', 15000, True),
+    (7, 'text/css', 8000, True),
+    (4, 'text/html', 20000, True),
+    (3, 'application/json', 1500, True),
+    (2, 'font/woff2', 25000, False),
+    (1, 'application/octet-stream', 30000, False),
+    (1, 'video/mp4', 500000, False),
+    (1, 'application/x-unknown-type', 2000, False),
+)
+
+# (weight, Cache-Control value or None for no header)
+CACHE_CONTROLS = (
+    (25, 'max-age=31536000'), (15, 'public, max-age=86400'), (10, 'no-cache'),
+    (5, 'no-store'), (5, 'private, max-age=0'), (5, 'max-age=0, must-revalidate'),
+    (3, 's-maxage=600'), (2, 'public'), (2, 'max-age=abc'), (2, 'max-age=-1'),
+    (1, 'max-age=600, max-age=60'), (25, None),
+)
+
+# (weight, Expires value: an offset from Date in seconds, or a literal)
+EXPIRES = ((70, None), (15, 3600), (5, -3600), (4, '0'), (3, '-1'),\
+    (2, 'Thu, 01 Jan 1970 00:00:00 GMT'), (1, 'not a date'))
+
+def _weighted(rand, choices):
+    total = sum(choice[0] for choice in choices)
+    pick = rand.random() * total
+    for choice in choices:
+        pick -= choice[0]
+        if pick < 0:
+            return choice
+    return choices[-1]
+
+
+################################################################################
+#                                                                              #
+#   GENERATOR                                                                  #
+#                                                                              #
+################################################################################
+
+class HarGenerator(object):
+    '''Generates HARs of synthetic pages with controlled properties.
+
+    Objects are spread over a few hosts; only the first request to a host
+    pays for DNS, TCP and (for https) TLS. Sizes are lognormal around a
+    median per MIME type; headers, Cache-Control and Expires values follow
+    the weights above, odd values included.
+
+    :param seed: random seed; the same seed and knobs give the same HAR
+    :param hosts: number of hosts the objects come from
+    :param https: fraction of hosts served over https
+    :param size_scale: multiplies every object size
+    :param huge_objects: fraction of objects that are huge (100MB to 4GB)
+    :param missing_timings: fraction of entries without a `timings` object
+    :param duplicate_headers: fraction of responses with a header repeated
+    :param body_bytes: include up to this many bytes of each body as
+        `content.text` (0: none), to make HARs as large as real ones with
+        bodies
+    '''
+
+    def __init__(self, seed=0, hosts=10, https=0.7, size_scale=1.0, huge_objects=0.0,\
+        missing_timings=0.0, duplicate_headers=0.05, body_bytes=0):
+        self._rand = random.Random(seed)
+        self._hosts = ['%s://%s.example%d.com' % ('https' if i < round(hosts * https) else 'http',\
+            'www' if i == 0 else 'static%d' % i, i) for i in range(max(1, hosts))]
+        self._size_scale = size_scale
+        self._huge_objects = huge_objects
+        self._missing_timings = missing_timings
+        self._duplicate_headers = duplicate_headers
+        self._body_bytes = body_bytes
+        self._start = datetime.datetime(2017, 1, 1) +\
+            datetime.timedelta(seconds=self._rand.randint(0, 365 * 86400))
+        self._page_timings = {'onContentLoad': round(self._rand.uniform(300, 2000), 3),
+                              'onLoad': round(self._rand.uniform(2000, 8000), 3)}
+
+    @property
+    def page_url(self):
+        return self._hosts[0] + '/'
+
+    def _size(self, median):
+        rand = self._rand
+        if self._huge_objects and rand.random() < self._huge_objects:
+            return rand.randint(100 << 20, 4 << 30)
+        return max(0, int(rand.lognormvariate(0, 1.2) * median * self._size_scale))
+
+    def _headers(self, mime_type, date, size, body_size):
+        rand = self._rand
+        headers = [('Date', date.strftime(HTTP_DATE_FORMAT)),\
+            ('Content-Type', mime_type), ('Content-Length', str(body_size)),\
+            ('Server', rand.choice(('nginx', 'Apache', 'cloudflare', 'ECS (dca/24A0)')))]
+        if body_size != size:
+            headers.append(('Content-Encoding', 'gzip'))
+        cache_control = _weighted(rand, CACHE_CONTROLS)[1]
+        if cache_control is not None:
+            headers.append(('Cache-Control', cache_control))
+        expires = _weighted(rand, EXPIRES)[1]
+        if isinstance(expires, int):
+            headers.append(('Expires', (date + datetime.timedelta(seconds=expires))\
+                .strftime(HTTP_DATE_FORMAT)))
+        elif expires is not None:
+            headers.append(('Expires', expires))
+        if rand.random() < self._duplicate_headers:
+            name, value = rand.choice(headers[1:])
+            headers.append((name, value if rand.random() < 0.5 else value + ', dup'))
+        return [{'name': header_name, 'value': header_value}\
+            for header_name, header_value in headers]
+
+    def iter_entries(self, entries=None):
+        '''Yield `entries` HAR entries (None: without end), in start time
+        order.'''
+        rand = self._rand
+        connected = set()
+        started = self._start
+        for i in itertools.count():
+            if entries is not None and i >= entries:
+                return
+            _, mime_type, median, compressible = _weighted(rand, MIME_TYPES)
+            host = self._hosts[0] if i == 0 else rand.choice(self._hosts)
+            url = '%s/%s/%d%s' % (host, mime_type.split('/')[0], i,\
+                rand.choice(('', '', '?v=%d' % rand.randint(1, 99))))
+            size = median * 2 if i == 0 else self._size(median)
+            compression = int(size * rand.uniform(0.5, 0.8)) if compressible else 0
+            body_size = size - compression
+
+            # the first request to a host sets up the connection
+            dns = connect = ssl = -1
+            if host not in connected:
+                connected.add(host)
+                dns = round(rand.lognormvariate(3, 0.5), 3)
+                connect = round(rand.lognormvariate(3.5, 0.5), 3)
+                if host.startswith('https'):
+                    ssl = round(rand.lognormvariate(3.5, 0.5), 3)
+            wait = round(rand.lognormvariate(4, 0.8), 3)
+            receive = round(body_size / 1000.0 / rand.uniform(1, 10), 3)
+            blocked = round(rand.expovariate(0.2), 3)
+            total = sum(t for t in (blocked, dns, connect, wait, receive) if t > 0)
+
+            entry = {
+                'pageref': 'page_1',
+                'startedDateTime': started.strftime(HAR_TIME_FORMAT),
+                'time': round(total, 3),
+                'request': {'method': 'GET', 'url': url, 'httpVersion': 'HTTP/1.1',
+                            'headers': [{'name': 'Host', 'value': host.split('://')[1]},\
+                                        {'name': 'User-Agent', 'value': 'Mozilla/5.0'}],
+                            'queryString': [], 'cookies': [],
+                            'headersSize': rand.randint(300, 900), 'bodySize': 0},
+                'response': {'status': 200, 'statusText': 'OK', 'httpVersion': 'HTTP/1.1',
+                             'headers': self._headers(mime_type, started, size, body_size),
+                             'cookies': [], 'redirectURL': '',
+                             'content': {'size': size, 'compression': compression,
+                                         'mimeType': mime_type},
+                             'headersSize': rand.randint(200, 600), 'bodySize': body_size},
+                'cache': {},
+                'timings': {'blocked': blocked, 'dns': dns, 'connect': connect, 'ssl': ssl,
+                            'send': 0, 'wait': wait, 'receive': receive}}
+            if self._body_bytes:
+                entry['response']['content']['text'] = 'x' * min(size, self._body_bytes)
+            if i and self._missing_timings and rand.random() < self._missing_timings:
+                del entry['timings']
+            yield entry
+            # requests overlap: the next one starts during this one
+            started += datetime.timedelta(milliseconds=rand.uniform(0, total))
+
+    def _log(self, entries_json):
+        page = {'id': 'page_1', 'title': self.page_url,
+                'startedDateTime': self._start.strftime(HAR_TIME_FORMAT),
+                'pageTimings': self._page_timings}
+        return {'log': {'version': '1.2', 'creator': {'name': 'hargen', 'version': '1.0'},
+                        'pages': [page], 'entries': entries_json}}
+
+    def generate(self, entries):
+        '''A HAR (as parsed JSON) with `entries` entries.'''
+        return self._log(list(self.iter_entries(entries)))
+
+    def write(self, f, entries=None, max_bytes=None):
+        '''Stream a HAR to file object `f`, one entry at a time, so its size
+        is not limited by memory. Stops after `entries` entries or once
+        about `max_bytes` are written, whichever comes first. Returns the
+        number of entries written.'''
+        # write the log around a placeholder for the entries
+        head, tail = json.dumps(self._log('ENTRIES')).split('"ENTRIES"')
+        f.write(head + '[')
+        written = len(head) + 1
+        count = 0
+        for entry in self.iter_entries(entries):
+            data = json.dumps(entry)
+            if count:
+                f.write(', ')
+                written += 2
+            f.write(data)
+            written += len(data)
+            count += 1
+            if max_bytes and written >= max_bytes:
+                break
+        f.write(']' + tail)
+        return count
+
+def generate(entries, seed=0, **knobs):
+    '''A HAR (as parsed JSON) with `entries` entries, see :class:`HarGenerator`.'''
+    return HarGenerator(seed, **knobs).generate(entries)
+
+
+
+def main():
+    generator = HarGenerator(args.seed, hosts=args.hosts, https=args.https,\
+        size_scale=args.size_scale, huge_objects=args.huge_objects,\
+        missing_timings=args.missing_timings, duplicate_headers=args.duplicate_headers,\
+        body_bytes=args.body_bytes)
+    max_bytes = int(args.max_mb * (1 << 20)) if args.max_mb else None
+    entries = args.entries
+    if entries is None and not max_bytes:
+        entries = 100
+    if args.output == '-':
+        count = generator.write(sys.stdout, entries, max_bytes)
+    else:
+        with open(args.output, 'w') as f:
+            count = generator.write(f, entries, max_bytes)
+    logging.info('Wrote %d entries to %s', count, args.output)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Write a synthetic HAR.')
+    parser.add_argument('output', help='HAR file to write (- for stdout)')
+    parser.add_argument('-n', '--entries', type=int, help='number of entries (default: 100, or no limit with --max_mb)')
+    parser.add_argument('-m', '--max_mb', type=float, help='stop once the HAR is this large')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--hosts', type=int, default=10, help='number of hosts')
+    parser.add_argument('--https', type=float, default=0.7, help='fraction of https hosts')
+    parser.add_argument('--size_scale', type=float, default=1.0, help='multiply object sizes by this')
+    parser.add_argument('--huge_objects', type=float, default=0.0, help='fraction of huge (100MB-4GB) objects')
+    parser.add_argument('--missing_timings', type=float, default=0.0, help='fraction of entries without timings')
+    parser.add_argument('--duplicate_headers', type=float, default=0.05, help='fraction of responses with a duplicate header')
+    parser.add_argument('--body_bytes', type=int, default=0, help='include up to this many bytes of each body')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
@@ -0,0 +1,84 @@
+import numpy
+from procutils import tree_usage
+
+
+class BrowserHealthMonitor(object):
+    '''Watches a worker's browser between jobs and decides when it is time to
+    recycle it (tear it down and start a fresh one).
+
+    Any threshold left as None (or 0) is not checked.
+
+    :param max_loads: recycle after this many loads
+    :param max_rss_mb: recycle if the browser's process tree uses more memory
+    :param max_fds: recycle if the process tree holds more open files
+    :param max_children: recycle if the browser has more child processes
+    :param max_time_drift: recycle if the median load time of the last
+        `window` loads grew by more than this fraction (e.g., 0.2 = 20%) over
+        the median of the first `window` loads after the browser started
+    :param window: number of loads in the drift medians
+    '''
+
+    def __init__(self, max_loads=None, max_rss_mb=None, max_fds=None,\
+        max_children=None, max_time_drift=None, window=10):
+        self._max_loads = max_loads
+        self._max_rss_mb = max_rss_mb
+        self._max_fds = max_fds
+        self._max_children = max_children
+        self._max_time_drift = max_time_drift
+        self._window = window
+        self.start()
+
+    def start(self):
+        '''Forget everything; call whenever the browser is (re)started.'''
+        self._num_loads = 0
+        self._times = []
+        self._last_usage = {}
+
+    def record_load(self, result):
+        '''Account for one finished load (a :class:`LoadResult`).'''
+        self._num_loads += 1
+        if result.time:
+            self._times.append(result.time)
+            # keep the baseline window plus the rolling window
+            if len(self._times) > 2 * self._window:
+                del self._times[self._window]
+
+    @property
+    def num_loads(self):
+        '''Loads since the browser was (re)started.'''
+        return self._num_loads
+
+    @property
+    def last_usage(self):
+        '''Resource usage found by the last :meth:`recycle_reason` call.'''
+        return self._last_usage
+
+    def _time_drift(self):
+        if len(self._times) < 2 * self._window:
+            return 0
+        baseline = numpy.median(self._times[:self._window])
+        recent = numpy.median(self._times[-self._window:])
+        return recent / baseline - 1 if baseline else 0
+
+    def recycle_reason(self, pids):
+        '''Returns why the browser whose top-level processes are `pids` should
+        be recycled, or None if it is fine.'''
+        if self._max_loads and self._num_loads >= self._max_loads:
+            return 'max_loads: %d loads' % self._num_loads
+
+        usage = tree_usage(pids) if pids else {}
+        self._last_usage = usage
+        if usage:
+            if self._max_rss_mb and usage['rss_mb'] > self._max_rss_mb:
+                return 'max_rss_mb: %.1f MB' % usage['rss_mb']
+            if self._max_fds and usage['fds'] > self._max_fds:
+                return 'max_fds: %d open files' % usage['fds']
+            if self._max_children and usage['children'] > self._max_children:
+                return 'max_children: %d child processes' % usage['children']
+
+        if self._max_time_drift:
+            drift = self._time_drift()
+            if drift > self._max_time_drift:
+                return 'max_time_drift: median load time up %.0f%%' % (drift * 100)
+
+        return None
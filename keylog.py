@@ -0,0 +1,152 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+
+################################################################################
+#                                                                              #
+#   PER-TRIAL SSL KEYLOG INDEX                                                 #
+#                                                                              #
+################################################################################
+
+def parse_keylog(data):
+    '''Map client random (hex) to the list of NSS keylog lines for it, for
+    a chunk of a keylog file (TLS 1.2 CLIENT_RANDOM lines and the TLS 1.3
+    *_SECRET lines alike: the client random is always the second field).'''
+    keys = {}
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) != 3 or line.startswith('#'):
+            continue
+        keys.setdefault(fields[1].lower(), []).append(line)
+    return keys
+
+
+class KeylogIndex(object):
+    '''Cuts the keylog a browser appends to (via SSLKEYLOGFILE) into trials
+    without copying it: for each trial, one JSON line in the index records
+    the byte range of the keylog written during the trial, the client
+    randoms in it and the trial's pcap. Tools can then seek straight to one
+    trial's keys (see :func:`trial_keys`).
+
+    :param keylog_path: the keylog file the browser writes
+    :param index_path: where to append the index lines; default is the
+        keylog path plus '.index'
+    '''
+
+    def __init__(self, keylog_path, index_path=None):
+        self._keylog_path = keylog_path
+        self._index_path = index_path or keylog_path + '.index'
+        self._start = None
+        self._partial_line = None  # offset of a line cut off by the last trial
+
+    @property
+    def keylog_path(self):
+        return self._keylog_path
+
+    @property
+    def index_path(self):
+        return self._index_path
+
+    def _size(self):
+        try:
+            return os.path.getsize(self._keylog_path)
+        except OSError:
+            return 0
+
+    def begin_trial(self):
+        self._start = self._size()
+        if self._partial_line is not None:
+            self._start = min(self._start, self._partial_line)
+            self._partial_line = None
+
+    def end_trial(self, url, trial, pcap=None):
+        '''Index the keys written since :meth:`begin_trial`.'''
+        if self._start is None:
+            return None
+        start, self._start = self._start, None
+        data = ''
+        if self._size() > start:
+            with open(self._keylog_path, 'r') as f:
+                f.seek(start)
+                data = f.read()
+        # a line still being written belongs to the next trial
+        end = start + len(data)
+        if data and not data.endswith('\n'):
+            data = data[:data.rfind('\n') + 1]
+            end = self._partial_line = start + len(data)
+
+        entry = {'url': url, 'trial': trial, 'pcap': pcap,
+                 'keylog': os.path.basename(self._keylog_path),
+                 'start': start, 'end': end,
+                 'client_randoms': sorted(parse_keylog(data))}
+        with open(self._index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        logging.debug('Indexed %d TLS sessions for trial %d of %s',\
+            len(entry['client_randoms']), trial, url)
+        return entry
+
+
+def read_index(index_path):
+    '''Yield the entries of a keylog index.'''
+    with open(index_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def trial_keys(index_path, entry):
+    '''The keylog lines of one index entry, read by seeking to its range.'''
+    keylog = os.path.join(os.path.dirname(index_path), entry['keylog'])
+    with open(keylog, 'r') as f:
+        f.seek(entry['start'])
+        return f.read(entry['end'] - entry['start'])
+
+
+
+def main():
+    # write the keys of the trials matching the filters to stdout or a file,
+    # e.g. for Wireshark's (Pre)-Master-Secret log filename
+    matched = 0
+    out = open(args.output, 'w') if args.output else None
+    try:
+        for entry in read_index(args.index):
+            if args.pcap and os.path.basename(entry['pcap'] or '') !=\
+                os.path.basename(args.pcap):
+                continue
+            if args.url and entry['url'] != args.url:
+                continue
+            if args.trial is not None and entry['trial'] != args.trial:
+                continue
+            matched += 1
+            keys = trial_keys(args.index, entry)
+            if out:
+                out.write(keys)
+            else:
+                sys.stdout.write(keys)
+    finally:
+        if out:
+            out.close()
+    logging.info('%d trials matched', matched)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Extract the SSL keys of single trials from a keylog index.')
+    parser.add_argument('index', help='keylog index (ssl_keylog_<worker>.index)')
+    parser.add_argument('-p', '--pcap', help='only the trial captured in this pcap')
+    parser.add_argument('-u', '--url', help='only trials of this URL')
+    parser.add_argument('-t', '--trial', type=int, help='only this trial number')
+    parser.add_argument('-o', '--output', help='write keys here instead of stdout')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
@@ -1,14 +1,24 @@
 import os
 import subprocess
-import re
 import logging
 import urlparse
-import requests
 import signal
 import pprint
 import traceback
 import numpy
-from time import sleep
+import procutils
+from capture import PacketCapture
+from netns import NetworkNamespace
+from netem import NetworkProfile
+import netem
+import pcapstats
+from keylog import KeylogIndex
+from spans import SpanRecorder
+from preflight import Preflight
+import artifacts
+from artifacts import Manifest, artifact_name, sanitize_url
+from timeouts import Timeout, TimeoutError, kill_if_running
+from time import sleep, time
 from collections import defaultdict
 
 
@@ -16,29 +26,6 @@ TCPDUMP = '/usr/sbin/tcpdump'
 SCREENSHOT = 'scrot'
 
 
-################################################################################
-#                                                                              #
-#   UTILITIES                                                                  #
-#                                                                              #
-################################################################################
-
-class TimeoutError(Exception):
-    pass
-
-class Timeout:
-    '''Can be used w/ 'with' to make arbitrary function calls with timeouts'''
-    def __init__(self, seconds=10, error_message='Timeout'):
-        self.seconds = seconds
-        self.error_message = error_message
-    def handle_timeout(self, __, _):
-        raise TimeoutError(self.error_message)
-    def __enter__(self):
-        signal.signal(signal.SIGALRM, self.handle_timeout)
-        signal.alarm(self.seconds)
-    def __exit__(self, _, __, ___):
-        signal.alarm(0)
-
-
 ################################################################################
 #                                                                              #
 #   RESULTS                                                                    #
@@ -52,12 +39,28 @@ class LoadResult(object):
     :param url: The original URL.
     :param final_url: The final URL (maybe be different if we were redirected).
     :param time: The page load time (in seconds).
+    :param dom_content_loaded: Time until DOMContentLoaded finished (in seconds).
+    :param first_contentful_paint: Time until first contentful paint (in seconds).
     :param size: Size of object if loading a single object; total size if loading
         a full page.
     :param har: Path to the HAR file.
     :param img: Path to a screenshot of the loaded page.
     :param tcp_fast_open_supported: True if TCP fast open was used successfully;
         False otherwise or unknown
+    :param tls_false_start_supported: True if TLS false start was used;
+        False otherwise or unknown
+    :param tls_session_resumption_supported: True if a TLS session was
+        resumed; False otherwise or unknown
+    :param transport: summary of the connections in the packet capture (see
+        :func:`pcapstats.summarize`), None if there was none
+    :param recycle_reason: why the browser was recycled right after this load,
+        if it was
+    :param network_profile: the link conditions of this load (a dict of
+        :class:`netem.NetworkProfile` fields plus the `method` used to apply
+        them), None if the link was not shaped
+    :param phases: seconds spent in each phase of this trial (preload,
+        capture_start, page_load, screenshot, ...; see
+        :class:`spans.SpanRecorder`)
     '''
 
     # Status constants
@@ -67,16 +70,32 @@ class LoadResult(object):
     FAILURE_NO_200 = 'FAILURE_NO_200'  #: HTTP status code was not 200
     FAILURE_UNSET = 'FAILURE_UNSET' #: Status has not been set
 
+    # the schema: results are pickled to the driver and stored by the million,
+    # so no per-instance __dict__; add new fields at the end
+    __slots__ = ('_status', '_url', '_final_url', '_time', '_size',\
+        '_dom_content_loaded', '_first_contentful_paint', '_har_path',\
+        '_image_path', '_raw', '_server', '_tcp_fast_open_supported',\
+        '_tls_false_start_supported', '_tls_session_resumption_supported',\
+        '_recycle_reason', '_network_profile', '_transport', '_phases')
+
+    # fields whose default is not None (for results pickled before they existed)
+    _DEFAULTS = {'_tcp_fast_open_supported': False,\
+        '_tls_false_start_supported': False,\
+        '_tls_session_resumption_supported': False}
+
     def __init__(self, status, url, final_url=None, time=None, size=None,\
-        har=None, img=None, raw=None, server=None,\
+        dom_content_loaded=None, first_contentful_paint=None, har=None, img=None, raw=None, server=None,\
         tcp_fast_open_supported=False, tls_false_start_supported=False,\
-        tls_session_resumption_supported=False):
+        tls_session_resumption_supported=False, recycle_reason=None,\
+        network_profile=None, transport=None, phases=None):
 
         self._status = status
         self._url = url  # the initial URL we requested
         self._final_url = final_url  # we may have been redirected
         self._time = time  # load time in seconds
         self._size = size
+        self._dom_content_loaded = dom_content_loaded
+        self._first_contentful_paint = first_contentful_paint
         self._har_path = har
         self._image_path = img
         self._raw = raw
@@ -84,6 +103,10 @@ class LoadResult(object):
         self._tcp_fast_open_supported = tcp_fast_open_supported
         self._tls_false_start_supported = tls_false_start_supported
         self._tls_session_resumption_supported = tls_session_resumption_supported
+        self._recycle_reason = recycle_reason
+        self._network_profile = network_profile
+        self._transport = transport
+        self._phases = phases
 
     @property
     def status(self):
@@ -110,6 +133,16 @@ class LoadResult(object):
         '''???'''
         return self._size
 
+    @property
+    def dom_content_loaded(self):
+        '''Time from fetch start until DOMContentLoaded finished, in seconds.'''
+        return self._dom_content_loaded
+
+    @property
+    def first_contentful_paint(self):
+        '''Time from fetch start until the first contentful paint, in seconds.'''
+        return self._first_contentful_paint
+
     @property
     def har_path(self):
         '''Path to the HAR captured during this page load.'''
@@ -136,20 +169,81 @@ class LoadResult(object):
             connection.'''
         return self._tcp_fast_open_supported
 
+    @tcp_fast_open_supported.setter
+    def tcp_fast_open_supported(self, supported):
+        self._tcp_fast_open_supported = supported
+
     @property
     def tls_false_start_supported(self):
         '''Bool indicating whether or not TLS false start succeeded for this
             connection.'''
         return self._tls_false_start_supported
 
+    @tls_false_start_supported.setter
+    def tls_false_start_supported(self, supported):
+        self._tls_false_start_supported = supported
+
     @property
     def tls_session_resumption_supported(self):
         '''Bool indicating whether or not TLS session resumption succeeded for this
             connection.'''
         return self._tls_session_resumption_supported
 
+    @tls_session_resumption_supported.setter
+    def tls_session_resumption_supported(self, supported):
+        self._tls_session_resumption_supported = supported
+
+    @property
+    def transport(self):
+        '''Connection count, handshake RTT, bytes, retransmissions and goodput
+            from this load's packet capture (None without one).'''
+        return self._transport
+
+    @transport.setter
+    def transport(self, transport):
+        self._transport = transport
+
+    @property
+    def recycle_reason(self):
+        '''Why the browser was recycled after this load (None if it was not).'''
+        return self._recycle_reason
+
+    @recycle_reason.setter
+    def recycle_reason(self, reason):
+        self._recycle_reason = reason
+
+    @property
+    def network_profile(self):
+        '''The link conditions the page was loaded under (None if unshaped).'''
+        return self._network_profile
+
+    @network_profile.setter
+    def network_profile(self, profile):
+        self._network_profile = profile
+
+    @property
+    def phases(self):
+        '''A dict mapping the phases of this trial (and of the recovery or
+            restart right after it) to the seconds they took.'''
+        return self._phases
+
+    @phases.setter
+    def phases(self, phases):
+        self._phases = phases
+
+    def to_dict(self):
+        '''The fields of this result, keyed by their property names.'''
+        return dict((slot[1:], getattr(self, slot)) for slot in self.__slots__)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for slot in self.__slots__:
+            setattr(self, slot, state.get(slot[1:], self._DEFAULTS.get(slot)))
+
     def __str__(self):
-        return 'LoadResult (%s): %s' % (self._status,  pprint.saferepr(self.__dict__))
+        return 'LoadResult (%s): %s' % (self._status,  pprint.saferepr(self.to_dict()))
 
     def __repr__(self):
         return self.__str__()
@@ -170,6 +264,11 @@ class PageResult(object):
     FAILURE_UNKNOWN = 'FAILURE_UNKNOWN' #: An unknown failure occurred
     FAILURE_UNSET = 'FAILURE_UNSET' #: Status has not been set
 
+    __slots__ = ('_status', '_url', '_load_statuses', '_times', '_sizes',\
+        '_server', '_network_profile', '_tcp_fast_open_support_statuses',\
+        '_tls_false_start_support_statuses',\
+        '_tls_session_resumption_support_statuses', '_transports')
+
     def __init__(self, url, status=None, load_results=None):
         self._status = PageResult.FAILURE_UNSET
         self._url = url
@@ -177,9 +276,11 @@ class PageResult(object):
         self._times = []
         self._sizes = []
         self._server = 'UNKNOWN'
+        self._network_profile = None
         self._tcp_fast_open_support_statuses = []
         self._tls_false_start_support_statuses = []
         self._tls_session_resumption_support_statuses = []
+        self._transports = []
 
         if load_results:
             was_a_failure = False
@@ -188,6 +289,8 @@ class PageResult(object):
                 self._load_statuses.append(result.status)
                 if result.server:
                     self._server = result.server
+                if result.network_profile:
+                    self._network_profile = result.network_profile
                 if result.status == PageResult.SUCCESS:
                     was_a_success = True
                     if result.time: self.times.append(result.time)
@@ -198,6 +301,8 @@ class PageResult(object):
                         result.tls_false_start_supported)
                     self._tls_session_resumption_support_statuses.append(
                         result.tls_session_resumption_supported)
+                    if result.transport:
+                        self._transports.append(result.transport)
                 else:
                     was_a_failure = True
             if was_a_failure and was_a_success:
@@ -240,6 +345,11 @@ class PageResult(object):
         '''Web server software name.'''
         return self._server
 
+    @property
+    def network_profile(self):
+        '''The link conditions the trials were loaded under (None if unshaped).'''
+        return self._network_profile
+
     @property
     def tcp_fast_open_support_statuses(self):
         '''A list of bools indicating whether or not TCP fast open succeeded
@@ -258,6 +368,12 @@ class PageResult(object):
             succeeded for each load.'''
         return self._tls_session_resumption_support_statuses
 
+    @property
+    def transports(self):
+        '''A list of the packet capture summaries of successful trials (only
+            those that saved a capture).'''
+        return self._transports
+
     @property
     def mean_time(self):
         '''Mean load time across all trials.'''
@@ -273,8 +389,18 @@ class PageResult(object):
         '''Standard deviation of load time across all trials.'''
         return numpy.std(self.times)
 
+    def to_dict(self):
+        return dict((slot[1:], getattr(self, slot)) for slot in self.__slots__)
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for slot in self.__slots__:
+            setattr(self, slot, state.get(slot[1:]))
+
     def __str__(self):
-        return 'PageResult (%s): %s' % (self._status,  pprint.saferepr(self.__dict__))
+        return 'PageResult (%s): %s' % (self._status,  pprint.saferepr(self.to_dict()))
 
     def __repr__(self):
         return self.__str__()
@@ -304,6 +430,9 @@ class Loader(object):
     :param headless: don't use GUI (if there normally is one -- e.g., browsers)
     :param restart_on_fail: if a load fails, set up the loader again (e.g.,
         reboot chrome)
+    :param proxy: 'host:port' of an HTTP proxy to load pages through (e.g.,
+        replay.py); a loopback host is replaced by the host's address when
+        the browser runs in a network namespace
     :param save_har: save a HAR file to the output directory
     :param save_screenshot: save a screenshot to the output directory
     :param retries_per_trial: if a trial fails, retry this many times (beyond
@@ -313,14 +442,36 @@ class Loader(object):
         stdout and stderr.
     :param check_protocol_availability: before loading the page, check to see
         if the specified protocol (HTTP or HTTPS) is supported. (otherwise, the
-        loader might silently fall back to a different protocol.)
+        loader might silently fall back to a different protocol.) A URL that
+        is not is not loaded; its :class:`PageResult` is FAILURE_NOT_ACCESSIBLE.
     :param save_packet_capture: save a pcap trace for each load (separate files)
     :param disable_quic: disable use of the QUIC transport protocol
     :param disable_spdy: disable use of SPDY/HTTP2
-    :param ssl_keylog_file: if specified, instruct browser to save SSL session
-        keys (by setting SSLKEYLOGFILE environment variable)
+    :param log_ssl_keys: instruct the browser to save SSL session keys (by
+        setting the SSLKEYLOGFILE environment variable) to ssl_keylog_<id> in
+        the output directory, indexed per trial in ssl_keylog_<id>.index
     :param ignore_certificate_errors: continue loading page even if
         certificate check fails
+    :param isolate_network: run the browser in a network namespace of its own
+        (per worker id), so packet captures only see its traffic (needs root)
+    :param save_trace: on teardown, write a Chrome trace of the time spent in
+        each phase (setup, preload, page load, screenshot, ...) to
+        loader_trace_<id>.json in the output directory
+
+    :param output_layout: 'flat' puts all files in the output directory;
+        'sharded' puts them in <run_name>/<hash>/<trial> under it (see
+        :func:`artifacts.shard_dir`), with the keylog and trace in
+        <run_name>, so no directory gets too large to list
+    :param run_name: the directory of this run in the sharded layout
+    :param compress_artifacts: compress HARs and pcaps in the background
+        once a trial is done: True (zstd if installed, else gzip), 'gzip' or
+        'zstd' (see :class:`artifacts.Compressor`)
+    :param compress_workers: number of compression threads per loader
+    :param dedup_artifacts: with compress_artifacts, store identical
+        artifacts and large response bodies once
+
+    Every HAR, pcap and screenshot is recorded in the manifest.jsonl of the
+    output directory (of the run, if sharded; see :class:`artifacts.Manifest`).
     '''
 
     def __init__(self, outdir='.', num_trials=1, http2=False, timeout=61,\
@@ -329,7 +480,10 @@ class Loader(object):
         save_har=False, save_screenshot=False, retries_per_trial=0,\
         stdout_filename=None, check_protocol_availability=True,\
         save_packet_capture=False, disable_quic=False, disable_spdy=False,\
-        log_ssl_keys=False, ignore_certificate_errors=False):
+        log_ssl_keys=False, ignore_certificate_errors=False,\
+        isolate_network=False, save_trace=False, output_layout='flat',\
+        run_name=None, compress_artifacts=False, compress_workers=2,\
+        dedup_artifacts=False):
         '''Initialize a Loader object.'''
 
         # options
@@ -354,6 +508,22 @@ class Loader(object):
         self._disable_spdy = disable_spdy
         self._log_ssl_keys = log_ssl_keys
         self._ignore_certificate_errors = ignore_certificate_errors
+        self._isolate_network = isolate_network
+        self._save_trace = save_trace
+        if output_layout not in artifacts.LAYOUTS:
+            raise ValueError('Unknown output layout %s' % output_layout)
+        self._sharded = output_layout == 'sharded'
+        self._compress_artifacts = compress_artifacts
+        self._compress_workers = compress_workers
+        self._dedup_artifacts = dedup_artifacts
+
+        # where each trial's files are
+        self._artifact_dir = os.path.join(outdir, run_name or 'run')\
+            if self._sharded else outdir
+        self._manifest = Manifest(self._artifact_dir)
+        self._made_dirs = set()
+        self._compressor = None
+        self._preflight = None
 
         # cummulative list of all URLs (one per trial)
         self._urls = []
@@ -374,6 +544,29 @@ class Loader(object):
 
         self.tcpdump_proc = None
 
+        # in-process capture service, started on the first trial that wants a
+        # pcap; if it can't be started we fall back to tcpdump per trial
+        self._capture = None
+        self._capture_failed = False
+
+        # the worker's network namespace, if isolate_network is set
+        self._netns = None
+
+        # per-trial index of the SSL keylog, if log_ssl_keys is set
+        self._keylog = None
+
+        # the network profile in effect and how it was applied
+        self._network_profile = None
+        self._network_shaping = None
+
+        # remember the id we were set up with so restarts reuse the same ports
+        self._my_id = 0
+
+        # where the time goes; the phases of the last trial also get the
+        # recovery after it
+        self._spans = SpanRecorder()
+        self._trial_phases = None
+
         # nicely teardown
         # NOTE: do not SIGKILL
         signal.signal(signal.SIGINT, self.handle_kill)
@@ -384,21 +577,49 @@ class Loader(object):
     ## Internal helper methods
     ##
 
-    # These two functions define how the loader names result files
-    # They are duplicated multiple times in other components of the whole test suite
-    # NOTE: change all of them if one wants to update them
+    # These two functions define how the loader names result files (see
+    # artifacts.py); tools find the files through the manifest
     def _sanitize_url(self, url):
         '''Returns a version of the URL suitable for use in a file name.'''
-        return re.sub(r'[/\;,><&*:%=+@!#^()|?^]', '-', url)
+        return sanitize_url(url)
 
     def _outfile_path(self, url, suffix=None, trial=None):
         '''Returns a path for an output file (e.g., HAR, screenshot, pcap)'''
-        filename = self._sanitize_url(url)
+        filename = artifact_name(url)
         if trial is not None:
             filename += '_%d' % trial
         if suffix:
             filename += suffix
-        return os.path.join(self._outdir, filename)
+        if not self._sharded:
+            return os.path.join(self._outdir, filename)
+        directory = artifacts.shard_dir(self._artifact_dir, url, trial)
+        self._makedirs(directory)
+        return os.path.join(directory, filename)
+
+    def _makedirs(self, directory):
+        # one stat per new directory, not per file
+        if directory not in self._made_dirs:
+            artifacts.makedirs(directory)
+            self._made_dirs.add(directory)
+
+    def _record_artifacts(self, url, trial, result, pcap_path=None, image_path=None):
+        '''Add the files a trial left in the output directory to the manifest.'''
+        for kind, path in (('har', result.har_path), ('pcap', pcap_path),\
+                           ('png', image_path or result.image_path)):
+            if path and os.path.exists(path):
+                try:
+                    self._manifest.add(url, trial, kind, path)
+                except (IOError, OSError) as e:
+                    logging.warning('Error adding %s to the manifest: %s', path, e)
+                    continue
+                # screenshots are compressed already
+                if self._compressor and kind != 'png':
+                    self._compressor.submit(url, trial, kind, path)
+
+    @property
+    def manifest(self):
+        '''The :class:`artifacts.Manifest` of the output directory.'''
+        return self._manifest
 
 
     def _check_url(self, url):
@@ -415,54 +636,146 @@ class Loader(object):
         '''Check if the URL can be loaded over the specified protocol.
 
         For example, an HTTPS might not respond or an HTTP URL might be
-        redirected to an HTTPS one.
+        redirected to an HTTPS one. Results are cached (see
+        :class:`preflight.Preflight`), so checking the URLs of all tests
+        first, with :meth:`preflight`, makes this free.
         '''
-
-        orig_protocol = urlparse.urlparse(url).scheme
-        logging.debug('Checking if %s can be accessed using %s'\
-            , url, orig_protocol)
-
-        # try to fetch the page with the specified protocol
-        response = None
+        logging.debug('Checking if %s can be accessed using %s', url,\
+            urlparse.urlparse(url).scheme)
+        return self.preflight([url])[url].scheme_supported
+
+    def preflight(self, urls):
+        '''Check `urls` concurrently; returns a dict mapping each to its
+        :class:`preflight.PreflightResult`.'''
+        if not self._preflight:
+            self._preflight = Preflight(timeout=self._timeout, user_agent=self._user_agent,\
+                proxy=self._proxy)
+        return self._preflight.check_all(urls)
+
+    def _proxy_address(self):
+        '''The proxy as the browser reaches it, or None.'''
+        if not self._proxy:
+            return None
+        host, _, port = self._proxy.rpartition(':')
+        if self._netns and host in ('localhost', '127.0.0.1', ''):
+            host = self._netns.host_address
+        return '%s:%s' % (host, port)
+
+    def _spawn(self, name, cmd, in_netns=False, **kwargs):
+        '''Launch a helper process (browser, Xvfb, tcpdump, ...) in its own
+        process group, with a pidfile so orphans can be swept up later.
+        With `in_netns`, it runs in the worker's network namespace (if any).'''
+        if in_netns and self._netns:
+            cmd = self._netns.wrap(cmd)
+        return procutils.spawn('%d-%s' % (self._my_id, name), cmd, **kwargs)
+
+    def _reap(self, name, proc):
+        '''Kill a process started with :meth:`_spawn` and all its children.'''
+        procutils.reap('%d-%s' % (self._my_id, name), proc)
+
+    def _capture_ports(self):
+        return procutils.socket_ports(self.browser_pids())
+
+    def _packet_capture(self):
+        '''The running capture service, or None if it is unavailable.'''
+        if not self._capture and not self._capture_failed:
+            # the host end of the namespace's link only carries our traffic
+            capture = PacketCapture(interface=self._netns.host_interface\
+                if self._netns else None)
+            if capture.start():
+                self._capture = capture
+            else:
+                logging.warning('Falling back to tcpdump for packet captures')
+                self._capture_failed = True
+        return self._capture
+
+    def _stop_capture(self):
+        if self._capture:
+            self._capture.stop()
+            self._capture = None
+
+    def _emulate_network(self, _):
+        '''Subclasses can override to make the browser itself emulate a
+        :class:`netem.NetworkProfile` (None: stop). Return the name of the
+        method used, or None if not supported.'''
+        return None
+
+    def _apply_network_profile(self, profile):
+        '''Put the link under `profile` (None: unshaped) for the next loads,
+        with tc in the worker's network namespace if there is one, otherwise
+        with the browser's own emulation. Returns how the profile is applied
+        ('tc', 'devtools', ...) or None.'''
+        if profile == self._network_profile:
+            return self._network_shaping
+        method = None
+        if self._netns:
+            try:
+                netem.shape_link(profile, self._netns.host_interface,\
+                    self._netns.namespace_interface, self._netns.name)
+                method = 'tc'
+            except Exception as e:
+                logging.warning('Error shaping %s with tc: %s', self._netns.name, e)
+        if not method:
+            method = self._emulate_network(profile)
+        if profile and not method:
+            logging.warning('Cannot apply network profile %s, loading unshaped', profile.name)
+        self._network_profile = profile
+        self._network_shaping = method
+        return method
+
+    def _analyze_capture(self, result, pcap_path, client_randoms=None):
+        '''Fill the transport fields of `result` from its packet capture.
+        With the `client_randoms` of the trial's SSL keys, also count the
+        TLS connections that can be decrypted.'''
         try:
-            with Timeout(seconds = self._timeout+5):
-                headers = {}
-                if self._user_agent:
-                    headers['User-Agent'] = self._user_agent
-                response = requests.get(url, timeout=self._timeout,\
-                    headers=headers, verify=False)
-        except requests.exceptions.ConnectionError as e:
-            logging.debug('Could not connect to %s: %s', url, e)
-            return False
-        except requests.exceptions.Timeout as e:
-            logging.debug('Timed out connecting to %s: %s', url, e)
-            return False
-        except TimeoutError:
-            logging.debug('* Timed out connecting to %s', url)
-            return False
+            connections = list(pcapstats.analyze(pcap_path))
         except Exception as e:
-            logging.exception('Error requesting %s: %s', url, e)
-            return False
-
-        # if we got a response, check if we changed protocols
-        final_protocol = urlparse.urlparse(response.url).scheme
-        if orig_protocol == final_protocol:
-            return True
-        else:
-            return False
-
-    def _preload_objects(self, _, __):
+            logging.warning('Error analyzing %s: %s', pcap_path, e)
+            return
+        summary = pcapstats.summarize(connections)
+        if client_randoms is not None:
+            client_randoms = set(client_randoms)
+            summary['transport']['tls_connections_with_keys'] = sum(1 for c in connections\
+                if c['tls_client_random'] in client_randoms)
+        result.tcp_fast_open_supported = summary['tcp_fast_open_supported']
+        result.tls_false_start_supported = summary['tls_false_start_supported']
+        result.tls_session_resumption_supported =\
+            summary['tls_session_resumption_supported']
+        result.transport = summary['transport']
+
+    def stop_tcpdump(self):
+        '''Stop tcpdump (if it's running)'''
+        if self.tcpdump_proc:
+            logging.debug('Stopping tcpdump')
+            self._reap('tcpdump', self.tcpdump_proc)
+            self.tcpdump_proc = None
+
+    # Subclasses load pages in these two; they must not run past `deadline`
+    # (an absolute time, as from time(); None: no limit), e.g., by guarding
+    # their waits with Timeout(..., deadline=deadline)
+    def _preload_objects(self, _, __, deadline=None):
         return
 
-    def _load_page(self, _, __, ___):
+    def _load_page(self, _, __, ___, deadline=None):
         return
 
+    def _call(self, cmd, timeout):
+        '''Run `cmd` (output to the stdout file) until it exits, or kill it
+        when `timeout` (a :class:`Timeout` we are in) expires.'''
+        proc = subprocess.Popen(cmd, stdout=self._stdout_file, stderr=subprocess.STDOUT)
+        timeout.guard(kill_if_running(proc))
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
     def _setup(self, _=0):
         '''Subclasses can override to prepare (e.g., launch Xvfb)'''
         return True
 
     def __setup(self, my_id=0):
         '''Private setup method for Loader superclass'''
+        # clean up after earlier runs that died without tearing down
+        procutils.sweep()
+
         if self._stdout_filename:
             try:
                 self._stdout_file = open(self._stdout_filename, 'a')
@@ -471,11 +784,32 @@ class Loader(object):
                     self._stdout_filename)
                 self._stdout_file = None
 
+        if self._log_ssl_keys:
+            # one file per worker: concurrent browsers would interleave writes;
+            # the browser appends new keys without overwriting old ones
+            self._keylog = KeylogIndex(os.path.abspath(os.path.join(self._artifact_dir,\
+                'ssl_keylog_%d' % my_id)))
+            os.environ['SSLKEYLOGFILE'] = self._keylog.keylog_path
+
+        if self._isolate_network:
+            self._netns = NetworkNamespace(my_id)
+            if not self._netns.setup():
+                self._netns = None
+                return False
+
         return self._setup(my_id)
 
     def setup(self, my_id=0):
         # my_id is a unique value to avoid multiple browsers using the same port
-        return self.__setup(my_id)
+        self._my_id = my_id
+        self._spans = SpanRecorder(my_id, 'worker %d' % my_id)
+        self._makedirs(self._artifact_dir)
+        if self._compress_artifacts and not self._compressor:
+            codec = self._compress_artifacts if self._compress_artifacts is not True else None
+            self._compressor = artifacts.Compressor(self._manifest, codec,\
+                workers=self._compress_workers, dedup=self._dedup_artifacts)
+        with self._spans.span('setup'):
+            return self.__setup(my_id)
 
     def _teardown(self):
         '''Subclasses can override to clean up (e.g., kill Xvfb)'''
@@ -483,15 +817,78 @@ class Loader(object):
 
     def __teardown(self):
         '''Private teardown method for Loader superclass'''
+        self.stop_tcpdump()
+        self._stop_capture()
         child_ret = self._teardown()
 
+        if self._netns:
+            self._netns.teardown()
+            self._netns = None
+        self._network_profile = None
+        self._network_shaping = None
+
         if self._stdout_file:
             self._stdout_file.close()
 
         return child_ret
 
     def teardown(self):
-        return self.__teardown()
+        with self._spans.span('teardown'):
+            ret = self.__teardown()
+            if self._compressor:
+                self._compressor.close()
+                self._compressor = None
+        if self._save_trace:
+            try:
+                self._spans.write_trace(os.path.join(self._artifact_dir,\
+                    'loader_trace_%d.json' % self._my_id))
+            except Exception as e:
+                logging.warning('Error writing trace: %s', e)
+        return ret
+
+    def _reset(self):
+        '''Subclasses can override to clear browser state (cache, cookies,
+        connections) in place. Return False if that is not possible.'''
+        return False
+
+    def _check_health(self):
+        '''Subclasses can override to report whether the loader (e.g., the
+        browser process) is still usable.'''
+        return True
+
+    def check_health(self):
+        return self._check_health()
+
+    def _browser_pids(self):
+        '''Subclasses can override to list the top-level browser processes'''
+        return []
+
+    def browser_pids(self):
+        return self._browser_pids()
+
+    def restart(self):
+        '''Tear down and set up the loader again (e.g., reboot the browser).
+        What :meth:`setup` starts for the whole run (the trace, the output
+        directory, the compressor) carries over; :meth:`teardown` ends it.'''
+        with self._spans.span('restart', self._trial_phases):
+            self.__teardown()
+            self._num_restarts += 1
+            return self.__setup(self._my_id)
+
+    def reset(self):
+        '''Clear browser state without restarting, if the loader is healthy.'''
+        with self._spans.span('reset', self._trial_phases):
+            return self._check_health() and self._reset()
+
+    def recover(self):
+        '''Get back to a clean state after a failed load. Prefer an in-place
+        reset; only tear down and set up the loader again if the health check
+        or the reset fails.'''
+        if self.reset():
+            logging.debug('Loader reset in place')
+            return True
+        logging.debug('Loader unhealthy or reset failed, restarting')
+        return self.restart()
 
     def handle_kill(self, __, _):
         self.teardown()
@@ -501,6 +898,9 @@ class Loader(object):
         '''override getstate so we don't try to pickle the stdout file object'''
         state = dict(self.__dict__)
         del state['_stdout_file']
+        # nor the compressor's thread, it is started by setup
+        state['_compressor'] = None
+        state['_preflight'] = None
         return state
 
 
@@ -525,6 +925,11 @@ class Loader(object):
         '''A dict mapping URLs to a :class:`PageResult`.'''
         return self._page_results
 
+    @property
+    def spans(self):
+        '''The :class:`spans.SpanRecorder` timing this loader's phases.'''
+        return self._spans
+
     @property
     def num_restarts(self):
         '''Number of times the loader was restarted (e.g., rebooted browser
@@ -548,16 +953,25 @@ class Loader(object):
         try:
             # if load fails, keep trying self._retries_per_trial times
             tries_so_far = 0
+            profile = NetworkProfile.from_setting(test.get('network_profile'))
             while tries_so_far <= self._retries_per_trial:
                 tries_so_far += 1
+                phases = self._trial_phases = {}
+
+                # (re)applied every try, a restart drops the shaping
+                with self._spans.span('network_profile', phases):
+                    shaping = self._apply_network_profile(profile)
 
                 # handle preload first
                 if test['preload']:
-                    self._preload_objects(test['preload'], test['fresh_view'])
+                    with self._spans.span('preload', phases):
+                        self._preload_objects(test['preload'], test['fresh_view'],\
+                            time() + (self._timeout + 5) * len(test['preload']))
 
                     # avoid clear cache again after preload
                     test['fresh_view'] = False
-                # start tcpdump if we want a packet capture
+                # start capturing if we want a packet capture
+                pcap_path = None
                 if test['save_packet_capture']:
 
                     # the prefix of the pcap file
@@ -566,18 +980,34 @@ class Loader(object):
                         prefix = url
                     pcap_path = self._outfile_path(prefix, suffix='.pcap', trial=i)
 
-                    # start dump, for now we just filter out port 22
-                    # could be only 80 and 443
-                    tcpdump_command = [TCPDUMP, '-w', pcap_path, 'port not 22']
-                    logging.debug('Starting tcpdump: %s', ' '.join(tcpdump_command))
-                    self.tcpdump_proc = subprocess.Popen(tcpdump_command,\
-                        stdout=self._stdout_file, stderr=self._stdout_file)
-                    # sometimes tcpdump is slower than chrome to startup
-                    sleep(0.5)
+                    with self._spans.span('capture_start', phases):
+                        if self._packet_capture():
+                            # only keep the browser's own connections (if we
+                            # know its processes), other workers share the link
+                            self._capture.begin_trial(self._capture_ports\
+                                if self.browser_pids() and not self._netns else None)
+                        else:
+                            # start dump, for now we just filter out port 22
+                            # could be only 80 and 443
+                            tcpdump_command = [TCPDUMP, '-w', pcap_path, 'port not 22']
+                            if self._netns:
+                                tcpdump_command[1:1] = ['-i', self._netns.host_interface]
+                            logging.debug('Starting tcpdump: %s', ' '.join(tcpdump_command))
+                            self.tcpdump_proc = self._spawn('tcpdump', tcpdump_command,\
+                                stdout=self._stdout_file, stderr=self._stdout_file)
+                            # sometimes tcpdump is slower than chrome to startup
+                            sleep(0.5)
+
+                # the keys of this trial start here, like the capture
+                if self._keylog:
+                    self._keylog.begin_trial()
 
                 # load the page, this function is overrided by ChromeLoader and FirefoxLoader
-                result = self._load_page(test, self._outdir, i)
+                with self._spans.span('page_load', phases, url=url, trial=i):
+                    result = self._load_page(test, self._outdir, i,\
+                        deadline=time() + self._timeout + 5)
 
+                sspath = None
                 try:
                     if test['save_screenshot']:
                         prefix = test['screenshot_name'] if test['screenshot_name'] else url
@@ -590,36 +1020,44 @@ class Loader(object):
                             cmd = [SCREENSHOT, sspath]
                         else:
                             cmd = [SCREENSHOT, sspath]
-                        with Timeout(seconds=self._timeout+5):
-                            subprocess.check_call(cmd, stdout=self._stdout_file, stderr=subprocess.STDOUT)
+                        with self._spans.span('screenshot', phases):
+                            with Timeout(seconds=self._timeout+5) as timeout:
+                                self._call(cmd, timeout)
                         logging.debug('Screenshot taken')
                 except TimeoutError:
                     logging.exception('* Timeout taking screenshot for %s', url)
                 except subprocess.CalledProcessError as e:
-                    logging.exception('Error call %s: %s\n%s', SCREENSHOT, e, e.output)
+                    logging.exception('Error call %s: %s', SCREENSHOT, e)
                 except Exception as e:
                     logging.exception('Error taking screenshot for %s: %s', url, e)
+                if profile and shaping:
+                    result.network_profile = dict(profile.to_dict(), method=shaping)
                 logging.debug('Trial %d, try %d: %s', i, tries_so_far, result)
 
-                # stop tcpdump (if it's running)
-                if self.tcpdump_proc:
-                    logging.debug('Stopping tcpdump')
-                    os.system("kill %s" % self.tcpdump_proc.pid)
-                    self.tcpdump_proc = None
+                with self._spans.span('capture_stop', phases):
+                    if pcap_path and self._capture:
+                        self._capture.end_trial(pcap_path)
+                    self.stop_tcpdump()
+                    keys = self._keylog.end_trial(url, i, pcap_path) if self._keylog else None
+                if pcap_path and result.status == LoadResult.SUCCESS:
+                    with self._spans.span('capture_analysis', phases):
+                        self._analyze_capture(result, pcap_path,\
+                            keys['client_randoms'] if keys else None)
+                result.phases = phases
 
                 if result.status == LoadResult.SUCCESS:
+                    self._record_artifacts(url, i, result, pcap_path, sspath)
                     self._urls.append(url)
                     self._load_results[url].append(result)
                     break  # success, don't retry
                 elif tries_so_far > self._retries_per_trial:
                     # this was the last try, record the failure
+                    self._record_artifacts(url, i, result, pcap_path, sspath)
                     self._urls.append(url)
                     self._load_results[url].append(result)
 
                 if result.status == LoadResult.FAILURE_UNKNOWN and self._restart_on_fail:
-                    self.__teardown()
-                    self.__setup()
-                    self._num_restarts += 1
+                    self.recover()
 
         except Exception as e:
             logging.exception('Error loading page %s: %s\n%s', url, e,\
@@ -632,14 +1070,26 @@ class Loader(object):
         '''
         self.tcpdump_proc = None  # if we use tcpdump, keep a handle to the process
         try:
-            if not self.__setup():
+            if not self.setup():
                 logging.error('Error setting up loader')
                 return
 
+            if self._check_protocol_availability:
+                # all at once, not one round trip per URL between loads
+                self.preflight([self._check_url(test['url']) for test in tests['tests']])
+
             for test in tests['tests']:
                 url = test['url']
                 # make sure URL is well-formed (e.g., has protocol, etc.)
                 url = self._check_url(url)
+                if self._check_protocol_availability and not self._check_protocol_available(url):
+                    logging.warning('Skipping %s: not available over %s', url,\
+                        urlparse.urlparse(url).scheme)
+                    if url not in self._page_results:
+                        self._page_results[url] = []
+                    self._page_results[url].append(PageResult(url,\
+                        status=PageResult.FAILURE_NOT_ACCESSIBLE))
+                    continue
                 # If all is well, load URL num_trials times
                 for i in range(0, test['num_trials']):
                     self.load_page(test, i)
@@ -651,12 +1101,8 @@ class Loader(object):
         except Exception as e:
             logging.exception('Error loading pages: %s\n%s', e, traceback.format_exc())
         finally:
-            # stop tcpdump (if it's running)
             try:
-                if self.tcpdump_proc:
-                    logging.debug('Stopping tcpdump')
-                    os.system("kill %s" % self.tcpdump_proc.pid)
-                    self.tcpdump_proc = None
+                self.stop_tcpdump()
             except Exception:
                 logging.exception('Error stopping tcpdump.')
-            self.__teardown()
+            self.teardown()
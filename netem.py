@@ -0,0 +1,164 @@
+import os
+import logging
+import subprocess
+
+TC = '/usr/bin/env tc'
+IP = '/usr/bin/env ip'
+
+
+################################################################################
+#                                                                              #
+#   NETWORK PROFILES                                                           #
+#                                                                              #
+################################################################################
+
+# named profiles (the usual WebPageTest connectivity presets); rates in kbit/s
+PRESETS = {
+    'cable': {'rtt_ms': 28, 'down_kbps': 5000, 'up_kbps': 1000},
+    'dsl': {'rtt_ms': 50, 'down_kbps': 1500, 'up_kbps': 384},
+    '3gslow': {'rtt_ms': 400, 'down_kbps': 400, 'up_kbps': 400},
+    '3g': {'rtt_ms': 300, 'down_kbps': 1600, 'up_kbps': 768},
+    '3gfast': {'rtt_ms': 150, 'down_kbps': 1600, 'up_kbps': 768},
+    '4g': {'rtt_ms': 170, 'down_kbps': 9000, 'up_kbps': 9000},
+    'lte': {'rtt_ms': 70, 'down_kbps': 12000, 'up_kbps': 12000},
+}
+
+class NetworkProfile(object):
+    '''Link conditions to load a page under.
+
+    :param name: a name for the profile (e.g., the preset it came from)
+    :param rtt_ms: round trip time added to every packet, in milliseconds
+        (split evenly between the two directions)
+    :param down_kbps: downlink rate in kbit/s (None: unlimited)
+    :param up_kbps: uplink rate in kbit/s (None: unlimited)
+    :param loss: packet loss in percent, in each direction
+    :param queue_packets: bottleneck queue size in packets (None: tc default)
+    '''
+
+    FIELDS = ('name', 'rtt_ms', 'down_kbps', 'up_kbps', 'loss', 'queue_packets')
+
+    def __init__(self, name='custom', rtt_ms=0, down_kbps=None, up_kbps=None,\
+        loss=0, queue_packets=None):
+        self._name = name
+        self._rtt_ms = rtt_ms
+        self._down_kbps = down_kbps
+        self._up_kbps = up_kbps
+        self._loss = loss
+        self._queue_packets = queue_packets
+
+    @classmethod
+    def from_setting(cls, setting):
+        '''Make a profile from a test's `network_profile` setting: a preset
+        name, or a dict of :class:`NetworkProfile` parameters, optionally with
+        a `preset` to start from. Returns None for None.'''
+        if setting is None:
+            return None
+        if not isinstance(setting, dict):
+            setting = {'preset': setting}
+        params = dict(setting)
+        preset = params.pop('preset', None)
+        if preset is not None:
+            if preset.lower() not in PRESETS:
+                raise ValueError('Unknown network profile %s' % preset)
+            base = dict(PRESETS[preset.lower()], name=preset.lower())
+            base.update(params)
+            params = base
+        return cls(**params)
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def rtt_ms(self):
+        return self._rtt_ms
+
+    @property
+    def down_kbps(self):
+        return self._down_kbps
+
+    @property
+    def up_kbps(self):
+        return self._up_kbps
+
+    @property
+    def loss(self):
+        return self._loss
+
+    @property
+    def queue_packets(self):
+        return self._queue_packets
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, NetworkProfile) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __str__(self):
+        return 'NetworkProfile %s: %s' % (self._name, self.to_dict())
+
+    def __repr__(self):
+        return self.__str__()
+
+
+################################################################################
+#                                                                              #
+#   TC                                                                         #
+#                                                                              #
+################################################################################
+
+def _tc(args, netns=None, check=True):
+    cmd = TC.split() + args
+    if netns:
+        cmd = IP.split() + ['netns', 'exec', netns] + cmd
+    logging.debug('Running: %s', ' '.join(cmd))
+    with open(os.devnull, 'w') as devnull:
+        if check:
+            subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+        else:
+            subprocess.call(cmd, stdout=devnull, stderr=devnull)
+
+def clear(interface, netns=None):
+    '''Remove any shaping from the egress of `interface`.'''
+    _tc(['qdisc', 'del', 'dev', interface, 'root'], netns, check=False)
+
+def shape(interface, delay_ms=0, rate_kbps=None, loss=0, queue_packets=None,\
+    netns=None):
+    '''Shape the egress of `interface`: netem adds delay and loss, a tbf below
+    it limits the rate. With `netns`, `interface` is in that namespace.'''
+    clear(interface, netns)
+    tbf_parent = ['root', 'handle', '1:']
+    if delay_ms or loss or (queue_packets and not rate_kbps):
+        netem = ['qdisc', 'add', 'dev', interface, 'root', 'handle', '1:', 'netem',\
+            'delay', '%sms' % delay_ms]
+        if loss:
+            netem += ['loss', '%s%%' % loss]
+        if queue_packets and not rate_kbps:
+            netem += ['limit', str(queue_packets)]
+        _tc(netem, netns)
+        tbf_parent = ['parent', '1:1', 'handle', '10:']
+    if rate_kbps:
+        # the queue of the bottleneck is tbf's; 1500 byte packets
+        limit = (queue_packets or 1000) * 1500
+        # bucket for ~4ms at full rate, at least one packet
+        burst = max(1600, int(rate_kbps) * 1000 // 8 // 250)
+        _tc(['qdisc', 'add', 'dev', interface] + tbf_parent +\
+            ['tbf', 'rate', '%dkbit' % rate_kbps, 'burst', str(burst),\
+            'limit', str(limit)], netns)
+
+def shape_link(profile, host_interface, namespace_interface, netns):
+    '''Apply `profile` to both ends of a namespace's veth pair: the host end
+    carries the downlink, the namespace end the uplink. None clears it.'''
+    if profile is None:
+        clear(host_interface)
+        clear(namespace_interface, netns)
+        return
+    half_rtt = profile.rtt_ms / 2.0
+    shape(host_interface, half_rtt, profile.down_kbps, profile.loss,\
+        profile.queue_packets)
+    shape(namespace_interface, half_rtt, profile.up_kbps, profile.loss,\
+        profile.queue_packets, netns)
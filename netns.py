@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import time
+import urllib2
+import logging
+import argparse
+import subprocess
+
+IP = '/usr/bin/env ip'
+IPTABLES = '/usr/bin/env iptables'
+SYSCTL = '/usr/bin/env sysctl'
+HOST_RESOLV_CONFS = ('/run/systemd/resolve/resolv.conf', '/etc/resolv.conf')
+# the workers' /30s are carved out of this
+NETWORK = '10.213.0.0/16'
+
+
+################################################################################
+#                                                                              #
+#   PER-WORKER NETWORK NAMESPACES                                              #
+#                                                                              #
+################################################################################
+
+class NetworkNamespace(object):
+    '''A Linux network namespace for one worker, connected to the host by a
+    veth pair and NATed out through the host's default route.
+
+    Whatever runs inside (see :meth:`wrap`) has its own interfaces, so a
+    capture on :attr:`host_interface` sees only that worker's traffic, and
+    shaping applied there affects only that worker. Needs root.
+
+    Worker `n` gets 10.213.0.0/16 + 4n as a /30: the host side is .1, the
+    namespace side .2.
+
+    :param my_id: the worker id
+    '''
+
+    def __init__(self, my_id=0):
+        self._id = my_id
+        self.name = 'webloader%d' % my_id
+        self.host_interface = 'wl%d-host' % my_id
+        self.namespace_interface = 'wl%d-ns' % my_id
+        base = 4 * my_id
+        prefix = '10.213.%d.' % (base // 256)
+        self.host_address = prefix + str(base % 256 + 1)
+        self.namespace_address = prefix + str(base % 256 + 2)
+        self.subnet = prefix + '%d/30' % (base % 256)
+        self._nat = False
+
+    def _run(self, cmd, check=True):
+        logging.debug('Running: %s', cmd)
+        with open(os.devnull, 'w') as devnull:
+            if check:
+                subprocess.check_call(cmd.split(), stdout=devnull, stderr=devnull)
+            else:
+                return subprocess.call(cmd.split(), stdout=devnull, stderr=devnull)
+
+    def _ns(self, cmd):
+        self._run('%s netns exec %s %s' % (IP, self.name, cmd))
+
+    def _write_resolv_conf(self):
+        # `ip netns exec` bind-mounts /etc/netns/<name>/resolv.conf; needed
+        # when the host resolver is a local stub that isn't reachable from
+        # inside the namespace
+        for path in HOST_RESOLV_CONFS:
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    conf = f.read()
+                if 'nameserver 127.' in conf:
+                    continue
+                netns_etc = os.path.join('/etc/netns', self.name)
+                if not os.path.isdir(netns_etc):
+                    os.makedirs(netns_etc)
+                with open(os.path.join(netns_etc, 'resolv.conf'), 'w') as f:
+                    f.write(conf)
+                return
+
+    def setup(self):
+        '''Create the namespace and its link. Returns False on failure.'''
+        # leftovers of a crashed run would make the commands below fail
+        self.teardown()
+        try:
+            self._run('%s netns add %s' % (IP, self.name))
+            self._run('%s link add %s type veth peer name %s'\
+                % (IP, self.host_interface, self.namespace_interface))
+            self._run('%s link set %s netns %s'\
+                % (IP, self.namespace_interface, self.name))
+            self._run('%s addr add %s/30 dev %s'\
+                % (IP, self.host_address, self.host_interface))
+            self._run('%s link set %s up' % (IP, self.host_interface))
+            self._ns('%s addr add %s/30 dev %s'\
+                % (IP, self.namespace_address, self.namespace_interface))
+            self._ns('%s link set %s up' % (IP, self.namespace_interface))
+            self._ns('%s link set lo up' % IP)
+            self._ns('%s route add default via %s' % (IP, self.host_address))
+            self._write_resolv_conf()
+        except Exception as e:
+            logging.error('Error setting up network namespace %s: %s', self.name, e)
+            self.teardown()
+            return False
+
+        # without NAT the namespace can still reach the host (e.g., a local
+        # test server or replay proxy), just not the internet
+        try:
+            self._run('%s -w net.ipv4.ip_forward=1' % SYSCTL)
+            self._run('%s -t nat -A POSTROUTING -s %s ! -o %s -j MASQUERADE'\
+                % (IPTABLES, self.subnet, self.host_interface))
+            self._nat = True
+        except Exception as e:
+            logging.warning('No NAT for network namespace %s: %s', self.name, e)
+        logging.debug('Network namespace %s up (%s)', self.name, self.namespace_address)
+        return True
+
+    def teardown(self):
+        if self._nat:
+            self._run('%s -t nat -D POSTROUTING -s %s ! -o %s -j MASQUERADE'\
+                % (IPTABLES, self.subnet, self.host_interface), check=False)
+            self._nat = False
+        # deleting one end of a veth pair deletes both
+        self._run('%s link del %s' % (IP, self.host_interface), check=False)
+        self._run('%s netns del %s' % (IP, self.name), check=False)
+        resolv_conf = os.path.join('/etc/netns', self.name, 'resolv.conf')
+        if os.path.exists(resolv_conf):
+            os.remove(resolv_conf)
+            os.rmdir(os.path.dirname(resolv_conf))
+
+    def wrap(self, cmd):
+        '''Return command list `cmd` changed to run inside the namespace.'''
+        return IP.split() + ['netns', 'exec', self.name] + list(cmd)
+
+
+
+def main():
+    # smoke test: a server inside the namespace, fetched from the host
+    ns = NetworkNamespace(args.id)
+    if not ns.setup():
+        sys.exit(-1)
+    server = None
+    try:
+        server = subprocess.Popen(ns.wrap([sys.executable, '-m',\
+            'SimpleHTTPServer', str(args.port)]))
+        time.sleep(1)
+        url = 'http://%s:%d/' % (ns.namespace_address, args.port)
+        print '%s -> %d bytes' % (url, len(urllib2.urlopen(url).read()))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        ns.teardown()
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Check that per-worker network namespaces work on this host.')
+    parser.add_argument('-i', '--id', type=int, default=0, help='worker id to test with')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='port of the test server in the namespace')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
@@ -0,0 +1,619 @@
+#! /usr/bin/env python
+
+import os
+import json
+import mmap
+import binascii
+import struct
+import logging
+import argparse
+import numpy
+import artifacts
+
+
+################################################################################
+#                                                                              #
+#   PCAP RECORDS                                                               #
+#                                                                              #
+################################################################################
+
+class PcapError(Exception):
+    pass
+
+# magic -> (byte order, timestamp fraction units per second)
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+
+# link type -> how to find the IP header: (offset of the ethertype or None,
+# offset of the link header's end)
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINK_HEADERS = {
+    LINKTYPE_NULL: (None, 4),
+    LINKTYPE_ETHERNET: (12, 14),
+    12: (None, 0),  # raw IP on some BSDs
+    LINKTYPE_RAW: (None, 0),
+    LINKTYPE_LINUX_SLL: (14, 16),
+}
+
+# bytes read at a time from a pcap that cannot be mapped (e.g., compressed)
+READ_BUFFER = 256 * 1024
+
+def _pcap_format(magic):
+    if magic not in PCAP_MAGICS:
+        raise PcapError('Not a pcap file (pcapng is not supported)')
+    order, units = PCAP_MAGICS[magic]
+    return units, struct.Struct(order + 'IHHiIII'), struct.Struct(order + 'IIII')
+
+def iter_records(mm):
+    '''Yield (timestamp, buffer, offset, captured length) for every record
+    of the pcap mapped in `mm` (the buffer is `mm`). Frames are not copied;
+    read them from the buffer at `offset`. Returns the link type as the
+    first item.'''
+    units, header, record = _pcap_format(mm[0:4])
+    yield header.unpack_from(mm, 0)[6]
+
+    offset = header.size
+    end = len(mm)
+    while offset + record.size <= end:
+        sec, frac, caplen, _ = record.unpack_from(mm, offset)
+        offset += record.size
+        if offset + caplen > end:
+            logging.debug('Truncated record at offset %d', offset)
+            return
+        yield sec + float(frac) / units, mm, offset, caplen
+        offset += caplen
+
+def _refill(f, buf, offset, size, buffer_size):
+    '''The unread part of `buf` from `offset`, plus more of `f` to make it at
+    least `size` bytes (unless `f` ends).'''
+    chunks = [buf[offset:]]
+    have = len(chunks[0])
+    while have < size:
+        data = f.read(max(buffer_size, size - have))
+        if not data:
+            break
+        chunks.append(data)
+        have += len(data)
+    return ''.join(chunks), 0
+
+def iter_file_records(f, buffer_size=READ_BUFFER):
+    '''Like :func:`iter_records`, for a pcap read from the file object `f`
+    (e.g., a compressed one, see :mod:`artifacts`) `buffer_size` bytes at a
+    time, so memory stays bounded whatever its size. A yielded buffer is
+    only valid until the next record. Yields nothing for an empty file.'''
+    buf = f.read(buffer_size)
+    if not buf:
+        return
+    units, header, record = _pcap_format(buf[0:4])
+    if len(buf) < header.size:
+        buf, _ = _refill(f, buf, 0, header.size, buffer_size)
+        if len(buf) < header.size:
+            raise PcapError('Truncated pcap header')
+    yield header.unpack_from(buf, 0)[6]
+
+    offset = header.size
+    position = 0  # of buf in the file, for messages
+    while True:
+        if len(buf) - offset < record.size:
+            position += offset
+            buf, offset = _refill(f, buf, offset, record.size, buffer_size)
+            if len(buf) < record.size:
+                if buf:
+                    logging.debug('Truncated record at offset %d', position)
+                return
+        sec, frac, caplen, _ = record.unpack_from(buf, offset)
+        size = record.size + caplen
+        if len(buf) - offset < size:
+            position += offset
+            buf, offset = _refill(f, buf, offset, size, buffer_size)
+            if len(buf) < size:
+                logging.debug('Truncated record at offset %d', position + record.size)
+                return
+        yield sec + float(frac) / units, buf, offset + record.size, caplen
+        offset += size
+
+
+################################################################################
+#                                                                              #
+#   PER-CONNECTION ANALYSIS                                                    #
+#                                                                              #
+################################################################################
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+TCPOPT_FASTOPEN = 34
+TCPOPT_EXPERIMENTAL = 254
+TCPOPT_FASTOPEN_MAGIC = 0xf989
+
+TLS_CHANGE_CIPHER_SPEC = 20
+TLS_HANDSHAKE = 22
+TLS_APPLICATION_DATA = 23
+TLS_CLIENT_HELLO = 1
+TLS_SERVER_HELLO = 2
+TLS_CERTIFICATE = 11
+TLS_EXT_SESSION_TICKET = 35
+TLS_EXT_PRE_SHARED_KEY = 41
+TLS_EXT_SUPPORTED_VERSIONS = 43
+TLS_1_3 = 0x0304
+
+# per direction, never buffer more than this much of the TLS handshake
+TLS_INSPECT_BYTES = 32 * 1024
+
+IPV4 = struct.Struct('!BxHxxHxBxxII')  # ihl, total length, frag, proto, addrs
+IPV6 = struct.Struct('!xxxxHBx16s16s')  # payload length, next header, addrs
+TCP = struct.Struct('!HHIIBB')  # ports, seq, ack, data offset, flags
+
+SERVER_PORTS = frozenset([80, 443, 8080, 8443])
+
+
+def _seq_after(a, b):
+    '''TCP sequence number a is after b (modulo 2**32).'''
+    return 0 < ((a - b) & 0xffffffff) < 0x80000000
+
+def _tcp_options(mm, offset, length):
+    kinds = set()
+    end = offset + length
+    while offset < end:
+        kind, = struct.unpack_from('!B', mm, offset)
+        if kind == 0:
+            break
+        if kind == 1:
+            offset += 1
+            continue
+        if offset + 1 >= end:
+            break
+        size, = struct.unpack_from('!B', mm, offset + 1)
+        if size < 2:
+            break
+        if kind == TCPOPT_EXPERIMENTAL and size >= 4 and\
+            struct.unpack_from('!H', mm, offset + 2)[0] == TCPOPT_FASTOPEN_MAGIC:
+            kind = TCPOPT_FASTOPEN
+        kinds.add(kind)
+        offset += size
+    return kinds
+
+
+class _TlsDirection(object):
+    '''The first bytes of one direction of a connection, parsed as TLS
+    records and handshake messages until the caller has seen enough.'''
+
+    def __init__(self, seq):
+        self.next_seq = seq
+        self.skip = 0
+        self.records = bytearray()
+        self.handshake = bytearray()
+        self.done = False
+        self.not_tls = False
+
+    def feed(self, data, seq, ts, on_record, on_message):
+        if self.done or seq != self.next_seq:
+            return  # out of order; not worth reassembling for this
+        self.next_seq = (seq + len(data)) & 0xffffffff
+        if self.skip:
+            # the rest of a record that is not part of the handshake
+            skipped = min(self.skip, len(data))
+            self.skip -= skipped
+            data = data[skipped:]
+        self.records.extend(data)
+        while not self.done and len(self.records) >= 5:
+            kind = self.records[0]
+            if kind < 20 or kind > 24 or self.records[1] != 3:
+                self.not_tls = self.done = True
+                break
+            length = (self.records[3] << 8) | self.records[4]
+            if kind == TLS_HANDSHAKE:
+                if len(self.records) < 5 + length:
+                    break
+                self.handshake.extend(self.records[5:5 + length])
+                del self.records[:5 + length]
+                self._messages(ts, on_message)
+            else:
+                on_record(kind, ts)
+                available = min(len(self.records), 5 + length)
+                self.skip = 5 + length - available
+                del self.records[:available]
+        if not self.done and\
+            len(self.records) + len(self.handshake) > TLS_INSPECT_BYTES:
+            self.done = True
+        if self.done:
+            self.records = self.handshake = None
+
+    def _messages(self, ts, on_message):
+        while len(self.handshake) >= 4:
+            length = (self.handshake[1] << 16) | (self.handshake[2] << 8) | self.handshake[3]
+            if len(self.handshake) < 4 + length:
+                return
+            on_message(self.handshake[0], self.handshake[4:4 + length], ts)
+            del self.handshake[:4 + length]
+            if self.done:
+                return
+
+
+def _hello_extensions(body, server):
+    '''{extension type: data} of a Client/ServerHello body.'''
+    offset = 2 + 32  # version, random
+    offset += 1 + body[offset]  # session id
+    if server:
+        offset += 3  # cipher suite, compression method
+    else:
+        suites = (body[offset] << 8) | body[offset + 1]
+        offset += 2 + suites
+        offset += 1 + body[offset]
+    extensions = {}
+    if offset + 2 > len(body):
+        return extensions
+    end = offset + 2 + ((body[offset] << 8) | body[offset + 1])
+    offset += 2
+    while offset + 4 <= min(end, len(body)):
+        kind = (body[offset] << 8) | body[offset + 1]
+        length = (body[offset + 2] << 8) | body[offset + 3]
+        extensions[kind] = body[offset + 4:offset + 4 + length]
+        offset += 4 + length
+    return extensions
+
+
+class TcpConnection(object):
+    '''Transport metrics of one TCP connection, accumulated packet by packet
+    with constant memory (apart from the first few KB of a TLS handshake).
+
+    :param client: (packed address, port) of the side that opened the
+        connection
+    :param server: (packed address, port) of the other side
+    '''
+
+    def __init__(self, client, server):
+        self.client = client
+        self.server = server
+        self.syn_ts = None
+        self.syn_seq = None
+        self.syn_data = 0
+        self.tfo_cookie = False
+        self.handshake_rtt = None
+        self.tfo = False
+        self.first_ts = None
+        self.last_ts = None
+        self.closed = False
+        self._fin = {True: False, False: False}
+
+        # per direction (True = client to server): highest sequence number
+        # sent, bytes, unique bytes, retransmitted segments
+        self._max_end = {True: None, False: None}
+        self.bytes = {True: 0, False: 0}
+        self.unique_bytes = {True: 0, False: 0}
+        self.retransmissions = {True: 0, False: 0}
+        self._first_data_ts = {True: None, False: None}
+        self._last_data_ts = {True: None, False: None}
+
+        self._tls = {True: None, False: None}
+        self.is_tls = False
+        self.tls13 = False
+        self.tls_resumption_offered = False
+        self.client_random = None
+        self.tls_resumed = None
+        self._server_certificate = False
+        self._server_ccs_ts = None
+        self._client_data_ts = None
+
+    def packet(self, ts, upstream, flags, seq, ack, mm, payload_offset,\
+        payload_length, captured, options):
+        if self.first_ts is None:
+            self.first_ts = ts
+        self.last_ts = ts
+
+        if flags & TCP_SYN:
+            if upstream and not flags & TCP_ACK:
+                if self.syn_ts is None:
+                    self.syn_ts = ts
+                    self.syn_seq = seq
+                    self.syn_data = payload_length
+                    self.tfo_cookie = TCPOPT_FASTOPEN in options
+            elif not upstream and flags & TCP_ACK and self.syn_ts is not None\
+                and self.handshake_rtt is None:
+                self.handshake_rtt = ts - self.syn_ts
+                # the server took the data in our SYN (TCP fast open)
+                self.tfo = self.syn_data > 0 and\
+                    ack == (self.syn_seq + 1 + self.syn_data) & 0xffffffff
+            seq = (seq + 1) & 0xffffffff  # the SYN takes a sequence number
+            if self._tls[upstream] is None:
+                self._tls[upstream] = _TlsDirection(seq)
+        if flags & TCP_FIN:
+            self._fin[upstream] = True
+        self.closed = bool(flags & TCP_RST) or (self._fin[True] and self._fin[False])
+
+        if payload_length <= 0:
+            return
+        end = (seq + payload_length) & 0xffffffff
+        self.bytes[upstream] += payload_length
+        max_end = self._max_end[upstream]
+        if max_end is None or _seq_after(end, max_end):
+            if max_end is None or not _seq_after(seq, max_end):
+                new = payload_length if max_end is None else (end - max_end) & 0xffffffff
+            else:
+                new = payload_length  # a gap (lost before the capture point)
+            self.unique_bytes[upstream] += new
+            self._max_end[upstream] = end
+        else:
+            self.retransmissions[upstream] += 1
+        if self._first_data_ts[upstream] is None:
+            self._first_data_ts[upstream] = ts
+        self._last_data_ts[upstream] = ts
+
+        tls = self._tls[upstream]
+        if tls is None:
+            # no SYN in the capture; start at the first payload we see
+            tls = self._tls[upstream] = _TlsDirection(seq)
+        if not tls.done and captured > 0:
+            def on_record(kind, record_ts):
+                self._tls_record(upstream, kind, record_ts)
+            def on_message(kind, body, message_ts):
+                self._tls_message(upstream, kind, body, message_ts)
+            tls.feed(mm[payload_offset:payload_offset + captured], seq, ts,\
+                on_record, on_message)
+            if tls.not_tls:
+                # no TLS on this connection, stop looking the other way too
+                other = self._tls[not upstream] = _TlsDirection(0)
+                other.done = True
+
+    def _tls_record(self, upstream, kind, ts):
+        tls = self._tls[upstream]
+        if upstream:
+            if kind == TLS_APPLICATION_DATA and self._client_data_ts is None:
+                self._client_data_ts = ts
+                tls.done = True
+        elif kind == TLS_CHANGE_CIPHER_SPEC and self._server_ccs_ts is None:
+            self._server_ccs_ts = ts
+            if not self.tls13:
+                # a full handshake shows the certificate before switching
+                self.tls_resumed = not self._server_certificate
+            tls.done = True
+
+    def _tls_message(self, upstream, kind, body, ts):
+        try:
+            if upstream and kind == TLS_CLIENT_HELLO:
+                self.is_tls = True
+                # as in SSLKEYLOGFILE lines, to find the session's keys
+                self.client_random = binascii.hexlify(bytes(body[2:34])).decode('ascii')
+                # TLS 1.3 clients send a random session id either way, so
+                # only a ticket or a PSK shows a resumption attempt
+                extensions = _hello_extensions(body, False)
+                self.tls_resumption_offered =\
+                    len(extensions.get(TLS_EXT_SESSION_TICKET, b'')) > 0 or\
+                    TLS_EXT_PRE_SHARED_KEY in extensions
+            elif not upstream and kind == TLS_SERVER_HELLO:
+                self.is_tls = True
+                extensions = _hello_extensions(body, True)
+                version = extensions.get(TLS_EXT_SUPPORTED_VERSIONS)
+                if version and len(version) >= 2 and\
+                    ((version[0] << 8) | version[1]) == TLS_1_3:
+                    self.tls13 = True
+                    self.tls_resumed = TLS_EXT_PRE_SHARED_KEY in extensions
+                    self._tls[upstream].done = True
+            elif not upstream and kind == TLS_CERTIFICATE:
+                self._server_certificate = True
+        except IndexError:
+            logging.debug('Malformed TLS hello from %s:%d', _address(self.client[0]),\
+                self.client[1])
+
+    @property
+    def tls_false_start(self):
+        '''The client sent application data before the server's Finished in
+        a full TLS (<= 1.2) handshake.'''
+        return bool(self.is_tls and not self.tls13 and self.tls_resumed is False\
+            and self._client_data_ts is not None and self._server_ccs_ts is not None\
+            and self._client_data_ts < self._server_ccs_ts)
+
+    @property
+    def goodput(self):
+        '''Unique bytes from the server per second of its data transfer
+        (bits/s), None if there is too little data to tell.'''
+        start, end = self._first_data_ts[False], self._last_data_ts[False]
+        if start is None or end <= start:
+            return None
+        return self.unique_bytes[False] * 8 / (end - start)
+
+    def stats(self):
+        return {'client': '%s:%d' % (_address(self.client[0]), self.client[1]),
+                'server': '%s:%d' % (_address(self.server[0]), self.server[1]),
+                'start': self.first_ts, 'end': self.last_ts,
+                'handshake_rtt': self.handshake_rtt,
+                'tcp_fast_open_cookie': self.tfo_cookie,
+                'tcp_fast_open': self.tfo,
+                'tls': self.is_tls,
+                'tls13': self.tls13,
+                'tls_client_random': self.client_random,
+                'tls_session_resumption_offered': self.tls_resumption_offered,
+                'tls_session_resumption': bool(self.tls_resumed),
+                'tls_false_start': self.tls_false_start,
+                'bytes_sent': self.bytes[True], 'bytes_received': self.bytes[False],
+                'retransmissions_sent': self.retransmissions[True],
+                'retransmissions_received': self.retransmissions[False],
+                'goodput': self.goodput}
+
+
+def _address(raw):
+    if len(raw) == 4:
+        return '.'.join(str(b) for b in bytearray(raw))
+    words = struct.unpack('!8H', raw)
+    return ':'.join('%x' % w for w in words)
+
+def analyze(path):
+    '''Yield the :meth:`TcpConnection.stats` of every TCP connection in the
+    pcap at `path`, each as soon as the connection is closed (or at the end
+    of the file). Memory stays bounded by the number of open connections.
+    A compressed pcap (see :mod:`artifacts`) is read a few frames at a
+    time, an uncompressed one is mapped.'''
+    compressed = artifacts.is_compressed(path)
+    f = artifacts.open_artifact(path) if compressed else open(path, 'rb')
+    mm = None
+    try:
+        if compressed:
+            records = iter_file_records(f)
+        elif os.fstat(f.fileno()).st_size == 0:
+            return
+        else:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            records = iter_records(mm)
+        linktype = next(records, None)
+        if linktype is None:
+            return
+        if linktype not in LINK_HEADERS:
+            raise PcapError('Unsupported link type %d' % linktype)
+        type_offset, ip_offset = LINK_HEADERS[linktype]
+
+        connections = {}
+        for ts, buf, offset, caplen in records:
+            end = offset + caplen
+            ip = offset + ip_offset
+            if type_offset is not None:
+                if caplen < ip_offset:
+                    continue
+                ethertype, = struct.unpack_from('!H', buf, offset + type_offset)
+                if linktype == LINKTYPE_ETHERNET and ethertype == 0x8100:
+                    ethertype, = struct.unpack_from('!H', buf, offset + 16)
+                    ip += 4
+            else:
+                ethertype = None
+            if ip >= end:
+                continue
+            version = struct.unpack_from('!B', buf, ip)[0] >> 4
+            try:
+                if version == 4 and ethertype in (None, 0x0800, 2):
+                    ihl, total, fragment, proto, src, dst = IPV4.unpack_from(buf, ip)
+                    if proto != 6 or fragment & 0x1fff:
+                        continue
+                    tcp = ip + (ihl & 0xf) * 4
+                    # segmentation offload can leave the length 0 in outgoing frames
+                    ip_end = ip + total if total else end
+                    src, dst = struct.pack('!I', src), struct.pack('!I', dst)
+                elif version == 6:
+                    payload, proto, src, dst = IPV6.unpack_from(buf, ip)
+                    if proto != 6:
+                        continue  # extension headers are rare enough to skip
+                    tcp = ip + 40
+                    ip_end = tcp + payload
+                else:
+                    continue
+                sport, dport, seq, ack, data_offset, flags = TCP.unpack_from(buf, tcp)
+            except struct.error:
+                continue
+            tcp_length = (data_offset >> 4) * 4
+            payload_offset = tcp + tcp_length
+            payload_length = ip_end - payload_offset
+            captured = max(0, min(end, ip_end) - payload_offset)
+            options = _tcp_options(buf, tcp + 20, tcp_length - 20)\
+                if flags & TCP_SYN else ()
+
+            a, b = (src, sport), (dst, dport)
+            key = (a, b) if a < b else (b, a)
+            conn = connections.get(key)
+            if flags & TCP_SYN and not flags & TCP_ACK and conn is not None\
+                and (conn.closed or conn.syn_seq != seq):
+                # a new connection reusing the 4-tuple
+                yield conn.stats()
+                conn = None
+            if conn is None:
+                if flags & TCP_SYN:
+                    client = a if not flags & TCP_ACK else b
+                elif payload_length > 0:
+                    # started before the capture; guess who the server is
+                    if dport in SERVER_PORTS or (sport not in SERVER_PORTS and dport < sport):
+                        client = a
+                    else:
+                        client = b
+                else:
+                    continue  # stray ACKs and FINs of a connection we let go
+                conn = connections[key] = TcpConnection(client, b if client == a else a)
+            conn.packet(ts, a == conn.client, flags, seq, ack, buf,\
+                payload_offset, payload_length, captured, options)
+            if conn.closed:
+                yield conn.stats()
+                del connections[key]
+        for conn in connections.values():
+            yield conn.stats()
+    finally:
+        if mm is not None:
+            mm.close()
+        f.close()
+
+
+################################################################################
+#                                                                              #
+#   SUMMARIES                                                                  #
+#                                                                              #
+################################################################################
+
+def summarize(connections):
+    '''Fold the connections of one trial into :class:`loader.LoadResult`
+    fields (the three *_supported flags) plus a `transport` summary dict.'''
+    connections = list(connections)
+    rtts = [c['handshake_rtt'] for c in connections if c['handshake_rtt'] is not None]
+    goodputs = [c['goodput'] for c in connections if c['goodput']]
+    transport = {
+        'connections': len(connections),
+        'tls_connections': sum(1 for c in connections if c['tls']),
+        'median_handshake_rtt': float(numpy.median(rtts)) if rtts else None,
+        'bytes_sent': sum(c['bytes_sent'] for c in connections),
+        'bytes_received': sum(c['bytes_received'] for c in connections),
+        'retransmissions': sum(c['retransmissions_sent'] + c['retransmissions_received']\
+            for c in connections),
+        'max_goodput': max(goodputs) if goodputs else None,
+    }
+    return {'tcp_fast_open_supported': any(c['tcp_fast_open'] for c in connections),
+            'tls_false_start_supported': any(c['tls_false_start'] for c in connections),
+            'tls_session_resumption_supported':\
+                any(c['tls_session_resumption'] for c in connections),
+            'transport': transport}
+
+
+def _pcap_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                for name in sorted(names):
+                    if artifacts.has_suffix(name, '.pcap'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+def main():
+    # one JSON line per connection (or per file with --summary), streamed so
+    # arbitrarily large capture sets need no more memory than one file's
+    # open connections
+    for path in _pcap_paths(args.pcaps):
+        try:
+            if args.summary:
+                summary = summarize(analyze(path))
+                summary['pcap'] = path
+                print json.dumps(summary)
+            else:
+                for conn in analyze(path):
+                    conn['pcap'] = path
+                    print json.dumps(conn)
+        except (PcapError, IOError) as e:
+            logging.error('Error analyzing %s: %s', path, e)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Per-connection transport metrics from pcap files.')
+    parser.add_argument('pcaps', nargs='+', help='pcap files, or directories to search for them')
+    parser.add_argument('-s', '--summary', action='store_true', default=False, help='one line per file instead of per connection')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
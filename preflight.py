@@ -0,0 +1,333 @@
+#! /usr/bin/env python
+
+import os
+import json
+import time
+import socket
+import urlparse
+import logging
+import argparse
+import threading
+import requests
+from requests.packages.urllib3 import connectionpool
+from multiprocessing.pool import ThreadPool
+from timeouts import Timeout, TimeoutError
+
+# what the driver does with tests whose URL fails the check
+POLICIES = ('keep', 'drop', 'rewrite')
+# bodies up to this size are read, so their connection can be reused
+MAX_DRAIN_BYTES = 256 * 1024
+
+
+################################################################################
+#                                                                              #
+#   PREFLIGHT RESULTS                                                          #
+#                                                                              #
+################################################################################
+
+class PreflightResult(object):
+    '''The outcome of fetching a URL before loading it in a browser.
+
+    :param url: the URL checked
+    :param reachable: whether it answered with an HTTP response
+    :param final_url: the URL after redirects
+    :param status: the HTTP status of the final response
+    :param server: its Server header
+    :param error: why it was not reachable
+    :param checked_at: when it was checked (seconds since the epoch)
+    '''
+
+    FIELDS = ('url', 'reachable', 'final_url', 'status', 'server', 'error', 'checked_at')
+
+    def __init__(self, url, reachable=False, final_url=None, status=None, server=None,\
+        error=None, checked_at=None):
+        self._url = url
+        self._reachable = reachable
+        self._final_url = final_url
+        self._status = status
+        self._server = server
+        self._error = error
+        self._checked_at = checked_at if checked_at is not None else time.time()
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def reachable(self):
+        return self._reachable
+
+    @property
+    def final_url(self):
+        return self._final_url
+
+    @property
+    def status(self):
+        return self._status
+
+    @property
+    def server(self):
+        return self._server
+
+    @property
+    def error(self):
+        return self._error
+
+    @property
+    def checked_at(self):
+        return self._checked_at
+
+    @property
+    def scheme_supported(self):
+        '''Whether the page loads over the URL's own scheme (e.g., an HTTP URL
+        is not redirected to HTTPS).'''
+        return self._reachable and urlparse.urlparse(self._url).scheme ==\
+            urlparse.urlparse(self._final_url).scheme
+
+    @property
+    def redirected(self):
+        return self._reachable and self._final_url != self._url
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __str__(self):
+        return 'PreflightResult: %s' % json.dumps(self.to_dict(), sort_keys=True)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+################################################################################
+#                                                                              #
+#   PREFLIGHT                                                                  #
+#                                                                              #
+################################################################################
+
+# requests' timeout bounds each socket operation, not a whole request (a
+# server can trickle bytes); to give up on one at a deadline, its sockets
+# are shut down. The pools note the connections each thread takes.
+_fetching = threading.local()
+
+class _TrackingPool(object):
+    def _get_conn(self, timeout=None):
+        conn = super(_TrackingPool, self)._get_conn(timeout)
+        connections = getattr(_fetching, 'connections', None)
+        if connections is not None:
+            connections.append(conn)
+        return conn
+
+class _HTTPPool(_TrackingPool, connectionpool.HTTPConnectionPool):
+    pass
+
+class _HTTPSPool(_TrackingPool, connectionpool.HTTPSConnectionPool):
+    pass
+
+class _TrackingAdapter(requests.adapters.HTTPAdapter):
+    POOL_CLASSES = {'http': _HTTPPool, 'https': _HTTPSPool}
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TrackingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = self.POOL_CLASSES
+
+    def proxy_manager_for(self, *args, **kwargs):
+        manager = super(_TrackingAdapter, self).proxy_manager_for(*args, **kwargs)
+        manager.pool_classes_by_scheme = self.POOL_CLASSES
+        return manager
+
+def _shut_down(connections):
+    def cancel():
+        for conn in connections:
+            sock = getattr(conn, 'sock', None)
+            if sock:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+    return cancel
+
+
+class Preflight(object):
+    '''Checks many URLs at once: a bounded pool of threads sharing one
+    pooled requests session, so connections to a host are reused. Results
+    are cached for `ttl` seconds, in memory and, with `cache_path`, in a
+    JSON file kept across runs.
+
+    :param workers: number of concurrent requests
+    :param timeout: seconds to wait for a server (connect and each read); a
+        check gives up after `timeout` + 5 seconds in all
+    :param ttl: seconds a result stays valid
+    :param cache_path: file to load the cache from and save it to
+    :param user_agent: User-Agent header to send
+    :param proxy: host:port of an HTTP proxy to go through
+    '''
+
+    def __init__(self, workers=32, timeout=10, ttl=3600, cache_path=None,\
+        user_agent=None, proxy=None):
+        self._workers = workers
+        self._timeout = timeout
+        self._ttl = ttl
+        self._cache_path = cache_path
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        self._session = requests.Session()
+        adapter = _TrackingAdapter(pool_connections=workers, pool_maxsize=workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        requests.packages.urllib3.disable_warnings(\
+            requests.packages.urllib3.exceptions.InsecureRequestWarning)
+        if user_agent:
+            self._session.headers['User-Agent'] = user_agent
+        if proxy:
+            self._session.proxies = {'http': 'http://' + proxy, 'https': 'http://' + proxy}
+        if cache_path:
+            self._load_cache()
+
+    def _load_cache(self):
+        if not os.path.exists(self._cache_path):
+            return
+        try:
+            with open(self._cache_path, 'r') as f:
+                for entry in json.load(f):
+                    result = PreflightResult(**entry)
+                    self._cache[result.url] = result
+        except (IOError, ValueError, TypeError) as e:
+            logging.warning('Ignoring preflight cache %s: %s', self._cache_path, e)
+
+    def save_cache(self):
+        '''Write the valid results to `cache_path` (if given).'''
+        if not self._cache_path:
+            return
+        with self._lock:
+            entries = [r.to_dict() for r in self._cache.values() if self._valid(r)]
+        with open(self._cache_path + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.rename(self._cache_path + '.tmp', self._cache_path)
+
+    def _valid(self, result):
+        return time.time() - result.checked_at < self._ttl
+
+    def cached(self, url):
+        '''The cached result for `url`, None if there is none (or it expired).'''
+        with self._lock:
+            result = self._cache.get(url)
+        return result if result and self._valid(result) else None
+
+    def _fetch(self, url):
+        _fetching.connections = []
+        try:
+            with Timeout(self._timeout + 5, 'Timeout checking %s' % url) as timeout:
+                timeout.guard(_shut_down(_fetching.connections))
+                # the headers are all we need; a small body is read anyway, so
+                # the connection goes back to the pool
+                # we check reachability, not certificates (the browser may
+                # ignore certificate errors); per request, or REQUESTS_CA_BUNDLE wins
+                response = self._session.get(url, timeout=self._timeout, stream=True,\
+                    verify=False)
+                length = response.headers.get('Content-Length', '')
+                if length.isdigit() and int(length) <= MAX_DRAIN_BYTES:
+                    response.content
+                response.close()
+        except (requests.exceptions.RequestException, TimeoutError) as e:
+            logging.debug('Could not fetch %s: %s', url, e)
+            return PreflightResult(url, error='%s: %s' % (e.__class__.__name__, e))
+        finally:
+            _fetching.connections = None
+        return PreflightResult(url, True, response.url, response.status_code,\
+            response.headers.get('Server'))
+
+    def check(self, url):
+        '''Check one URL (or return its cached result).'''
+        result = self.cached(url)
+        if result is None:
+            result = self._fetch(url)
+            with self._lock:
+                self._cache[url] = result
+        return result
+
+    def check_all(self, urls):
+        '''Check `urls` concurrently; returns a dict mapping each to its
+        :class:`PreflightResult`.'''
+        results = {}
+        pending = []
+        for url in set(urls):
+            result = self.cached(url)
+            if result is None:
+                pending.append(url)
+            else:
+                results[url] = result
+        if pending:
+            logging.info('Preflight: checking %d URLs (%d cached)', len(pending), len(results))
+            pool = ThreadPool(min(self._workers, len(pending)))
+            try:
+                for result in pool.imap_unordered(self.check, pending):
+                    results[result.url] = result
+            finally:
+                pool.close()
+                pool.join()
+        return results
+
+
+def apply_policy(tests, results, policy):
+    '''Split `tests` (dicts with a `url`) by their preflight `results`:
+    'keep' keeps them all; 'drop' drops those whose URL is unreachable or
+    loads over another scheme; 'rewrite' drops the unreachable ones and
+    points the redirected ones to where they end up. Returns the tests to
+    run and the dropped ones.'''
+    if policy not in POLICIES:
+        raise ValueError('Unknown preflight policy %s' % policy)
+    kept, dropped = [], []
+    for test in tests:
+        result = results.get(test['url'])
+        if result is None or policy == 'keep':
+            kept.append(test)
+        elif not result.reachable:
+            dropped.append(test)
+        elif policy == 'rewrite' and result.redirected:
+            logging.info('Preflight: %s redirects to %s', test['url'], result.final_url)
+            test = dict(test, url=result.final_url, preflight_url=test['url'])
+            kept.append(test)
+        elif policy == 'drop' and not result.scheme_supported:
+            dropped.append(test)
+        else:
+            kept.append(test)
+    return kept, dropped
+
+
+
+def main():
+    if args.urls.endswith('.json'):
+        with open(args.urls, 'r') as f:
+            urls = [test['url'] for test in json.load(f)['tests']]
+    else:
+        with open(args.urls, 'r') as f:
+            urls = [line.strip() for line in f if line.strip()]
+    preflight = Preflight(args.workers, args.timeout, args.ttl, args.cache)
+    start = time.time()
+    results = preflight.check_all(urls)
+    logging.info('Checked %d URLs in %.1f s', len(results), time.time() - start)
+    preflight.save_cache()
+    for url in urls:
+        result = results[url]
+        print json.dumps(dict(result.to_dict(), scheme_supported=result.scheme_supported),\
+            sort_keys=True)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Check that URLs are reachable (and over which scheme) before loading them.')
+    parser.add_argument('urls', help='a tests.json, or a file with one URL per line')
+    parser.add_argument('-w', '--workers', type=int, default=32, help='concurrent requests')
+    parser.add_argument('-t', '--timeout', type=float, default=10, help='seconds to wait for a server')
+    parser.add_argument('-l', '--ttl', type=float, default=3600, help='seconds a cached result stays valid')
+    parser.add_argument('-c', '--cache', help='JSON file to cache results in')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
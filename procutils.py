@@ -0,0 +1,252 @@
+import os
+import errno
+import signal
+import logging
+import tempfile
+import subprocess
+from time import sleep, time
+
+
+################################################################################
+#                                                                              #
+#   /proc HELPERS (Linux only; everything degrades to empty/zero elsewhere)    #
+#                                                                              #
+################################################################################
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+# the process that imported us first; workers are forked from it, so they all
+# see the pid of the test driver here
+DRIVER_PID = os.getpid()
+
+PIDFILE_DIR = os.path.join(tempfile.gettempdir(), 'webloader-pids-%d' % os.getuid())
+
+def _parent_map():
+    '''Map every visible pid to its parent pid.'''
+    parents = {}
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return parents
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid, 'r') as f:
+                stat = f.read()
+            # the command name may contain spaces; fields after it are fixed
+            parents[pid] = int(stat.rsplit(')', 1)[1].split()[1])
+        except (IOError, OSError, IndexError, ValueError):
+            continue
+    return parents
+
+def start_time(pid):
+    '''Start time of a process (in clock ticks since boot), used together with
+    the pid to make sure a pidfile still refers to the same process.
+    Returns None if the process does not exist.'''
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+def descendants(pid):
+    '''All (transitive) child pids of `pid`.'''
+    children = {}
+    for child, parent in _parent_map().items():
+        children.setdefault(parent, []).append(child)
+    found = []
+    stack = list(children.get(pid, []))
+    while stack:
+        child = stack.pop()
+        found.append(child)
+        stack.extend(children.get(child, []))
+    return found
+
+def process_tree(pids):
+    '''The given pids plus all of their descendants.'''
+    tree = set()
+    for pid in pids:
+        tree.add(pid)
+        tree.update(descendants(pid))
+    return tree
+
+def rss_bytes(pid):
+    '''Resident set size of one process, 0 if it is gone.'''
+    try:
+        with open('/proc/%d/statm' % pid, 'r') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        return 0
+
+def num_fds(pid):
+    '''Number of open file descriptors of one process, 0 if unknown.'''
+    try:
+        return len(os.listdir('/proc/%d/fd' % pid))
+    except OSError:
+        return 0
+
+def _socket_inodes(pid):
+    inodes = set()
+    try:
+        fds = os.listdir('/proc/%d/fd' % pid)
+    except OSError:
+        return inodes
+    for fd in fds:
+        try:
+            target = os.readlink('/proc/%d/fd/%s' % (pid, fd))
+        except OSError:
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[8:-1])
+    return inodes
+
+def socket_ports(pids):
+    '''Local TCP/UDP ports of all sockets held by the process trees rooted at
+    `pids` (e.g., to tell a browser's packets from everybody else's).'''
+    inodes = set()
+    for pid in process_tree(pids):
+        inodes.update(_socket_inodes(pid))
+    ports = set()
+    if not inodes:
+        return ports
+    for table in ('tcp', 'tcp6', 'udp', 'udp6'):
+        try:
+            with open('/proc/net/%s' % table, 'r') as f:
+                next(f)  # header
+                for line in f:
+                    fields = line.split()
+                    if fields[9] in inodes:
+                        ports.add(int(fields[1].rsplit(':', 1)[1], 16))
+        except (IOError, OSError, IndexError, ValueError, StopIteration):
+            continue
+    return ports
+
+def tree_usage(pids):
+    '''Summed resource usage of the process trees rooted at `pids`.
+
+    Returns a dict with 'rss_mb', 'fds' and 'children'.'''
+    tree = process_tree(pids)
+    usage = {'rss_mb': sum(rss_bytes(p) for p in tree) / (1024.0 * 1024.0),
+             'fds': sum(num_fds(p) for p in tree),
+             'children': len(tree) - len(pids)}
+    logging.debug('Process tree usage of %s: %s', pids, usage)
+    return usage
+
+
+################################################################################
+#                                                                              #
+#   PROCESS GROUPS, REAPING AND PIDFILES                                       #
+#                                                                              #
+################################################################################
+
+def _pidfile_path(name):
+    return os.path.join(PIDFILE_DIR, '%d-%s.pid' % (DRIVER_PID, name))
+
+def register(name, pid):
+    '''Write a pidfile for `pid` so a later run can clean it up if we die
+    without tearing it down (e.g., SIGKILL).'''
+    try:
+        if not os.path.isdir(PIDFILE_DIR):
+            os.makedirs(PIDFILE_DIR)
+        with open(_pidfile_path(name), 'w') as f:
+            f.write('%d %s %d %s\n' % (pid, start_time(pid), DRIVER_PID,\
+                start_time(DRIVER_PID)))
+    except (IOError, OSError) as e:
+        logging.warning('Error writing pidfile for %s: %s', name, e)
+
+def unregister(name):
+    try:
+        os.remove(_pidfile_path(name))
+    except OSError:
+        pass
+
+def spawn(name, cmd, **kwargs):
+    '''Popen `cmd` as the leader of a new session (and so process group) and
+    register it. Everything it forks can then be killed as one group.'''
+    proc = subprocess.Popen(cmd, preexec_fn=os.setsid, **kwargs)
+    register(name, proc.pid)
+    return proc
+
+def _signal(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+def _alive(pids):
+    alive = []
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid, 'r') as f:
+                # zombies are dead, just not waited for yet
+                if f.read().rsplit(')', 1)[1].split()[0] != 'Z':
+                    alive.append(pid)
+        except (IOError, OSError, IndexError):
+            continue
+    return alive
+
+def kill_tree(pid, grace=3):
+    '''SIGTERM `pid`, its process group (if it leads one) and every
+    descendant, then SIGKILL whatever is still alive after `grace` seconds.'''
+    # collect the tree first; once the root dies its children get reparented
+    tree = process_tree([pid])
+    try:
+        if os.getpgid(pid) == pid:
+            os.killpg(pid, signal.SIGTERM)
+    except OSError:
+        pass
+    for p in tree:
+        _signal(p, signal.SIGTERM)
+
+    deadline = time() + grace
+    while _alive(tree) and time() < deadline:
+        sleep(0.1)
+    survivors = _alive(tree)
+    if survivors:
+        logging.debug('SIGKILLing processes %s', survivors)
+        try:
+            if os.getpgid(pid) == pid:
+                os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for p in survivors:
+            _signal(p, signal.SIGKILL)
+
+def reap(name, proc, grace=3):
+    '''Kill a process started with :func:`spawn` with its whole tree, wait
+    for it and drop its pidfile.'''
+    if proc.poll() is None:
+        kill_tree(proc.pid, grace)
+    else:
+        # the leader is gone, but its group may not be
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    proc.wait()
+    unregister(name)
+
+def sweep():
+    '''Kill leftovers of earlier runs whose driver is gone (crashed or was
+    SIGKILLed), as recorded by their pidfiles.'''
+    try:
+        pidfiles = os.listdir(PIDFILE_DIR)
+    except OSError:
+        return
+    for pidfile in pidfiles:
+        path = os.path.join(PIDFILE_DIR, pidfile)
+        try:
+            with open(path, 'r') as f:
+                pid, started, driver, driver_started = f.read().split()
+        except (IOError, OSError, ValueError):
+            continue
+        if str(start_time(int(driver))) == driver_started:
+            continue  # that run is still going
+        if str(start_time(int(pid))) == started:
+            logging.warning('Killing orphan process %s left by an earlier run (%s)',\
+                pid, pidfile)
+            kill_tree(int(pid))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
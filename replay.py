@@ -0,0 +1,401 @@
+#! /usr/bin/env python
+
+import os
+import ssl
+import time
+import uuid
+import signal
+import socket
+import struct
+import httplib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import urlparse
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime
+
+OPENSSL = '/usr/bin/env openssl'
+CERT_DIR = os.path.join(tempfile.gettempdir(), 'webloader-replay-%d' % os.getuid())
+UPSTREAM_TIMEOUT = 30
+
+# never forwarded, recorded or replayed; they describe one hop, not the resource
+HOP_BY_HOP_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-authenticate',\
+    'proxy-authorization', 'proxy-connection', 'te', 'trailer', 'transfer-encoding',\
+    'upgrade', 'content-length'])
+
+
+################################################################################
+#                                                                              #
+#   ARCHIVE                                                                    #
+#                                                                              #
+################################################################################
+
+class ArchiveError(Exception):
+    pass
+
+def _strip_query(url):
+    return url.split('?', 1)[0]
+
+def _parse_headers(lines):
+    headers = []
+    for line in lines:
+        name, _, value = line.partition(':')
+        headers.append((name.strip(), value.strip()))
+    return headers
+
+
+class Archive(object):
+    '''HTTP exchanges in a WARC-style file: a request and a response record
+    per exchange, each a block of WARC headers followed by the raw HTTP
+    message. The response records carry the method and the recorded timings
+    in extra WebLoader-* fields.
+
+    Only the first response for each (method, URL) is kept, so replays are
+    deterministic. Records are located by an index of offsets built when the
+    archive is opened; bodies are only read when served.
+
+    :param path: the archive file; created when recording
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = None
+        # (method, url) -> (offset, length, wait, receive)
+        self._index = {}
+        # (method, url without query) -> first (method, url) recorded
+        self._by_path = {}
+        if os.path.exists(path):
+            self._load_index()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _add(self, method, url, offset, length, wait, receive):
+        key = (method, url)
+        if key not in self._index:
+            self._index[key] = (offset, length, wait, receive)
+            self._by_path.setdefault((method, _strip_query(url)), key)
+
+    def _load_index(self):
+        with open(self._path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                if not line.startswith('WARC/'):
+                    raise ArchiveError('No WARC record at offset %d of %s' % (offset, self._path))
+                header_lines = []
+                for line in iter(f.readline, ''):
+                    if not line.strip():
+                        break
+                    header_lines.append(line)
+                headers = dict((k.lower(), v) for k, v in _parse_headers(header_lines))
+                length = int(headers['content-length'])
+                block = f.tell()
+                f.seek(length, os.SEEK_CUR)
+                if headers.get('warc-type') == 'response':
+                    self._add(headers.get('webloader-method', 'GET'),\
+                        headers['warc-target-uri'], block, length,\
+                        float(headers.get('webloader-wait', 0)),\
+                        float(headers.get('webloader-receive', 0)))
+        logging.debug('Indexed %d responses in %s', len(self._index), self._path)
+
+    def _write_record(self, kind, url, block, extra=()):
+        fields = [('WARC-Type', kind),
+                  ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+                  ('WARC-Date', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+                  ('WARC-Target-URI', url),
+                  ('Content-Type', 'application/http;msgtype=%s' % kind),
+                  ('Content-Length', str(len(block)))] + list(extra)
+        self._file.write('WARC/1.0\r\n')
+        for name, value in fields:
+            self._file.write('%s: %s\r\n' % (name, value))
+        self._file.write('\r\n')
+        offset = self._file.tell()
+        self._file.write(block)
+        self._file.write('\r\n\r\n')
+        return offset
+
+    def record(self, method, url, request_headers, request_body, status, reason,\
+        headers, body, wait, receive):
+        '''Store one exchange (unless the URL was recorded before).'''
+        with self._lock:
+            if (method, url) in self._index:
+                return
+            if not self._file:
+                self._file = open(self._path, 'ab')
+            parsed = urlparse.urlsplit(url)
+            target = urlparse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+            request = '%s %s HTTP/1.1\r\n' % (method, target) +\
+                ''.join('%s: %s\r\n' % h for h in request_headers) + '\r\n' + request_body
+            self._write_record('request', url, request)
+            response = 'HTTP/1.1 %d %s\r\n' % (status, reason) +\
+                ''.join('%s: %s\r\n' % h for h in headers) + '\r\n' + body
+            offset = self._write_record('response', url, response,\
+                [('WebLoader-Method', method), ('WebLoader-Wait', '%.6f' % wait),\
+                 ('WebLoader-Receive', '%.6f' % receive)])
+            self._file.flush()
+            self._add(method, url, offset, len(response), wait, receive)
+
+    def lookup(self, method, url):
+        '''The recorded response to `method` `url` as (status, reason,
+        headers, body, wait, receive), or None. If the exact URL was not
+        recorded, the first response for the same URL with a different
+        query string is used (e.g., for cache busters).'''
+        key = (method, url)
+        if key not in self._index:
+            key = self._by_path.get((method, _strip_query(url)))
+            if key is None:
+                return None
+        offset, length, wait, receive = self._index[key]
+        with open(self._path, 'rb') as f:
+            f.seek(offset)
+            message = f.read(length)
+        head, _, body = message.partition('\r\n\r\n')
+        lines = head.split('\r\n')
+        _, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+        return int(status), reason, _parse_headers(lines[1:]), body, wait, receive
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+################################################################################
+#                                                                              #
+#   PROXY                                                                      #
+#                                                                              #
+################################################################################
+
+def make_certificate(cert_dir=CERT_DIR):
+    '''A self-signed certificate for the HTTPS side of the proxy, made once
+    per user. Browsers must ignore certificate errors to accept it.'''
+    cert = os.path.join(cert_dir, 'cert.pem')
+    key = os.path.join(cert_dir, 'key.pem')
+    if not os.path.exists(cert):
+        if not os.path.isdir(cert_dir):
+            os.makedirs(cert_dir)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(OPENSSL.split() + ['req', '-x509', '-newkey',\
+                'rsa:2048', '-nodes', '-days', '3650', '-subj', '/CN=webloader-replay',\
+                '-keyout', key, '-out', cert], stdout=devnull, stderr=devnull)
+    return cert, key
+
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Records exchanges passing through to the origin, or replays them from
+    the archive. HTTPS is intercepted: CONNECT tunnels are terminated here.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    # set for requests inside a CONNECT tunnel: 'host:port' of the origin
+    origin = None
+
+    def log_message(self, format, *args):
+        logging.debug('%s - %s', self.client_address[0], format % args)
+
+    def _url(self):
+        if self.origin:
+            host, _, port = self.origin.partition(':')
+            netloc = host if port in ('', '443') else self.origin
+            return 'https://%s%s' % (netloc, self.path)
+        if '://' not in self.path:
+            return None
+        return self.path
+
+    def do_CONNECT(self):
+        self.send_response(200, 'Connection Established')
+        self.end_headers()
+        try:
+            tunnel = self.server.ssl_context.wrap_socket(self.connection, server_side=True)
+        except (ssl.SSLError, socket.error) as e:
+            logging.debug('TLS handshake for %s failed: %s', self.path, e)
+            self.close_connection = 1
+            return
+        _TunnelHandler(tunnel, self.client_address, self.server, self.path)
+        self.close_connection = 1
+
+    def _send(self, status, reason, headers, body, receive=0):
+        # not send_response(): recorded responses bring their own Date and Server
+        self.log_request(status)
+        self.wfile.write('%s %d %s\r\n' % (self.protocol_version, status, reason))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'HEAD' or not body:
+            return
+        if receive <= 0:
+            self.wfile.write(body)
+            return
+        # spread the body over the recorded transfer time
+        chunks = 10
+        size = len(body) // chunks + 1
+        for i in range(0, len(body), size):
+            self.wfile.write(body[i:i + size])
+            self.wfile.flush()
+            time.sleep(receive / chunks)
+
+    def _record(self, url, body):
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme == 'https':
+            conn = httplib.HTTPSConnection(parsed.netloc, timeout=UPSTREAM_TIMEOUT,\
+                context=ssl._create_unverified_context())
+        else:
+            conn = httplib.HTTPConnection(parsed.netloc, timeout=UPSTREAM_TIMEOUT)
+        target = urlparse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+        request_headers = [(k, v) for k, v in self.headers.items()\
+            if k.lower() not in HOP_BY_HOP_HEADERS]
+        try:
+            start = time.time()
+            conn.request(self.command, target, body, dict(request_headers))
+            response = conn.getresponse()
+            wait = time.time() - start
+            data = response.read()  # chunked encoding is undone here
+            receive = time.time() - start - wait
+        except (httplib.HTTPException, socket.error, ssl.SSLError) as e:
+            logging.warning('Error fetching %s: %s', url, e)
+            self._send(502, 'Bad Gateway', [], '')
+            return
+        finally:
+            conn.close()
+        headers = [(k, v) for k, v in response.getheaders()\
+            if k.lower() not in HOP_BY_HOP_HEADERS]
+        self.server.archive.record(self.command, url, request_headers, body,\
+            response.status, response.reason, headers, data, wait, receive)
+        self._send(response.status, response.reason, headers, data)
+
+    def _replay(self, url):
+        entry = self.server.archive.lookup(self.command, url)
+        if entry is None:
+            logging.info('Not in archive: %s %s', self.command, url)
+            self.server.misses += 1
+            self._send(404, 'Not Found', [], '')
+            return
+        status, reason, headers, body, wait, receive = entry
+        if not self.server.use_timings:
+            wait = receive = 0
+        time.sleep(wait + self.server.latency_ms / 1000.0)
+        self._send(status, reason, headers, body, receive)
+
+    def _handle(self):
+        url = self._url()
+        if not url:
+            self._send(400, 'Bad Request', [], '')
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        if self.server.mode == 'record':
+            self._record(url, body)
+        else:
+            self._replay(url)
+
+    do_GET = do_POST = do_HEAD = do_PUT = do_DELETE = do_OPTIONS = do_PATCH = _handle
+
+
+class _TunnelHandler(ProxyHandler):
+    '''Handles the requests inside one CONNECT tunnel.'''
+
+    def __init__(self, request, client_address, server, origin):
+        self.origin = origin
+        ProxyHandler.__init__(self, request, client_address, server)
+
+
+class ReplayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''A record/replay HTTP(S) proxy.
+
+    :param address: (host, port) to listen on
+    :param archive: an :class:`Archive`
+    :param mode: 'record' (fetch from the origin and store) or 'replay'
+        (serve from the archive; anything not in it gets a 404)
+    :param latency_ms: extra delay before every replayed response
+    :param use_timings: replay the recorded server wait and transfer times
+    :param allowed: networks ('a.b.c.d/n') clients may connect from (None:
+        any); it forwards anywhere, so keep it from being an open proxy
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, archive, mode='replay', latency_ms=0, use_timings=True,\
+        allowed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ProxyHandler)
+        self.allowed = [_parse_network(n) for n in allowed] if allowed else None
+        self.archive = archive
+        self.mode = mode
+        self.latency_ms = latency_ms
+        self.use_timings = use_timings
+        self.misses = 0
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.ssl_context.load_cert_chain(*make_certificate())
+
+    def verify_request(self, _, client_address):
+        if self.allowed is None:
+            return True
+        address = _ip_to_int(client_address[0])
+        if any(address & mask == network for network, mask in self.allowed):
+            return True
+        logging.warning('Refusing client %s', client_address[0])
+        return False
+
+def _ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+def _parse_network(network):
+    address, _, bits = network.partition('/')
+    mask = (0xffffffff << (32 - int(bits or 32))) & 0xffffffff
+    return _ip_to_int(address) & mask, mask
+
+
+
+def main():
+    archive = Archive(args.archive)
+    server = ReplayServer((args.address, args.port), archive, args.mode,\
+        args.latency, not args.no_timings, args.allow)
+
+    def stop(_, __):
+        raise KeyboardInterrupt('To be killed')
+    signal.signal(signal.SIGTERM, stop)
+
+    logging.info('%s proxy on %s:%d (%d responses in %s)', args.mode.capitalize(),\
+        args.address, args.port, len(archive), args.archive)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        archive.close()
+        logging.info('%d responses in archive, %d requests not found', len(archive),\
+            server.misses)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Record pages into an archive, or replay them from it, through an HTTP(S) proxy.')
+    parser.add_argument('mode', choices=('record', 'replay'), help='record from the live network or replay the archive')
+    parser.add_argument('archive', help='archive file (WARC-style)')
+    parser.add_argument('-a', '--address', default='127.0.0.1', help='address to listen on (network namespaces reach the host on their veth address, so use 0.0.0.0 with --allow for them)')
+    parser.add_argument('-A', '--allow', action='append', help='only accept clients from this network (a.b.c.d/n); repeat for more')
+    parser.add_argument('-p', '--port', type=int, default=8990, help='port to listen on')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='extra delay before each replayed response (ms)')
+    parser.add_argument('-n', '--no_timings', action='store_true', default=False, help='do not replay the recorded server and transfer times')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import numpy
+from loader import LoadResult
+
+BATCH_PREFIX = 'batch-'
+RUNS_FILE = 'runs.json'
+
+
+################################################################################
+#                                                                              #
+#   SCHEMA                                                                     #
+#                                                                              #
+################################################################################
+
+STRING, FLOAT, BOOL, INT = 'string', 'float', 'bool', 'int'
+
+TRANSPORT_FIELDS = ('connections', 'tls_connections', 'median_handshake_rtt',\
+    'bytes_sent', 'bytes_received', 'retransmissions', 'max_goodput')
+
+# the phases a Loader times per trial (see LoadResult.phases)
+PHASES = ('network_profile', 'preload', 'capture_start', 'page_load', 'screenshot',\
+    'capture_stop', 'capture_analysis', 'reset', 'restart', 'tab_wait')
+
+def _transport(name):
+    return lambda r: (r.transport or {}).get(name)
+
+def _profile(name):
+    return lambda r: (r.network_profile or {}).get(name)
+
+def _phase(name):
+    return lambda r: (r.phases or {}).get(name)
+
+# one column per field of LoadResult that is worth comparing (not `raw`);
+# the transport, network profile and phases dicts are flattened. Columns may
+# be added at the end: older batches read as missing values for them
+COLUMNS = [
+    ('status', STRING, lambda r: r.status),
+    ('url', STRING, lambda r: r.url),
+    ('final_url', STRING, lambda r: r.final_url),
+    ('server', STRING, lambda r: r.server),
+    ('time', FLOAT, lambda r: r.time),
+    ('size', FLOAT, lambda r: r.size),
+    ('dom_content_loaded', FLOAT, lambda r: r.dom_content_loaded),
+    ('first_contentful_paint', FLOAT, lambda r: r.first_contentful_paint),
+    ('har_path', STRING, lambda r: r.har_path),
+    ('image_path', STRING, lambda r: r.image_path),
+    ('tcp_fast_open_supported', BOOL, lambda r: r.tcp_fast_open_supported),
+    ('tls_false_start_supported', BOOL, lambda r: r.tls_false_start_supported),
+    ('tls_session_resumption_supported', BOOL,\
+        lambda r: r.tls_session_resumption_supported),
+    ('recycle_reason', STRING, lambda r: r.recycle_reason),
+    ('network_profile', STRING, _profile('name')),
+    ('network_method', STRING, _profile('method')),
+] + [('transport_' + name, FLOAT, _transport(name)) for name in TRANSPORT_FIELDS] +\
+    [('phase_' + name, FLOAT, _phase(name)) for name in PHASES]
+
+COLUMN_KINDS = dict((name, kind) for name, kind, _ in COLUMNS)
+COLUMN_KINDS['run'] = INT
+FIELDS = ['run'] + [name for name, _, _ in COLUMNS]
+
+class ResultStoreError(Exception):
+    pass
+
+
+################################################################################
+#                                                                              #
+#   RESULT STORE                                                               #
+#                                                                              #
+################################################################################
+
+class ResultStore(object):
+    '''A directory of :class:`LoadResult` fields, stored by column.
+
+    Results are appended in batches; each batch is a directory with one .npy
+    file per column (strings are dictionary encoded: int32 codes into a JSON
+    list of values, -1 for None) that is renamed into place once complete,
+    so readers never see half a batch. Numbers use NaN for missing values.
+    `runs.json` lists the runs with their metadata (start time, host and
+    whatever the caller adds, e.g. the test settings); every row records
+    the run it belongs to.
+
+    Reading a field is a concatenation of its .npy files, so the results of
+    millions of loads load in seconds -- no HARs are parsed.
+
+    :param path: the store's directory (created if needed)
+    :param batch_size: rows to buffer before writing a batch
+    '''
+
+    def __init__(self, path, batch_size=10000):
+        self._path = path
+        self._batch_size = batch_size
+        self._rows = []
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def path(self):
+        return self._path
+
+    ##
+    ## Runs
+    ##
+
+    def runs(self):
+        '''The metadata of all runs in the store, in order (run ids are
+        indexes into this list).'''
+        runs_path = os.path.join(self._path, RUNS_FILE)
+        if not os.path.exists(runs_path):
+            return []
+        with open(runs_path, 'r') as f:
+            return json.load(f)
+
+    def start_run(self, **metadata):
+        '''Record a new run and return its id, for :meth:`append`.'''
+        runs = self.runs()
+        run = dict(metadata, id=len(runs), start=time.time(),\
+            host=socket.gethostname())
+        runs.append(run)
+        self._write_json(os.path.join(self._path, RUNS_FILE), runs)
+        return run['id']
+
+    ##
+    ## Writing
+    ##
+
+    def append(self, result, run):
+        '''Add a :class:`LoadResult` of run `run`.'''
+        self._rows.append([run] + [get(result) for _, _, get in COLUMNS])
+        if len(self._rows) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        '''Write the buffered rows as a new batch.'''
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        batch = os.path.join(self._path, '%s%06d' % (BATCH_PREFIX, len(self._batches())))
+        tmp = batch + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        columns = zip(*rows)
+        for field, values in zip(FIELDS, columns):
+            kind = COLUMN_KINDS[field]
+            if kind == STRING:
+                vocab = {}
+                codes = numpy.array([-1 if v is None else vocab.setdefault(v, len(vocab))\
+                    for v in values], dtype=numpy.int32)
+                self._write_json(os.path.join(tmp, field + '.json'),\
+                    sorted(vocab, key=vocab.get))
+                numpy.save(os.path.join(tmp, field + '.npy'), codes)
+            elif kind == FLOAT:
+                numpy.save(os.path.join(tmp, field + '.npy'), numpy.array(\
+                    [numpy.nan if v is None else v for v in values], dtype=numpy.float64))
+            elif kind == BOOL:
+                numpy.save(os.path.join(tmp, field + '.npy'),\
+                    numpy.array([bool(v) for v in values], dtype=numpy.bool_))
+            else:
+                numpy.save(os.path.join(tmp, field + '.npy'),\
+                    numpy.array(values, dtype=numpy.int32))
+        self._write_json(os.path.join(tmp, 'meta.json'),\
+            {'rows': len(rows), 'columns': FIELDS})
+        os.rename(tmp, batch)
+        logging.debug('Wrote %d results to %s', len(rows), batch)
+
+    def close(self):
+        self.flush()
+
+    def _write_json(self, path, data):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    ##
+    ## Reading
+    ##
+
+    def _batches(self):
+        return sorted(os.path.join(self._path, name) for name in os.listdir(self._path)\
+            if name.startswith(BATCH_PREFIX) and not name.endswith('.tmp'))
+
+    def _read_batch(self, batch, field, rows):
+        # (values, vocab): codes and their strings for string columns
+        kind = COLUMN_KINDS.get(field)
+        if kind is None:
+            raise ResultStoreError('Unknown field %s' % field)
+        npy = os.path.join(batch, field + '.npy')
+        if not os.path.exists(npy):
+            # a column added after this batch was written
+            if kind == STRING:
+                return numpy.full(rows, -1, dtype=numpy.int32), []
+            if kind == FLOAT:
+                return numpy.full(rows, numpy.nan), None
+            return numpy.zeros(rows, dtype=numpy.bool_ if kind == BOOL else numpy.int32), None
+        values = numpy.load(npy)
+        vocab = None
+        if kind == STRING:
+            with open(os.path.join(batch, field + '.json'), 'r') as f:
+                vocab = json.load(f)
+        return values, vocab
+
+    def categories(self, field, run=None):
+        '''Read string column `field` as (codes, labels): an int array of
+        indexes into the object array `labels`, or -1 for None. Handy for
+        grouping without comparing strings.'''
+        if COLUMN_KINDS.get(field) != STRING:
+            raise ResultStoreError('%s is not a string field' % field)
+        labels = {}
+        parts = []
+        for batch, rows in self._batch_rows():
+            codes, vocab = self._read_batch(batch, field, rows)
+            # map this batch's codes onto the store-wide labels; the extra
+            # last entry takes the -1s
+            remap = numpy.array([labels.setdefault(v, len(labels)) for v in vocab] + [-1],\
+                dtype=numpy.int32)
+            parts.append(remap[codes])
+        codes = numpy.concatenate(parts) if parts else numpy.zeros(0, dtype=numpy.int32)
+        label_array = numpy.empty(len(labels), dtype=object)
+        for label, code in labels.items():
+            label_array[code] = label
+        if run is not None:
+            codes = codes[self._run_mask(run)]
+        return codes, label_array
+
+    def column(self, field, run=None):
+        '''All values of `field` as a numpy array: float64 (NaN if missing),
+        bool, int32 (`run`) or object (strings, None if missing). `run` is
+        a run id or a list of them.'''
+        if COLUMN_KINDS.get(field) == STRING:
+            codes, labels = self.categories(field, run)
+            return numpy.append(labels, None)[codes]
+        parts = [self._read_batch(batch, field, rows)[0] for batch, rows in self._batch_rows()]
+        if not parts:
+            return numpy.zeros(0, dtype=numpy.float64)
+        values = numpy.concatenate(parts)
+        if run is not None:
+            values = values[self._run_mask(run)]
+        return values
+
+    def load(self, fields=None, run=None):
+        '''A dict mapping each of `fields` (default: all) to its
+        :meth:`column`.'''
+        return dict((field, self.column(field, run)) for field in (fields or FIELDS))
+
+    def by_url(self, field, run=None, successful_only=True):
+        '''A dict mapping each URL to the array of its values of numeric
+        `field`, e.g. ``store.by_url('time')`` for load time samples.'''
+        codes, urls = self.categories('url', run)
+        values = self.column(field, run)
+        if successful_only:
+            status = self.column('status', run)
+            keep = status == LoadResult.SUCCESS
+            codes, values = codes[keep], values[keep]
+        order = numpy.argsort(codes, kind='mergesort')
+        codes, values = codes[order], values[order]
+        bounds = numpy.flatnonzero(numpy.diff(codes)) + 1
+        groups = {}
+        for group_codes, group in zip(numpy.split(codes, bounds), numpy.split(values, bounds)):
+            if len(group_codes) and group_codes[0] >= 0:
+                groups[urls[group_codes[0]]] = group
+        return groups
+
+    def __len__(self):
+        return sum(rows for _, rows in self._batch_rows()) + len(self._rows)
+
+    def _batch_rows(self):
+        for batch in self._batches():
+            with open(os.path.join(batch, 'meta.json'), 'r') as f:
+                yield batch, json.load(f)['rows']
+
+    def _run_mask(self, run):
+        runs = self.column('run')
+        if isinstance(run, (list, tuple)):
+            return numpy.in1d(runs, run)
+        return runs == run
+
+
+
+def main():
+    store = ResultStore(args.store)
+    runs = store.runs()
+    if not runs:
+        logging.error('No runs in %s', args.store)
+        sys.exit(-1)
+    for run in runs:
+        if args.run is None or run['id'] == args.run:
+            print 'run %d: %s' % (run['id'], json.dumps(run, sort_keys=True))
+    for url, values in sorted(store.by_url(args.field, args.run).items()):
+        values = values[~numpy.isnan(values)]
+        if len(values):
+            print '%s\t%d\t%f\t%f' % (url, len(values), numpy.median(values), numpy.mean(values))
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Summarize the results in a result store.')
+    parser.add_argument('store', help='result store directory')
+    parser.add_argument('-r', '--run', type=int, help='only this run')
+    parser.add_argument('-f', '--field', default='time', help='numeric field to summarize per URL (count, median, mean)')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
@@ -0,0 +1,336 @@
+#! /usr/bin/env python
+
+import os
+import sys
+import zlib
+import gzip
+import bisect
+import struct
+import logging
+import argparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# uncompressed bytes per frame; a seek decompresses at most one frame
+FRAME_SIZE = 1 << 20
+
+CODECS = ('gzip', 'zstd')
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+def default_codec():
+    '''zstd if the zstandard module is installed, gzip otherwise.'''
+    return 'zstd' if zstandard else 'gzip'
+
+def codec_of(path):
+    '''The codec of a compressed file, by its suffix (None if not compressed).'''
+    for codec, suffix in SUFFIXES.items():
+        if path.endswith(suffix):
+            return codec
+    return None
+
+
+################################################################################
+#                                                                              #
+#   FRAMING                                                                    #
+#                                                                              #
+################################################################################
+
+# Both formats are a sequence of independently compressed frames, so a
+# reader can start at any frame, and standard tools still decompress them:
+#
+# gzip: every frame is a gzip member (concatenated members are one gzip
+#   stream), like BGZF; an extra field 'WL' in its header holds the sizes of
+#   the member and of its data, so a reader finds the frames by hopping
+#   from header to header.
+# zstd: every frame is a zstd frame, followed by the seek table of the zstd
+#   seekable format (a skippable frame), which `zstd -d` ignores.
+
+GZIP_MAGIC = '\x1f\x8b'
+GZIP_HEADER = struct.Struct('<2sBBIBBH2sHII')
+GZIP_TRAILER = struct.Struct('<iI')
+FLAG_EXTRA = 4
+OS_UNKNOWN = 255
+
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A5E
+ZSTD_SEEKABLE_MAGIC = 0x8F92EAB1
+ZSTD_SEEK_ENTRY = struct.Struct('<II')
+ZSTD_SEEK_FOOTER = struct.Struct('<IBI')
+
+def _gzip_frame(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    size = GZIP_HEADER.size + len(deflated) + GZIP_TRAILER.size
+    # mtime 0, so the same data always gives the same bytes
+    header = GZIP_HEADER.pack(GZIP_MAGIC, 8, FLAG_EXTRA, 0, 0, OS_UNKNOWN, 12,\
+        'WL', 8, size, len(data))
+    return header + deflated + GZIP_TRAILER.pack(zlib.crc32(data), len(data) & 0xffffffff)
+
+class SeekableWriter(object):
+    '''Writes a compressed file in independent frames of `frame_size`
+    uncompressed bytes, readable with :class:`SeekableReader` (or
+    gunzip/zstd -d).
+
+    :param f: a file object open for writing (binary)
+    :param codec: 'gzip' or 'zstd' (needs the zstandard module)
+    :param level: compression level, by default the codec's default
+    '''
+
+    def __init__(self, f, codec='gzip', level=None, frame_size=FRAME_SIZE):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec %s' % codec)
+        if codec == 'zstd' and not zstandard:
+            raise ValueError('zstd needs the zstandard module')
+        self._f = f
+        self._codec = codec
+        self._level = level if level is not None else DEFAULT_LEVELS[codec]
+        self._frame_size = frame_size
+        self._buffer = []
+        self._buffered = 0
+        self._frames = []  # (compressed size, uncompressed size)
+        if codec == 'zstd':
+            self._zstd = zstandard.ZstdCompressor(level=self._level, write_content_size=True)
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._frame_size:
+            data = ''.join(self._buffer)
+            while len(data) >= self._frame_size:
+                self._write_frame(data[:self._frame_size])
+                data = data[self._frame_size:]
+            self._buffer = [data]
+            self._buffered = len(data)
+
+    def _write_frame(self, data):
+        if self._codec == 'zstd':
+            frame = self._zstd.compress(data)
+        else:
+            frame = _gzip_frame(data, self._level)
+        self._f.write(frame)
+        self._frames.append((len(frame), len(data)))
+
+    def close(self):
+        '''Write the last frame (and the seek table); does not close the file.'''
+        if self._buffered or not self._frames:
+            self._write_frame(''.join(self._buffer))
+        self._buffer = []
+        self._buffered = 0
+        if self._codec == 'zstd':
+            table = ''.join(ZSTD_SEEK_ENTRY.pack(c, u) for c, u in self._frames)
+            table += ZSTD_SEEK_FOOTER.pack(len(self._frames), 0, ZSTD_SEEKABLE_MAGIC)
+            self._f.write(struct.pack('<II', ZSTD_SKIPPABLE_MAGIC, len(table)) + table)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+def compress_file(src, dst, codec='gzip', level=None, frame_size=FRAME_SIZE):
+    '''Compress file `src` to `dst`.'''
+    with open(src, 'rb') as f, open(dst, 'wb') as out:
+        with SeekableWriter(out, codec, level, frame_size) as writer:
+            while True:
+                data = f.read(frame_size)
+                if not data:
+                    break
+                writer.write(data)
+
+
+################################################################################
+#                                                                              #
+#   READER                                                                     #
+#                                                                              #
+################################################################################
+
+class SeekableReader(object):
+    '''A read-only file object for a file written by :class:`SeekableWriter`;
+    seeking decompresses only the frame it lands in. Plain gzip files are
+    read too, but seek by decompressing from the start.
+
+    :param path: the compressed file
+    :param codec: its codec, by default by its suffix
+    '''
+
+    def __init__(self, path, codec=None):
+        self._codec = codec or codec_of(path) or 'gzip'
+        if self._codec == 'zstd' and not zstandard:
+            raise IOError('Reading %s needs the zstandard module' % path)
+        self._f = open(path, 'rb')
+        self._pos = 0
+        self._frame = None  # (index, data) of the last frame read
+        self._plain = None
+        try:
+            if self._codec == 'zstd':
+                self._offsets, self._starts = self._zstd_index()
+                self._zstd = zstandard.ZstdDecompressor()
+            else:
+                self._offsets, self._starts = self._gzip_index()
+        except (IOError, struct.error):
+            self._f.close()
+            raise
+        if self._offsets is None:
+            # not framed: read it as a stream
+            self._f.seek(0)
+            self._plain = gzip.GzipFile(fileobj=self._f, mode='rb')
+
+    def _gzip_index(self):
+        offsets, starts = [], []
+        offset = start = 0
+        size = os.fstat(self._f.fileno()).st_size
+        while offset < size:
+            self._f.seek(offset)
+            header = self._f.read(GZIP_HEADER.size)
+            if len(header) < GZIP_HEADER.size:
+                return None, None
+            magic, _, flags, _, _, _, xlen, subfield, _, member_size, data_size =\
+                GZIP_HEADER.unpack(header)
+            if magic != GZIP_MAGIC or not flags & FLAG_EXTRA or xlen != 12 or subfield != 'WL':
+                return None, None
+            offsets.append(offset)
+            starts.append(start)
+            offset += member_size
+            start += data_size
+        offsets.append(offset)
+        starts.append(start)
+        return offsets, starts
+
+    def _zstd_index(self):
+        self._f.seek(0, os.SEEK_END)
+        size = self._f.tell()
+        if size < ZSTD_SEEK_FOOTER.size:
+            raise IOError('Not a seekable zstd file')
+        self._f.seek(size - ZSTD_SEEK_FOOTER.size)
+        frames, _, magic = ZSTD_SEEK_FOOTER.unpack(self._f.read(ZSTD_SEEK_FOOTER.size))
+        if magic != ZSTD_SEEKABLE_MAGIC:
+            raise IOError('Not a seekable zstd file')
+        self._f.seek(size - ZSTD_SEEK_FOOTER.size - frames * ZSTD_SEEK_ENTRY.size)
+        table = self._f.read(frames * ZSTD_SEEK_ENTRY.size)
+        offsets, starts = [], []
+        offset = start = 0
+        for i in range(frames):
+            compressed, data_size = ZSTD_SEEK_ENTRY.unpack_from(table, i * ZSTD_SEEK_ENTRY.size)
+            offsets.append(offset)
+            starts.append(start)
+            offset += compressed
+            start += data_size
+        offsets.append(offset)
+        starts.append(start)
+        return offsets, starts
+
+    @property
+    def size(self):
+        '''Uncompressed size (None for a plain gzip file).'''
+        return self._starts[-1] if self._plain is None else None
+
+    def _read_frame(self, i):
+        if self._frame and self._frame[0] == i:
+            return self._frame[1]
+        self._f.seek(self._offsets[i])
+        frame = self._f.read(self._offsets[i + 1] - self._offsets[i])
+        if self._codec == 'zstd':
+            data = self._zstd.decompress(frame)
+        else:
+            data = zlib.decompress(frame[GZIP_HEADER.size:-GZIP_TRAILER.size], -zlib.MAX_WBITS)
+        self._frame = (i, data)
+        return data
+
+    def read(self, size=-1):
+        if self._plain is not None:
+            data = self._plain.read(size)
+            self._pos += len(data)
+            return data
+        end = self._starts[-1] if size is None or size < 0 else min(self._starts[-1], self._pos + size)
+        chunks = []
+        while self._pos < end:
+            i = bisect.bisect_right(self._starts, self._pos) - 1
+            frame = self._read_frame(i)
+            offset = self._pos - self._starts[i]
+            chunk = frame[offset:offset + end - self._pos]
+            chunks.append(chunk)
+            self._pos += len(chunk)
+        return ''.join(chunks)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            if self._plain is not None:
+                raise IOError('Cannot seek from the end of a plain gzip file')
+            offset += self._starts[-1]
+        if self._plain is not None:
+            self._plain.seek(offset)
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._plain is not None:
+            self._plain.close()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __iter__(self):
+        # by lines, like a file
+        pending = ''
+        while True:
+            data = self.read(FRAME_SIZE)
+            if not data:
+                break
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+
+
+def main():
+    if args.compress:
+        codec = args.codec or default_codec()
+        dst = args.output or args.file + SUFFIXES[codec]
+        compress_file(args.file, dst, codec, args.level)
+        logging.info('%s: %d -> %d bytes', dst, os.path.getsize(args.file), os.path.getsize(dst))
+        return
+    with SeekableReader(args.file) as f:
+        f.seek(args.offset)
+        remaining = args.length
+        while remaining is None or remaining > 0:
+            data = f.read(FRAME_SIZE if remaining is None else min(FRAME_SIZE, remaining))
+            if not data:
+                break
+            sys.stdout.write(data)
+            if remaining is not None:
+                remaining -= len(data)
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Compress a file in seekable frames, or print (part of) a compressed file.')
+    parser.add_argument('file', help='file to compress, or compressed file to read')
+    parser.add_argument('-c', '--compress', action='store_true', default=False, help='compress (default: decompress to stdout)')
+    parser.add_argument('-z', '--codec', choices=CODECS, help='codec (default: zstd if installed, else gzip)')
+    parser.add_argument('-l', '--level', type=int, help='compression level')
+    parser.add_argument('-o', '--output', help='compressed file (default: file + .gz or .zst)')
+    parser.add_argument('-s', '--offset', type=int, default=0, help='uncompressed offset to start printing at')
+    parser.add_argument('-n', '--length', type=int, help='bytes to print')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
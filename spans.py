@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+import os
+import json
+import glob
+import logging
+import argparse
+import threading
+import numpy
+from time import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+
+# spans kept per recorder for the trace; the summary counts all of them
+MAX_TRACE_SPANS = 100000
+
+
+################################################################################
+#                                                                              #
+#   PHASE SPANS                                                                #
+#                                                                              #
+################################################################################
+
+class SpanRecorder(object):
+    '''Times the phases of a worker (setup, preload, page load, ...).
+
+    Each span is kept for a Chrome trace (see :meth:`write_trace`, open it
+    in chrome://tracing or Perfetto) and its duration for
+    :meth:`summary`. Spans may nest and come from several threads.
+
+    :param pid: the process id to show in the trace (e.g., the worker id)
+    :param name: the process name to show in the trace
+    '''
+
+    def __init__(self, pid=0, name=None):
+        self._pid = pid
+        self._name = name or 'worker %d' % pid
+        self._start = time()
+        self._events = deque(maxlen=MAX_TRACE_SPANS)
+        self._durations = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # a copy starts over, e.g., in another process
+        return {'pid': self._pid, 'name': self._name}
+
+    def __setstate__(self, state):
+        self.__init__(state['pid'], state['name'])
+
+    @contextmanager
+    def span(self, name, phases=None, **args):
+        '''Time the body of a `with` block as phase `name`. The duration
+        (seconds) is also added to dict `phases`, if given, e.g., to collect
+        the phases of one trial. Keyword args end up in the trace event.'''
+        start = time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time() - start, phases, **args)
+
+    def add(self, name, start, duration, phases=None, **args):
+        '''Record a span that was timed elsewhere.'''
+        if phases is not None:
+            phases[name] = phases.get(name, 0) + duration
+        event = {'name': name, 'cat': 'loader', 'ph': 'X', 'pid': self._pid,
+                 'tid': threading.current_thread().name,
+                 'ts': int(start * 1e6), 'dur': int(duration * 1e6)}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self._events.append(event)
+            self._durations[name].append(duration)
+
+    @property
+    def wall_time(self):
+        '''Seconds since the recorder was created.'''
+        return time() - self._start
+
+    def summary(self):
+        '''Per phase: count, total, share of the wall time, and percentiles
+        of the duration (seconds).'''
+        with self._lock:
+            durations = dict((name, numpy.array(d)) for name, d in self._durations.items())
+        return summarize(durations, self.wall_time)
+
+    def trace(self):
+        '''The spans as Chrome trace events (a JSON object format trace).'''
+        with self._lock:
+            events = list(self._events)
+        # name the process and its threads in the viewer
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': self._pid,
+                     'args': {'name': self._name}}]
+        return {'traceEvents': metadata + events, 'displayTimeUnit': 'ms',
+                'otherData': {'wall_time': self.wall_time}}
+
+    def write_trace(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.trace(), f)
+        os.rename(path + '.tmp', path)
+        logging.debug('Wrote %d spans to %s', len(self._events), path)
+
+
+def summarize(durations, wall_time=None):
+    '''Summarize a dict mapping phases to arrays of durations (seconds).'''
+    summary = {}
+    for name, values in durations.items():
+        if not len(values):
+            continue
+        p50, p90, p99 = numpy.percentile(values, [50, 90, 99])
+        summary[name] = {'count': len(values), 'total': float(values.sum()),
+                         'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                         'max': float(values.max())}
+        if wall_time:
+            summary[name]['share'] = float(values.sum()) / wall_time
+    return summary
+
+def merge_traces(paths):
+    '''Merge the traces of several workers into one trace.'''
+    events = []
+    wall_time = 0
+    for path in paths:
+        with open(path, 'r') as f:
+            trace = json.load(f)
+        events.extend(trace['traceEvents'])
+        wall_time += trace.get('otherData', {}).get('wall_time', 0)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'wall_time': wall_time}}
+
+
+
+def main():
+    paths = []
+    for pattern in args.traces:
+        paths.extend(sorted(glob.glob(os.path.join(pattern, 'loader_trace_*.json'))\
+            if os.path.isdir(pattern) else glob.glob(pattern)))
+    trace = merge_traces(paths)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(trace, f)
+
+    # where the worker-hours went, summed over workers
+    durations = defaultdict(list)
+    for event in trace['traceEvents']:
+        if event.get('ph') == 'X':
+            durations[event['name']].append(event['dur'] / 1e6)
+    summary = summarize(dict((name, numpy.array(d)) for name, d in durations.items()),\
+        trace['otherData']['wall_time'])
+    print '%-20s %8s %10s %7s %9s %9s %9s %9s' % ('phase', 'count', 'total s',\
+        'share', 'p50 s', 'p90 s', 'p99 s', 'max s')
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        print '%-20s %8d %10.1f %6.1f%% %9.3f %9.3f %9.3f %9.3f' % (name, s['count'],\
+            s['total'], s.get('share', 0) * 100, s['p50'], s['p90'], s['p99'], s['max'])
+    logging.info('%d workers, %.1f worker-seconds', len(paths), trace['otherData']['wall_time'])
+
+
+if __name__ == '__main__':
+    # set up command line args
+    parser = argparse.ArgumentParser(description='Summarize (and merge) the phase traces of loader workers.')
+    parser.add_argument('traces', nargs='+', help='trace files (loader_trace_<worker>.json) or directories holding them')
+    parser.add_argument('-o', '--output', help='write the merged Chrome trace here')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='print debug info')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format = "%(levelname) -10s %(asctime)s %(module)s:%(lineno) -7s %(message)s",
+        level = logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    main()
@@ -1,19 +1,36 @@
 #!/usr/bin/env python
 # Test driver loads test configurations and then lanuchs browsers to test.
-import os, sys, logging, argparse, pprint, json, time
+import os, sys, logging, argparse, json, time
 from chrome_loader import ChromeLoader
 from firefox_loader import FirefoxLoader
 from multiprocessing import Process, JoinableQueue
-import threading, signal
+import threading, signal, socket
+import Queue
 from loader import LoadResult
+from netem import NetworkProfile
+import netns
+from health import BrowserHealthMonitor
+from resultstore import ResultStore
+from preflight import Preflight, apply_policy, POLICIES
+import artifacts
+import procutils
 import traceback
 
 # These are the default values
 GLOBAL_DEFAULT = {'headless': True, 'log_ssl_keys': False, 'disable_quic': True,
                   'disable_spdy': False, 'ignore_certificate_errors': False,
-                  'browser': 'chrome', 'parallel': 1}
+                  'browser': 'chrome', 'parallel': 1, 'tabs_per_worker': 1,
+                  'recycle_after_loads': None, 'recycle_max_rss_mb': None,
+                  'recycle_max_fds': None, 'recycle_max_children': None,
+                  'recycle_max_time_drift': None, 'isolate_network': False,
+                  'replay_mode': None, 'replay_archive': 'replay.warc',
+                  'replay_port': 8990, 'replay_latency_ms': 0, 'replay_timings': True,
+                  'results_store': None, 'save_trace': False, 'output_layout': 'flat',
+                  'run_name': None, 'compress_artifacts': False, 'compress_workers': 2,
+                  'dedup_artifacts': False, 'preflight': None, 'preflight_workers': 32,
+                  'preflight_timeout': 10, 'preflight_ttl': 3600, 'preflight_cache': None}
 LOCAL_DEFAULT = {'num_trials': 1, 'save_har': True, 'save_packet_capture': False,
-                 'save_screenshot': True, 'fresh_view': True}
+                 'save_screenshot': True, 'fresh_view': True, 'network_profile': None}
 PRIVATE_DEFAULT = {'har_file_name': None, 'packet_capture_file_name': None,
                    'screenshot_name': None, 'preload': []}
 
@@ -43,23 +60,52 @@ def prepare_tests_settings(tests):
 
     return
 
+def num_tabs(default):
+    # concurrent tabs are only supported by chrome
+    if default['browser'].lower() == 'chrome':
+        return default['tabs_per_worker']
+    return 1
+
+def make_loader(default):
+    # NOTE: some parameters are obsolete as they are overruled by the parameters in individual tests
+    options = dict(disable_quic=default['disable_quic'], disable_spdy=default['disable_spdy'],
+                   check_protocol_availability=False, save_packet_capture=True,
+                   log_ssl_keys=default['log_ssl_keys'], save_har=True, disable_local_cache=False,
+                   headless=default['headless'], ignore_certificate_errors=default['ignore_certificate_errors'],
+                   isolate_network=default['isolate_network'], save_trace=default['save_trace'],
+                   output_layout=default['output_layout'], run_name=default['run_name'],
+                   compress_artifacts=default['compress_artifacts'],
+                   compress_workers=default['compress_workers'],
+                   dedup_artifacts=default['dedup_artifacts'])
+    if default['replay_mode']:
+        options['proxy'] = '127.0.0.1:%d' % default['replay_port']
+        # the proxy terminates HTTPS with a certificate of its own
+        options['ignore_certificate_errors'] = True
+    if default['browser'].lower() == 'chrome':
+        return ChromeLoader(max_tabs=num_tabs(default), **options)
+    elif default['browser'].lower() == 'firefox':
+        return FirefoxLoader(**options)
+    return None
+
 def loader_worker(my_id, default, job_queue, result_queue):
     # this is the worker subprocess
-    if default['browser'].lower() == 'chrome':
-        # we only use the worker subprocess for chrome
-        # firefox should work equally well as long as there is only one worker
-        # but it is never tested
-        loader = ChromeLoader(disable_quic=default['disable_quic'], disable_spdy=default['disable_spdy'],
-                              check_protocol_availability=False, save_packet_capture=True,
-                              log_ssl_keys=default['log_ssl_keys'], save_har=True, disable_local_cache=False,
-                              headless=default['headless'], ignore_certificate_errors=default['ignore_certificate_errors'])
-        if not loader.setup(my_id):
-            logging.error('Error setting up loader')
-            return
-    else:
-        # TODO: firefox
+    # every worker has its own browser, display, profile, HAR export
+    # directory and keylog, so workers don't step on each other
+    loader = make_loader(default)
+    if not loader.setup(my_id):
+        logging.error('Error setting up loader')
         return
 
+    if num_tabs(default) > 1:
+        tab_worker(loader, num_tabs(default), job_queue, result_queue)
+        return
+
+    monitor = BrowserHealthMonitor(max_loads=default['recycle_after_loads'],
+                                   max_rss_mb=default['recycle_max_rss_mb'],
+                                   max_fds=default['recycle_max_fds'],
+                                   max_children=default['recycle_max_children'],
+                                   max_time_drift=default['recycle_max_time_drift'])
+
     while True:
         # dead loop to wait for test jobs.
         testJob = job_queue.get()
@@ -69,34 +115,92 @@ def loader_worker(my_id, default, job_queue, result_queue):
             return
         try:
             result = loader.load_page(testJob[0], testJob[1])
-            if result:
-                result_queue.put(result)
+            monitor.record_load(result)
+            restarts = loader.num_restarts
             if result.status != LoadResult.SUCCESS:
-                # if anything went bad, we try to restart the browser
-                # to minimize the impact of the failure on further tests
-                loader.teardown()
-                if not loader.setup(my_id):
+                # if anything went bad, clean the browser state to minimize the
+                # impact of the failure on further tests; the browser is only
+                # restarted if it fails the health check
+                if not loader.recover():
                     # restart, if failure, just give up the whole tests
+                    result_queue.put(result)
                     logging.error('Error setting up loader')
                     return
+                if loader.num_restarts != restarts:
+                    result.recycle_reason = 'unhealthy after failed load'
+            else:
+                # recycle an aging browser before it skews further tests
+                reason = monitor.recycle_reason(loader.browser_pids())
+                if reason:
+                    logging.info('Recycling browser: %s', reason)
+                    result.recycle_reason = reason
+                    if not loader.restart():
+                        result_queue.put(result)
+                        logging.error('Error setting up loader')
+                        return
+            if loader.num_restarts != restarts:
+                monitor.start()
+            result_queue.put(result)
         except Exception as e:
             logging.exception('Error loading pages: %s\n%s', e, traceback.format_exc())
-            loader.teardown()
-            if not loader.setup(my_id):
+            if not loader.recover():
                 logging.error('Error setting up loader')
                 return
+            monitor.start()
         finally:
-            # stop tcpdump (if it's running)
             try:
-                if loader.tcpdump_proc:
-                    logging.debug('Stopping tcpdump')
-                    os.system("kill %s" % loader.tcpdump_proc.pid)
-                    loader.tcpdump_proc = None
+                loader.stop_tcpdump()
             except Exception:
                 logging.exception('Error stopping tcpdump.')
             job_queue.task_done()
 
 
+def tab_worker(loader, num_tabs, job_queue, result_queue):
+    # throughput mode: num_tabs threads share one chrome, each loads its jobs
+    # in a separate browser context of its own
+    restart_lock = threading.Lock()
+    # set when chrome could not be recovered: all tabs stop, like loader_worker
+    failed = threading.Event()
+
+    def tab_thread():
+        while not failed.is_set():
+            try:
+                testJob = job_queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if testJob[1] < 0: # a reseved number to tell workers to quit
+                job_queue.task_done()
+                return
+            try:
+                if failed.is_set():
+                    # leave it to another worker
+                    job_queue.put(testJob)
+                    continue
+                result = loader.load_page_in_tab(testJob[0], testJob[1])
+                result_queue.put(result)
+                if result.status != LoadResult.SUCCESS:
+                    # the other tabs keep running unless chrome itself is broken
+                    with restart_lock:
+                        if not failed.is_set() and not loader.check_health()\
+                            and not loader.recover():
+                            logging.error('Error setting up loader')
+                            failed.set()
+            except Exception as e:
+                logging.exception('Error loading pages: %s\n%s', e, traceback.format_exc())
+            finally:
+                job_queue.task_done()
+
+    threads = []
+    for i in range(num_tabs):
+        thread = threading.Thread(name='tab%d'%i, target=tab_thread)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    loader.teardown()
+
+
 def check_alive(workers):
     # check if there is any alive workers
     for worker in workers:
@@ -140,13 +244,60 @@ def dispatch_parallel_tests(tests, queue):
             queue.put(current_test)
 
 def teardown_parallel_instances(default, job_queue):
-    # signaling the workers to stop
-    for _ in range(default['parallel']):
+    # signaling the workers to stop, one message per tab thread
+    for _ in range(default['parallel'] * num_tabs(default)):
         job_queue.put([None, -1])
     time.sleep(0.5)
 
+def preflight_tests(tests, default):
+    # check every URL at once, before any browser time is spent on them;
+    # only through a replaying proxy: a recording one would archive these
+    # fetches instead of the browser's
+    proxy = '127.0.0.1:%d' % default['replay_port'] if default['replay_mode'] == 'replay' else None
+    preflight = Preflight(default['preflight_workers'], default['preflight_timeout'],
+                          default['preflight_ttl'], default['preflight_cache'], proxy=proxy)
+    start = time.time()
+    results = preflight.check_all([test['url'] for test in tests['tests']])
+    preflight.save_cache()
+    kept, dropped = apply_policy(tests['tests'], results, default['preflight'])
+    for test in dropped:
+        result = results[test['url']]
+        logging.warning('Preflight: dropping %s (%s)', test['url'],
+                        result.error or 'loads over %s' % result.final_url.split(':')[0])
+    logging.info('Preflight: %d URLs checked in %.1f s, %d tests dropped', len(results),
+                 time.time() - start, len(dropped))
+    tests['tests'] = kept
+
+def start_replay_proxy(default):
+    # one proxy for all workers, so recording writes a single archive
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replay.py'),
+               default['replay_mode'], default['replay_archive'],
+               '-p', str(default['replay_port']), '-l', str(default['replay_latency_ms'])]
+    if not default['replay_timings']:
+        command.append('--no_timings')
+    if default['isolate_network']:
+        # every worker's namespace reaches it on its own veth address, which
+        # only exists once the worker is up; let in those and no one else
+        command += ['-a', '0.0.0.0', '-A', '127.0.0.0/8', '-A', netns.NETWORK]
+    logging.info('Starting %s proxy: %s', default['replay_mode'], ' '.join(command))
+    proc = procutils.spawn('replay-proxy', command)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            break
+        try:
+            socket.create_connection(('127.0.0.1', default['replay_port']), 1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.2)
+    procutils.reap('replay-proxy', proc)
+    return None
+
 def main(fileName):
 
+    # kill browsers, Xvfbs and tcpdumps left by a crashed earlier run
+    procutils.sweep()
+
     # load test config and default values
     with open(fileName, 'r') as f:
         tests = json.load(f)
@@ -156,56 +307,90 @@ def main(fileName):
     jobQueue = JoinableQueue()
     resultQueue = JoinableQueue()
 
-    # NOTE: some parameters are obsolete as they are overruled by the parameters in individual tests
-    if default['browser'].lower() == 'chrome':
-        # use producer-consumer mode for chrome
-        # this mode helps isolating individual failures
-        # as well as supporting parallel browsers
-        workers = start_parallel_instances(default, jobQueue, resultQueue)
-        dispatch_parallel_tests(tests, jobQueue)
-
-        def terminate_jobs(_, __):
-            logging.warning("SIGINT: terminating all the intances ")
-            for worker in workers:
-                # SIGTERM will trigger teardown function of the workers
-                # so that they could nicely kill the processes (chrome, Xvfb) they started
-                os.kill(worker.pid, signal.SIGTERM)
-                time.sleep(0.5)
+    if default['browser'].lower() not in ('chrome', 'firefox'):
+        logging.critical('Uknown browser %s', default['browser'].lower())
+        sys.exit(-1)
+
+    # catch typos in network profiles before any browser starts
+    for test in tests['tests']:
+        try:
+            NetworkProfile.from_setting(test['network_profile'])
+        except (ValueError, TypeError) as e:
+            logging.critical('Bad network_profile for %s: %s', test['url'], e)
             sys.exit(-1)
-        # SIGINT is for nice teardown
-        # NOTE: if SIGKILL this process, there could be orphan processes that stop new tests
-        # one must manually kill them if that happens
-        signal.signal(signal.SIGINT, terminate_jobs)
-        #loader = ChromeLoader(disable_quic=default['disable_quic'], disable_spdy=default['disable_spdy'],
-        #                      check_protocol_availability=False, save_packet_capture=True,
-        #                      log_ssl_keys=default['log_ssl_keys'], save_har=True, disable_local_cache=False,
-        #                      headless=default['headless'], ignore_certificate_errors=default['ignore_certificate_errors'])
-        #loader.load_pages(tests)
-        #pprint.pprint(dict(loader.load_results))
-
-        # then wait for the queue to be empty
-        jobQueue.join()
-
-        while not resultQueue.empty():
-            # print all the test reports
-            result = resultQueue.get(False)
-            print result
-            resultQueue.task_done()
-        # send teardown message then wait
-        teardown_parallel_instances(default, jobQueue)
-        jobQueue.join()
 
-    elif default['browser'].lower() == 'firefox':
-        # simplier single thread mode for firefox
-        loader = FirefoxLoader(disable_quic=default['disable_quic'], disable_spdy=default['disable_spdy'],
-                               check_protocol_availability=False, save_packet_capture=True,
-                               log_ssl_keys=default['log_ssl_keys'], save_har=True, disable_local_cache=False,
-                               headless=default['headless'], ignore_certificate_errors=default['ignore_certificate_errors'])
-        loader.load_pages(tests)
-        pprint.pprint(dict(loader.load_results))
-    else:
-        logging.critical('Uknown browser %s', default['browser'].lower())
+    if default['output_layout'] not in artifacts.LAYOUTS:
+        logging.critical('Unknown output_layout %s', default['output_layout'])
+        sys.exit(-1)
+    if default['output_layout'] == 'sharded' and not default['run_name']:
+        # all workers write to the same run directory
+        default['run_name'] = time.strftime('%Y%m%d-%H%M%S')
+        logging.info('Run name: %s', default['run_name'])
+
+    proxy = None
+    if default['replay_mode']:
+        if default['replay_mode'] not in ('record', 'replay'):
+            logging.critical('Unknown replay_mode %s', default['replay_mode'])
+            sys.exit(-1)
+        proxy = start_replay_proxy(default)
+        if not proxy:
+            logging.critical('Error starting the %s proxy', default['replay_mode'])
+            sys.exit(-1)
+
+    if default['preflight']:
+        if default['preflight'] not in POLICIES:
+            logging.critical('Unknown preflight policy %s', default['preflight'])
+            sys.exit(-1)
+        # a URL without a scheme is loaded over http
+        for test in tests['tests']:
+            if '://' not in test['url']:
+                test['url'] = 'http://' + test['url']
+        preflight_tests(tests, default)
+
+    # use producer-consumer mode
+    # this mode helps isolating individual failures
+    # as well as supporting parallel browsers
+    workers = start_parallel_instances(default, jobQueue, resultQueue)
+    dispatch_parallel_tests(tests, jobQueue)
+
+    def terminate_jobs(_, __):
+        logging.warning("SIGINT: terminating all the intances ")
+        for worker in workers:
+            # SIGTERM will trigger teardown function of the workers
+            # so that they could nicely kill the processes (browser, Xvfb) they started
+            os.kill(worker.pid, signal.SIGTERM)
+            time.sleep(0.5)
+        if proxy:
+            procutils.reap('replay-proxy', proxy)
         sys.exit(-1)
+    # SIGINT is for nice teardown
+    # NOTE: if this process is SIGKILLed, the orphan processes it leaves are
+    # killed by the pidfile sweep (procutils.sweep) of the next run
+    signal.signal(signal.SIGINT, terminate_jobs)
+
+    # then wait for the queue to be empty
+    jobQueue.join()
+
+    store = None
+    if default['results_store']:
+        store = ResultStore(default['results_store'])
+        run = store.start_run(tests=os.path.abspath(fileName), settings=default)
+    while not resultQueue.empty():
+        # print all the test reports
+        result = resultQueue.get(False)
+        print result
+        if store:
+            store.append(result, run)
+        resultQueue.task_done()
+    if store:
+        store.close()
+        logging.info('Results stored in %s (run %d)', store.path, run)
+    # send teardown message then wait
+    teardown_parallel_instances(default, jobQueue)
+    jobQueue.join()
+
+    if proxy:
+        procutils.reap('replay-proxy', proxy)
 
     #pprint.pprint(dict(loader.page_results))
 
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from artifacts import Compressor, Manifest, open_artifact, load_har, BLOBS
+
+
+def _har(url, body):
+    return {'log': {'pages': [{'id': 'page_1', 'title': url}], 'entries': [
+        {'request': {'url': url}, 'response': {'content': {'text': body}}},
+        {'request': {'url': url + 'small'}, 'response': {'content': {'text': 'small'}}},
+    ]}}
+
+
+class CompressorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = Manifest(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _blobs(self):
+        return sorted(name for _, _, names in os.walk(os.path.join(self.tmpdir, BLOBS))\
+            for name in names)
+
+    def test_round_trip(self):
+        data = 'packets' * 1000
+        path = self._write('0.pcap', data)
+        compressor = Compressor(self.manifest, codec='gzip')
+        compressor.submit('http://a/', 0, 'pcap', path)
+        compressor.close()
+
+        self.assertFalse(os.path.exists(path))
+        compressed = self.manifest.lookup('http://a/', 0, 'pcap')
+        self.assertEqual(compressed, path + '.gz')
+        with open_artifact(compressed) as f:
+            self.assertEqual(f.read(), data)
+        # found by the path it had before it was compressed, too
+        with open_artifact(path) as f:
+            self.assertEqual(f.read(), data)
+        stats = compressor.stats
+        self.assertEqual(stats['files'], 1)
+        self.assertEqual(stats['bytes_in'], len(data))
+        self.assertLess(stats['bytes_out'], len(data))
+        self.assertEqual(self._blobs(), [])
+
+    def test_dedup(self):
+        same = 'the same capture' * 500
+        paths = [self._write('%d.pcap' % i, data) for i, data in\
+            enumerate([same, 'another capture' * 500, same, same])]
+        compressor = Compressor(self.manifest, codec='gzip', workers=3, dedup=True)
+        for trial, path in enumerate(paths):
+            compressor.submit('http://a/', trial, 'pcap', path)
+        compressor.close()
+
+        compressed = [self.manifest.lookup('http://a/', trial, 'pcap') for trial in range(4)]
+        inodes = [os.stat(path).st_ino for path in compressed]
+        # one file per content, whichever worker got there first
+        self.assertEqual(len(set(inodes)), 2)
+        self.assertEqual(inodes[0], inodes[2])
+        self.assertEqual(inodes[0], inodes[3])
+        self.assertNotEqual(inodes[0], inodes[1])
+        self.assertEqual(len(self._blobs()), 2)
+        self.assertEqual(compressor.stats['duplicates'], 2)
+        with open_artifact(compressed[3]) as f:
+            self.assertEqual(f.read(), same)
+
+        entries = list(self.manifest.entries())
+        sha1 = dict((entry['trial'], entry['sha1']) for entry in entries)
+        self.assertEqual(sha1[0], sha1[2])
+        self.assertNotEqual(sha1[0], sha1[1])
+        self.assertTrue(all(entry['compressed'] == 'gzip' for entry in entries))
+
+    def test_har_bodies(self):
+        # the same large body in two different HARs is stored once
+        body = u'<html>%s</html>' % (u'\xe9' * 2000)
+        paths = []
+        for trial, url in enumerate(['http://a/', 'http://b/']):
+            path = os.path.join(self.tmpdir, '%d.har' % trial)
+            with open(path, 'w') as f:
+                json.dump(_har(url, body), f)
+            paths.append(path)
+        compressor = Compressor(self.manifest, codec='gzip', dedup=True, min_body=1024)
+        for trial, path in enumerate(paths):
+            compressed, _ = compressor.compress(path, 'har')
+            har = load_har(compressed)
+            self.assertEqual(har, _har(['http://a/', 'http://b/'][trial], body))
+            with open_artifact(compressed) as f:
+                stripped = json.load(f)
+            content = stripped['log']['entries'][0]['response']['content']
+            self.assertNotIn('text', content)
+            self.assertIn('_blob', content)
+            # small bodies stay where they were
+            self.assertEqual(stripped['log']['entries'][1]['response']['content'],\
+                {'text': 'small'})
+        compressor.close()
+        self.assertEqual(compressor.stats['bodies'], 2)
+        self.assertEqual(len([name for name in self._blobs() if '.body' in name]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
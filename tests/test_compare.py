@@ -0,0 +1,154 @@
+import os
+import sys
+import math
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compare import pad, row_medians, mann_whitney, bootstrap_median_difference,\
+    benjamini_hochberg, compare
+
+
+################################################################################
+#                                                                              #
+#   STATISTICS                                                                 #
+#                                                                              #
+################################################################################
+
+# R's wilcox.test(a, b, exact=FALSE): normal approximation with tie and
+# continuity correction, W being the U of `a`
+REFERENCE = [
+    ([1, 2, 3], [4, 5, 6], 0.0, 0.0808555983700523),
+    # ties across and within the samples
+    ([1, 2, 2, 3, 3], [2, 3, 3, 4, 5], 5.0, 0.12637938760851553),
+    # the example of ?wilcox.test
+    ([0.80, 0.83, 1.89, 1.04, 1.45, 1.38, 1.91, 1.64, 0.73, 1.46],
+        [1.15, 0.88, 0.90, 0.74, 1.21], 35.0, 0.24462360512698333),
+]
+
+def _test(pairs):
+    a, a_lengths = pad([numpy.array(a, dtype=float) for a, _ in pairs])
+    b, b_lengths = pad([numpy.array(b, dtype=float) for _, b in pairs])
+    return mann_whitney(a, a_lengths, b, b_lengths)
+
+class MannWhitneyTest(unittest.TestCase):
+
+    def test_reference(self):
+        # all rows at once, each padded to the longest
+        u, p = _test([(a, b) for a, b, _, _ in REFERENCE])
+        for i, (_, _, expected_u, expected_p) in enumerate(REFERENCE):
+            self.assertEqual(u[i], expected_u)
+            self.assertAlmostEqual(p[i], expected_p, places=12)
+
+    def test_symmetric(self):
+        # swapping the samples gives the other U, and the same p
+        u, p = _test([(b, a) for a, b, _, _ in REFERENCE])
+        for i, (a, b, expected_u, expected_p) in enumerate(REFERENCE):
+            self.assertEqual(u[i], len(a) * len(b) - expected_u)
+            self.assertAlmostEqual(p[i], expected_p, places=12)
+
+    def test_all_tied(self):
+        # no variance at all: nothing to tell the samples apart
+        u, p = _test([([5, 5, 5], [5, 5, 5, 5])])
+        self.assertEqual(u[0], 6.0)
+        self.assertEqual(p[0], 1.0)
+
+    def test_empty(self):
+        u, p = _test([([], [1, 2, 3]), ([1, 2, 3], []), ([1, 2, 3], [4, 5, 6])])
+        self.assertTrue(math.isnan(p[0]))
+        self.assertTrue(math.isnan(p[1]))
+        self.assertAlmostEqual(p[2], REFERENCE[0][3], places=12)
+
+class BenjaminiHochbergTest(unittest.TestCase):
+
+    def test_reference(self):
+        # R's p.adjust(p, 'BH')
+        q = benjamini_hochberg(numpy.array([0.01, 0.04, 0.03, 0.005]))
+        numpy.testing.assert_allclose(q, [0.02, 0.04, 0.04, 0.02])
+        q = benjamini_hochberg(numpy.array([0.01, 0.02, 0.03, 0.04, 0.05]))
+        numpy.testing.assert_allclose(q, [0.05] * 5)
+        # a larger p value can lower the q value of a smaller one
+        q = benjamini_hochberg(numpy.array([0.5, 0.9]))
+        numpy.testing.assert_allclose(q, [0.9, 0.9])
+
+    def test_capped(self):
+        q = benjamini_hochberg(numpy.array([0.6, 0.7, 0.8]))
+        numpy.testing.assert_allclose(q, [0.8, 0.8, 0.8])
+        q = benjamini_hochberg(numpy.array([0.9, 0.95, 0.4]))
+        self.assertTrue((q <= 1.0).all())
+
+    def test_nan(self):
+        # untested comparisons neither get a q value nor count as tests
+        q = benjamini_hochberg(numpy.array([0.01, numpy.nan, 0.04, 0.03, numpy.nan, 0.005]))
+        self.assertTrue(math.isnan(q[1]) and math.isnan(q[4]))
+        numpy.testing.assert_allclose(q[[0, 2, 3, 5]], [0.02, 0.04, 0.04, 0.02])
+        self.assertTrue(numpy.isnan(benjamini_hochberg(numpy.array([numpy.nan, numpy.nan]))).all())
+        self.assertEqual(len(benjamini_hochberg(numpy.array([]))), 0)
+
+class MedianTest(unittest.TestCase):
+
+    def test_row_medians(self):
+        matrix, lengths = pad([numpy.array(a, dtype=float) for a in\
+            ([3, 1, 2], [4, 1, 3, 2], [7], [])])
+        medians = row_medians(matrix, lengths)
+        numpy.testing.assert_allclose(medians[:3], [2, 2.5, 7])
+        self.assertTrue(math.isnan(medians[3]))
+
+    def test_bootstrap(self):
+        a, a_lengths = pad([numpy.arange(100, 120, dtype=float), numpy.array([1.0]),\
+            numpy.array([])])
+        b, b_lengths = pad([numpy.arange(150, 170, dtype=float), numpy.array([]),\
+            numpy.array([1.0])])
+        low, high = bootstrap_median_difference(a, a_lengths, b, b_lengths, seed=1)
+        # the samples don't overlap, so neither does any resample
+        self.assertTrue(30 < low[0] <= 50 <= high[0] < 70)
+        self.assertTrue(numpy.isnan(low[1:]).all() and numpy.isnan(high[1:]).all())
+        # the same seed, the same interval
+        again = bootstrap_median_difference(a, a_lengths, b, b_lengths, seed=1)
+        numpy.testing.assert_array_equal(again[0][:1], low[:1])
+        numpy.testing.assert_array_equal(again[1][:1], high[:1])
+
+
+################################################################################
+#                                                                              #
+#   COMPARISON                                                                 #
+#                                                                              #
+################################################################################
+
+class CompareTest(unittest.TestCase):
+
+    def test_verdicts(self):
+        steady = [100.0 + i % 5 for i in range(20)]
+        baseline = {'time': {'slower': steady, 'faster': steady, 'same': steady,
+            'few': steady, 'missing': steady}}
+        candidate = {'time': {'slower': [x + 50 for x in steady],
+            'faster': [x - 50 for x in steady], 'same': list(reversed(steady)),
+            'few': [x + 50 for x in steady[:3]]}}
+        comparisons = compare(baseline, candidate, metrics=('time',), seed=1)
+
+        # too few samples, or missing on a side: not compared
+        self.assertEqual([c['url'] for c in comparisons], ['slower', 'faster', 'same'])
+        self.assertEqual([c['verdict'] for c in comparisons],\
+            ['regression', 'improvement', 'unchanged'])
+        slower = comparisons[0]
+        self.assertEqual(slower['metric'], 'time')
+        self.assertEqual(slower['baseline_samples'], 20)
+        self.assertEqual(slower['candidate_median'], 152.0)
+        self.assertAlmostEqual(slower['change'], 0.5 / 1.02)
+        self.assertTrue(slower['q'] < 0.05 and slower['q'] >= slower['p'])
+        self.assertTrue(slower['difference_low'] > 0)
+        # no interval where the test found nothing
+        self.assertEqual(comparisons[2]['p'], 1.0)
+        self.assertTrue(math.isnan(comparisons[2]['difference_low']))
+
+    def test_min_change(self):
+        steady = [100.0 + i % 5 for i in range(20)]
+        comparisons = compare({'time': {'u': steady}}, {'time': {'u': [x + 3 for x in steady]}},\
+            metrics=('time',), min_change=0.05, seed=1)
+        self.assertLess(comparisons[0]['q'], 0.05)
+        self.assertEqual(comparisons[0]['verdict'], 'unchanged')
+        self.assertEqual(compare({}, {}), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
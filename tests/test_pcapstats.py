@@ -0,0 +1,206 @@
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import seekable
+from pcapstats import analyze, iter_file_records, summarize, PcapError
+
+
+################################################################################
+#                                                                              #
+#   SYNTHETIC CAPTURE                                                          #
+#                                                                              #
+################################################################################
+
+CLIENT = '\x0a\x00\x00\x01'
+SERVER = '\x0a\x00\x00\x02'
+
+FIN, SYN, RST, PSH, ACK = 0x01, 0x02, 0x04, 0x08, 0x10
+
+def _tcp_frame(src, dst, sport, dport, seq, ack, flags, payload='', options=''):
+    options += '\x00' * (-len(options) % 4)
+    tcp = struct.pack('!HHIIBBHHH', sport, dport, seq, ack, (20 + len(options)) // 4 << 4,\
+        flags, 65535, 0, 0) + options
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0x4000,\
+        64, 6, 0, src, dst)
+    return '\x00' * 12 + '\x08\x00' + ip + tcp + payload
+
+def _tls_record(kind, body):
+    return struct.pack('!BHH', kind, 0x0303, len(body)) + body
+
+def _handshake(kind, body):
+    return struct.pack('!I', kind << 24 | len(body)) + body
+
+def _extensions(extensions):
+    data = ''.join(struct.pack('!HH', kind, len(value)) + value for kind, value in extensions)
+    return struct.pack('!H', len(data)) + data
+
+def _client_hello(random, extensions=()):
+    return _handshake(1, '\x03\x03' + random + '\x00' + '\x00\x02\x13\x01' + '\x01\x00' +\
+        _extensions(extensions))
+
+def _server_hello(extensions=()):
+    return _handshake(2, '\x03\x03' + '\x22' * 32 + '\x00' + '\x13\x01' + '\x00' +\
+        _extensions(extensions))
+
+class Capture(object):
+    '''A pcap (Ethernet, microsecond timestamps) built frame by frame.'''
+
+    def __init__(self):
+        self.records = [struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)]
+
+    def add(self, ts, upstream, port, seq, ack, flags, payload='', options=''):
+        if upstream:
+            frame = _tcp_frame(CLIENT, SERVER, port, 443, seq, ack, flags, payload, options)
+        else:
+            frame = _tcp_frame(SERVER, CLIENT, 443, port, seq, ack, flags, payload, options)
+        usec = int(round(ts * 1000000))
+        self.records.append(struct.pack('<IIII', usec // 1000000, usec % 1000000,\
+            len(frame), len(frame)) + frame)
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(''.join(self.records))
+
+def _capture():
+    capture = Capture()
+
+    # 40001: plain TCP, 30 ms handshake, one server segment sent twice
+    capture.add(1.000, True, 40001, 1000, 0, SYN)
+    capture.add(1.030, False, 40001, 5000, 1001, SYN | ACK)
+    capture.add(1.031, True, 40001, 1001, 5001, ACK)
+    capture.add(1.032, True, 40001, 1001, 5001, PSH | ACK, 'GET / HTTP/1.1\r\n\r\n')
+    capture.add(1.070, False, 40001, 5001, 1019, ACK, 'x' * 1000)
+    capture.add(1.300, False, 40001, 5001, 1019, ACK, 'x' * 1000)
+    capture.add(1.330, False, 40001, 6001, 1019, PSH | ACK, 'y' * 500)
+    capture.add(1.400, True, 40001, 1019, 6501, FIN | ACK)
+    capture.add(1.410, False, 40001, 6501, 1020, FIN | ACK)
+
+    # 40002: TCP fast open (ClientHello in the SYN, with a cookie), then a
+    # full TLS 1.2 handshake where the client sends data before the
+    # server's Finished (false start)
+    hello = _tls_record(22, _client_hello('\x11' * 32))
+    cookie = struct.pack('!BB', 34, 10) + '\xc0' * 8
+    capture.add(2.000, True, 40002, 2000, 0, SYN, hello, cookie)
+    capture.add(2.050, False, 40002, 7000, 2001 + len(hello), SYN | ACK)
+    server = _tls_record(22, _server_hello() + _handshake(11, '\x00' * 3) + _handshake(14, ''))
+    capture.add(2.100, False, 40002, 7001, 2001 + len(hello), PSH | ACK, server)
+    client = _tls_record(22, _handshake(16, '\x00' * 4)) + _tls_record(20, '\x01') +\
+        _tls_record(22, '\x00' * 16) + _tls_record(23, 'request')
+    capture.add(2.110, True, 40002, 2001 + len(hello), 7001 + len(server), PSH | ACK, client)
+    capture.add(2.160, False, 40002, 7001 + len(server), 2001 + len(hello) + len(client),\
+        PSH | ACK, _tls_record(20, '\x01') + _tls_record(22, '\x00' * 16))
+    # left open at the end of the capture
+
+    # 40003: a TLS 1.3 resumption, reset at the end
+    hello = _tls_record(22, _client_hello('\x33' * 32, [(35, ''), (43, '\x02\x03\x04'),\
+        (41, '\x00' * 8)]))
+    capture.add(3.000, True, 40003, 3000, 0, SYN)
+    capture.add(3.020, False, 40003, 9000, 3001, SYN | ACK)
+    capture.add(3.021, True, 40003, 3001, 9001, PSH | ACK, hello)
+    server = _tls_record(22, _server_hello([(43, '\x03\x04'), (41, '\x00\x00')]))
+    capture.add(3.040, False, 40003, 9001, 3001 + len(hello), PSH | ACK, server)
+    capture.add(3.050, True, 40003, 3001 + len(hello), 9001 + len(server), RST)
+    return capture
+
+
+################################################################################
+#                                                                              #
+#   TESTS                                                                      #
+#                                                                              #
+################################################################################
+
+class AnalyzeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'trial.pcap')
+        _capture().write(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _connections(self, path):
+        connections = list(analyze(path))
+        self.assertEqual(len(connections), 3)
+        return dict((int(c['client'].split(':')[1]), c) for c in connections)
+
+    def test_plain(self):
+        plain = self._connections(self.path)[40001]
+        self.assertEqual(plain['client'], '10.0.0.1:40001')
+        self.assertEqual(plain['server'], '10.0.0.2:443')
+        self.assertAlmostEqual(plain['handshake_rtt'], 0.030)
+        self.assertAlmostEqual(plain['start'], 1.0)
+        self.assertAlmostEqual(plain['end'], 1.41)
+        self.assertEqual(plain['bytes_sent'], 18)
+        self.assertEqual(plain['bytes_received'], 2500)
+        self.assertEqual(plain['retransmissions_sent'], 0)
+        self.assertEqual(plain['retransmissions_received'], 1)
+        # unique bytes only, over the server's 260 ms of sending
+        self.assertAlmostEqual(plain['goodput'], 1500 * 8 / 0.26)
+        self.assertFalse(plain['tls'])
+        self.assertFalse(plain['tcp_fast_open'])
+        self.assertFalse(plain['tcp_fast_open_cookie'])
+
+    def test_fast_open(self):
+        tfo = self._connections(self.path)[40002]
+        self.assertAlmostEqual(tfo['handshake_rtt'], 0.050)
+        self.assertTrue(tfo['tcp_fast_open_cookie'])
+        self.assertTrue(tfo['tcp_fast_open'])
+
+        self.assertTrue(tfo['tls'])
+        self.assertFalse(tfo['tls13'])
+        self.assertEqual(tfo['tls_client_random'], '11' * 32)
+        self.assertFalse(tfo['tls_session_resumption_offered'])
+        self.assertFalse(tfo['tls_session_resumption'])
+        self.assertTrue(tfo['tls_false_start'])
+
+    def test_tls13(self):
+        tls13 = self._connections(self.path)[40003]
+        self.assertAlmostEqual(tls13['handshake_rtt'], 0.020)
+        self.assertTrue(tls13['tls'])
+        self.assertTrue(tls13['tls13'])
+        self.assertEqual(tls13['tls_client_random'], '33' * 32)
+        self.assertTrue(tls13['tls_session_resumption_offered'])
+        self.assertTrue(tls13['tls_session_resumption'])
+        self.assertFalse(tls13['tls_false_start'])
+        self.assertFalse(tls13['tcp_fast_open'])
+
+    def test_compressed(self):
+        # read a few frames at a time instead of mapped, with the same result
+        compressed = self.path + seekable.SUFFIXES['gzip']
+        seekable.compress_file(self.path, compressed, 'gzip')
+        self.assertEqual(self._connections(compressed), self._connections(self.path))
+
+        # records spanning buffer refills
+        with open(self.path, 'rb') as f:
+            records = list(iter_file_records(f, buffer_size=7))
+        self.assertEqual(records[0], 1)
+        # the link type, then one per frame
+        self.assertEqual(len(records), len(_capture().records))
+
+    def test_summarize(self):
+        summary = summarize(analyze(self.path))
+        self.assertTrue(summary['tcp_fast_open_supported'])
+        self.assertTrue(summary['tls_false_start_supported'])
+        self.assertTrue(summary['tls_session_resumption_supported'])
+        transport = summary['transport']
+        self.assertEqual(transport['connections'], 3)
+        self.assertEqual(transport['tls_connections'], 2)
+        self.assertAlmostEqual(transport['median_handshake_rtt'], 0.030)
+        self.assertEqual(transport['retransmissions'], 1)
+
+    def test_not_pcap(self):
+        with open(self.path, 'wb') as f:
+            f.write('\x0a\x0d\x0d\x0a' + '\x00' * 40)
+        self.assertRaises(PcapError, list, analyze(self.path))
+        open(self.path, 'wb').close()
+        self.assertEqual(list(analyze(self.path)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
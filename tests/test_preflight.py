@@ -0,0 +1,218 @@
+import os
+import sys
+import ssl
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import subprocess
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from preflight import Preflight, apply_policy
+
+
+################################################################################
+#                                                                              #
+#   STAND-IN SERVERS                                                           #
+#                                                                              #
+################################################################################
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'stand-in'
+    sys_version = ''
+
+    def do_GET(self):
+        if self.path == '/ok':
+            body = 'ok'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/to-https':
+            self._redirect(self.server.https_url + '/ok')
+        elif self.path == '/moved':
+            self._redirect('/ok')
+        elif self.path == '/drip':
+            # a header byte now and then: no read ever times out
+            self.wfile.write('HTTP/1.1 200 OK\r\n')
+            try:
+                while not self.server.stopped:
+                    self.wfile.write('X')
+                    self.wfile.flush()
+                    time.sleep(0.2)
+            except socket.error:
+                pass
+        else:
+            self.send_error(404)
+
+    def _redirect(self, location):
+        self.send_response(301)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *_):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    stopped = False
+
+    def handle_error(self, *_):
+        # e.g., the TLS handshake a plain HTTP server gets
+        pass
+
+def _serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+def _closed_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+################################################################################
+#                                                                              #
+#   TESTS                                                                      #
+#                                                                              #
+################################################################################
+
+class PreflightTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cert = os.path.join(cls.tmpdir, 'cert.pem')
+        try:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',\
+                '-keyout', cert, '-out', cert, '-days', '1', '-subj', '/CN=127.0.0.1'],\
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.tmpdir)
+            raise unittest.SkipTest('openssl is needed for a self-signed certificate')
+
+        cls.http = Server(('127.0.0.1', 0), Handler)
+        cls.https = Server(('127.0.0.1', 0), Handler)
+        cls.https.socket = ssl.wrap_socket(cls.https.socket, certfile=cert, server_side=True)
+        cls.http_url = 'http://127.0.0.1:%d' % cls.http.server_port
+        cls.https_url = 'https://127.0.0.1:%d' % cls.https.server_port
+        cls.http.https_url = cls.https.https_url = cls.https_url
+        _serve(cls.http)
+        _serve(cls.https)
+
+        cls.ok = cls.http_url + '/ok'
+        cls.moved = cls.http_url + '/moved'
+        cls.to_https = cls.http_url + '/to-https'
+        cls.secure = cls.https_url + '/ok'
+        cls.refused = 'http://127.0.0.1:%d/ok' % _closed_port()
+        # TLS to a server that speaks plain HTTP
+        cls.plain_port = 'https://127.0.0.1:%d/ok' % cls.http.server_port
+        cls.urls = [cls.ok, cls.moved, cls.to_https, cls.secure, cls.refused, cls.plain_port]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.http.stopped = True
+        cls.http.shutdown()
+        cls.https.shutdown()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_check_all(self):
+        results = Preflight(workers=4, timeout=5).check_all(self.urls)
+        self.assertEqual(set(results), set(self.urls))
+
+        self.assertTrue(results[self.ok].reachable)
+        self.assertEqual(results[self.ok].status, 200)
+        self.assertEqual(results[self.ok].server, 'stand-in')
+        self.assertTrue(results[self.ok].scheme_supported)
+        self.assertFalse(results[self.ok].redirected)
+
+        self.assertTrue(results[self.moved].redirected)
+        self.assertTrue(results[self.moved].scheme_supported)
+        self.assertEqual(results[self.moved].final_url, self.ok)
+
+        # redirected to another scheme
+        self.assertTrue(results[self.to_https].reachable)
+        self.assertTrue(results[self.to_https].redirected)
+        self.assertFalse(results[self.to_https].scheme_supported)
+        self.assertEqual(results[self.to_https].final_url, self.secure)
+
+        # self-signed certificates are fine
+        self.assertTrue(results[self.secure].reachable)
+        self.assertTrue(results[self.secure].scheme_supported)
+
+        for url in (self.refused, self.plain_port):
+            self.assertFalse(results[url].reachable)
+            self.assertFalse(results[url].scheme_supported)
+            self.assertTrue(results[url].error)
+        self.assertIn('ConnectionError', results[self.refused].error)
+
+    def test_slow_server(self):
+        # each check has a deadline, so one server can't hold up the rest
+        drip = self.http_url + '/drip'
+        start = time.time()
+        results = Preflight(workers=4, timeout=1).check_all([drip, self.ok])
+        self.assertLess(time.time() - start, 6 + 2)
+        self.assertFalse(results[drip].reachable)
+        self.assertIn('TimeoutError', results[drip].error)
+        self.assertTrue(results[self.ok].reachable)
+
+    def test_cache(self):
+        cache_path = os.path.join(self.tmpdir, 'cache.json')
+        preflight = Preflight(workers=4, timeout=5, ttl=60, cache_path=cache_path)
+        results = preflight.check_all([self.ok, self.to_https, self.refused])
+        preflight.save_cache()
+
+        # a new run answers from the file, without fetching
+        cached = Preflight(timeout=5, ttl=60, cache_path=cache_path)
+        cached._fetch = lambda url: self.fail('fetched %s' % url)
+        again = cached.check_all([self.ok, self.to_https, self.refused])
+        for url, result in results.items():
+            self.assertEqual(again[url].to_dict(), result.to_dict())
+
+        # expired results are neither used nor saved
+        with open(cache_path, 'r') as f:
+            entries = json.load(f)
+        for entry in entries:
+            entry['checked_at'] = time.time() - 120
+        with open(cache_path, 'w') as f:
+            json.dump(entries, f)
+        expired = Preflight(timeout=5, ttl=60, cache_path=cache_path)
+        self.assertIsNone(expired.cached(self.ok))
+        expired.save_cache()
+        with open(cache_path, 'r') as f:
+            self.assertEqual(json.load(f), [])
+
+    def test_apply_policy(self):
+        results = Preflight(workers=4, timeout=5).check_all(self.urls)
+        tests = [{'url': url} for url in self.urls]
+
+        kept, dropped = apply_policy(tests, results, 'keep')
+        self.assertEqual(kept, tests)
+        self.assertEqual(dropped, [])
+
+        kept, dropped = apply_policy(tests, results, 'drop')
+        self.assertEqual([t['url'] for t in kept], [self.ok, self.moved, self.secure])
+        self.assertEqual([t['url'] for t in dropped], [self.to_https, self.refused, self.plain_port])
+
+        kept, dropped = apply_policy(tests, results, 'rewrite')
+        self.assertEqual([t['url'] for t in kept], [self.ok, self.ok, self.secure, self.secure])
+        self.assertEqual(kept[1]['preflight_url'], self.moved)
+        self.assertEqual(kept[2]['preflight_url'], self.to_https)
+        self.assertNotIn('preflight_url', kept[0])
+        self.assertEqual([t['url'] for t in dropped], [self.refused, self.plain_port])
+
+        self.assertRaises(ValueError, apply_policy, tests, results, 'bogus')
+
+
+if __name__ == '__main__':
+    unittest.main()
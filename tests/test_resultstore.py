@@ -0,0 +1,139 @@
+import os
+import sys
+import math
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from loader import LoadResult
+from resultstore import ResultStore, ResultStoreError, FIELDS
+
+
+def _result(url, time, status=LoadResult.SUCCESS, **fields):
+    return LoadResult(status, url, final_url=url, time=time, **fields)
+
+def _results():
+    # (run, result), across several batches
+    return [
+        (0, _result('http://a/', 1.5, server='nginx', tcp_fast_open_supported=True,\
+            transport={'connections': 3, 'median_handshake_rtt': 0.02},\
+            network_profile={'name': '3g', 'method': 'netem'}, phases={'page_load': 1.4})),
+        (0, _result('http://b/', 2.5)),
+        (0, _result('http://a/', 1.7, server='nginx')),
+        (0, _result('http://b/', None, status=LoadResult.FAILURE_TIMEOUT)),
+        (1, _result('http://a/', 1.1)),
+        (1, _result('http://c/', 3.0, recycle_reason='memory')),
+        (1, _result('http://a/', 1.2)),
+    ]
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'store')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _fill(self, batch_size=3):
+        store = ResultStore(self.path, batch_size=batch_size)
+        self.assertEqual(store.start_run(label='baseline'), 0)
+        self.assertEqual(store.start_run(label='candidate'), 1)
+        for run, result in _results():
+            store.append(result, run)
+        # the last, partial batch is only written by close()
+        self.assertEqual(len(store), 7)
+        store.close()
+        return ResultStore(self.path)
+
+    def test_round_trip(self):
+        store = self._fill()
+        self.assertEqual(len(store), 7)
+        self.assertEqual(len([name for name in os.listdir(self.path)\
+            if name.startswith('batch-')]), 3)
+        self.assertEqual([run['label'] for run in store.runs()], ['baseline', 'candidate'])
+        self.assertEqual([run['id'] for run in store.runs()], [0, 1])
+
+        results = [result for _, result in _results()]
+        columns = store.load()
+        self.assertEqual(set(columns), set(FIELDS))
+        self.assertEqual(list(columns['run']), [run for run, _ in _results()])
+        self.assertEqual(list(columns['url']), [r.url for r in results])
+        self.assertEqual(list(columns['status']), [r.status for r in results])
+        # missing values: None for strings, NaN for numbers
+        self.assertEqual(list(columns['server']), ['nginx', None, 'nginx', None, None, None, None])
+        time = columns['time']
+        self.assertEqual(time.dtype, numpy.float64)
+        self.assertTrue(math.isnan(time[3]))
+        numpy.testing.assert_array_equal(numpy.delete(time, 3), [1.5, 2.5, 1.7, 1.1, 3.0, 1.2])
+        self.assertEqual(list(columns['tcp_fast_open_supported']),\
+            [True, False, False, False, False, False, False])
+        self.assertEqual(columns['recycle_reason'][5], 'memory')
+
+        # nested dicts are flattened
+        self.assertEqual(columns['transport_connections'][0], 3)
+        self.assertEqual(columns['transport_median_handshake_rtt'][0], 0.02)
+        self.assertTrue(numpy.isnan(columns['transport_connections'][1:]).all())
+        self.assertEqual(columns['network_profile'][0], '3g')
+        self.assertEqual(columns['network_method'][0], 'netem')
+        self.assertEqual(columns['phase_page_load'][0], 1.4)
+
+    def test_runs(self):
+        store = self._fill()
+        self.assertEqual(list(store.column('url', run=1)), ['http://a/', 'http://c/', 'http://a/'])
+        numpy.testing.assert_array_equal(store.column('time', run=1), [1.1, 3.0, 1.2])
+        self.assertEqual(len(store.column('time', run=[0, 1])), 7)
+        self.assertEqual(len(store.column('time', run=2)), 0)
+
+        # codes are consistent across batches with different vocabularies
+        codes, labels = store.categories('url')
+        self.assertEqual(list(labels[codes]), [r.url for _, r in _results()])
+        self.assertEqual(len(labels), 3)
+
+    def test_by_url(self):
+        store = self._fill()
+        by_url = store.by_url('time', run=0)
+        self.assertEqual(sorted(by_url), ['http://a/', 'http://b/'])
+        numpy.testing.assert_array_equal(by_url['http://a/'], [1.5, 1.7])
+        # only successful loads, unless asked
+        numpy.testing.assert_array_equal(by_url['http://b/'], [2.5])
+        everything = store.by_url('time', run=0, successful_only=False)
+        self.assertEqual(len(everything['http://b/']), 2)
+        numpy.testing.assert_array_equal(store.by_url('time')['http://a/'], [1.5, 1.7, 1.1, 1.2])
+
+    def test_added_column(self):
+        # a batch written before a column existed reads as missing values
+        store = self._fill()
+        batch = os.path.join(self.path, 'batch-000000')
+        for name in ('server.npy', 'server.json', 'transport_connections.npy'):
+            os.remove(os.path.join(batch, name))
+        self.assertEqual(list(store.column('server')), [None] * 7)
+        self.assertTrue(numpy.isnan(store.column('transport_connections')).all())
+
+    def test_partial_batch(self):
+        # a batch still being written is not read
+        store = self._fill()
+        shutil.copytree(os.path.join(self.path, 'batch-000000'),\
+            os.path.join(self.path, 'batch-000003.tmp'))
+        self.assertEqual(len(store), 7)
+        self.assertEqual(len(store.column('url')), 7)
+
+    def test_empty(self):
+        store = ResultStore(self.path)
+        self.assertEqual(store.runs(), [])
+        self.assertEqual(len(store), 0)
+        self.assertEqual(len(store.column('time')), 0)
+        self.assertEqual(len(store.column('url')), 0)
+        self.assertEqual(store.by_url('time'), {})
+
+    def test_unknown_field(self):
+        store = self._fill()
+        self.assertRaises(ResultStoreError, store.column, 'bogus')
+        self.assertRaises(ResultStoreError, store.categories, 'time')
+
+
+if __name__ == '__main__':
+    unittest.main()
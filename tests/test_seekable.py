@@ -0,0 +1,123 @@
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import seekable
+from seekable import SeekableReader, SeekableWriter, compress_file, codec_of
+
+# small frames, so a few KB make many of them
+FRAME_SIZE = 1000
+
+
+def _data(size, seed=1):
+    # compressible, but not one repeated byte
+    rng = random.Random(seed)
+    return ''.join(rng.choice('abcdefgh\n') for _ in range(size))
+
+
+class SeekableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = _data(5 * FRAME_SIZE + 321)
+        self.src = os.path.join(self.tmpdir, 'data')
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _compress(self, codec, data=None):
+        path = os.path.join(self.tmpdir, 'data' + seekable.SUFFIXES[codec])
+        if data is None:
+            compress_file(self.src, path, codec, frame_size=FRAME_SIZE)
+        else:
+            with open(path, 'wb') as f:
+                with SeekableWriter(f, codec, frame_size=FRAME_SIZE) as writer:
+                    # odd-sized writes straddle the frames
+                    for i in range(0, len(data), 777):
+                        writer.write(data[i:i + 777])
+        return path
+
+    def _round_trip(self, codec):
+        path = self._compress(codec)
+        self.assertEqual(codec_of(path), codec)
+        with SeekableReader(path) as reader:
+            self.assertEqual(reader.size, len(self.data))
+            self.assertEqual(reader.read(), self.data)
+            self.assertEqual(reader.read(), '')
+
+            rng = random.Random(2)
+            for _ in range(200):
+                offset = rng.randint(0, len(self.data) + 10)
+                size = rng.randint(0, 3 * FRAME_SIZE)
+                reader.seek(offset)
+                self.assertEqual(reader.read(size), self.data[offset:offset + size])
+                self.assertEqual(reader.tell(), min(len(self.data), offset + size))
+
+            reader.seek(-100, os.SEEK_END)
+            self.assertEqual(reader.read(), self.data[-100:])
+            reader.seek(FRAME_SIZE - 5)
+            reader.seek(10, os.SEEK_CUR)
+            self.assertEqual(reader.read(5), self.data[FRAME_SIZE + 5:FRAME_SIZE + 10])
+
+        with SeekableReader(path) as reader:
+            self.assertEqual(list(reader), self.data.splitlines(True))
+
+        # written in pieces, the same frames
+        with SeekableReader(self._compress(codec, self.data)) as reader:
+            reader.seek(3 * FRAME_SIZE - 1)
+            self.assertEqual(reader.read(2), self.data[3 * FRAME_SIZE - 1:3 * FRAME_SIZE + 1])
+
+    def test_gzip(self):
+        self._round_trip('gzip')
+
+    def test_zstd(self):
+        if not seekable.zstandard:
+            raise unittest.SkipTest('the zstandard module is not installed')
+        self._round_trip('zstd')
+
+    def test_gzip_compatible(self):
+        # any gzip reader takes the frames for one stream
+        path = self._compress('gzip')
+        with gzip.open(path, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        # and the same data always compresses to the same bytes
+        with open(path, 'rb') as f:
+            first = f.read()
+        with open(self._compress('gzip'), 'rb') as f:
+            self.assertEqual(f.read(), first)
+
+    def test_plain_gzip(self):
+        # not written in frames: read as a stream, seeking from the start
+        path = os.path.join(self.tmpdir, 'plain.gz')
+        with gzip.open(path, 'wb') as f:
+            f.write(self.data)
+        with SeekableReader(path) as reader:
+            self.assertIsNone(reader.size)
+            reader.seek(2 * FRAME_SIZE)
+            self.assertEqual(reader.read(10), self.data[2 * FRAME_SIZE:2 * FRAME_SIZE + 10])
+            reader.seek(5)
+            self.assertEqual(reader.read(), self.data[5:])
+            self.assertRaises(IOError, reader.seek, -1, os.SEEK_END)
+
+    def test_empty(self):
+        for codec in seekable.CODECS:
+            if codec == 'zstd' and not seekable.zstandard:
+                continue
+            with SeekableReader(self._compress(codec, '')) as reader:
+                self.assertEqual(reader.size, 0)
+                self.assertEqual(reader.read(), '')
+
+    def test_unknown_codec(self):
+        with open(os.path.join(self.tmpdir, 'out'), 'wb') as f:
+            self.assertRaises(ValueError, SeekableWriter, f, 'lzma')
+
+
+if __name__ == '__main__':
+    unittest.main()
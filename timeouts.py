@@ -0,0 +1,146 @@
+import os
+import heapq
+import logging
+import threading
+from time import time
+
+
+################################################################################
+#                                                                              #
+#   DEADLINES                                                                  #
+#                                                                              #
+################################################################################
+
+class TimeoutError(Exception):
+    pass
+
+class _Watchdog(object):
+    '''One thread per process that expires the :class:`Timeout` objects of
+    all threads, in deadline order.'''
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._pid = None
+
+    def add(self, timeout):
+        with self._cond:
+            if self._pid != os.getpid():
+                # first use, or a forked worker: threads don't survive a fork
+                self._heap = []
+                self._pid = os.getpid()
+                thread = threading.Thread(name='timeout-watchdog', target=self._run)
+                thread.daemon = True
+                thread.start()
+            heapq.heappush(self._heap, (timeout.deadline, id(timeout), timeout))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # finished ones are dropped once they reach the top
+                    while self._heap and self._heap[0][2].done:
+                        heapq.heappop(self._heap)
+                    now = time()
+                    if self._heap and self._heap[0][0] <= now:
+                        timeout = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            # cancelling may block (e.g., killing a process tree); never
+            # hold up the other deadlines for it
+            thread = threading.Thread(name='timeout-cancel', target=timeout.expire)
+            thread.daemon = True
+            thread.start()
+
+_watchdog = _Watchdog()
+
+class Timeout(object):
+    '''Can be used w/ 'with' to make arbitrary function calls with timeouts.
+
+    Unlike SIGALRM, it works in any thread, nests, and takes fractions of
+    a second. Nothing is interrupted by itself: once the deadline passes,
+    the cancel functions registered with :meth:`guard` are called (e.g.,
+    to kill the subprocess or close the DevTools session the block waits
+    for), and leaving the block raises :class:`TimeoutError`, whatever the
+    cancelled call raised. Loops can check :meth:`remaining` or call
+    :meth:`check` instead.
+
+    :param seconds: time allowed (None: only `deadline`)
+    :param deadline: absolute time (as from time.time()) not to run past,
+        e.g., the deadline of an enclosing operation
+    '''
+
+    def __init__(self, seconds=10, error_message='Timeout', deadline=None):
+        self.seconds = seconds
+        self.error_message = error_message
+        self._deadline = deadline
+        self._cancels = []
+        self._lock = threading.Lock()
+        self.deadline = None
+        self.expired = False
+        self.done = False
+
+    def __enter__(self):
+        deadlines = [d for d in (self._deadline,\
+            time() + self.seconds if self.seconds is not None else None) if d is not None]
+        self.deadline = min(deadlines) if deadlines else float('inf')
+        if self.deadline != float('inf'):
+            _watchdog.add(self)
+        return self
+
+    def __exit__(self, _, __, ___):
+        with self._lock:
+            self.done = True
+        if self.expired:
+            raise TimeoutError(self.error_message)
+        return False
+
+    def remaining(self):
+        '''Seconds left until the deadline (0 if it passed).'''
+        return max(0.0, self.deadline - time())
+
+    def check(self):
+        '''Raise :class:`TimeoutError` if the deadline passed.'''
+        if self.expired or time() >= self.deadline:
+            raise TimeoutError(self.error_message)
+
+    def guard(self, cancel):
+        '''Call `cancel` (no args) when the deadline passes within the block;
+        right away if it already has.'''
+        with self._lock:
+            if not self.expired:
+                self._cancels.append(cancel)
+                return
+        self._cancel(cancel)
+
+    def _cancel(self, cancel):
+        try:
+            cancel()
+        except Exception as e:
+            logging.debug('Error cancelling after %s: %s', self.error_message, e)
+
+    def expire(self):
+        '''Run the cancel functions, as the watchdog does at the deadline.'''
+        with self._lock:
+            if self.done or self.expired:
+                return
+            self.expired = True
+            cancels = self._cancels
+        for cancel in cancels:
+            self._cancel(cancel)
+
+def remaining(seconds, deadline):
+    '''`seconds`, or less to end by `deadline` (None: no limit), for calls
+    that take a timeout rather than running in a :class:`Timeout`.'''
+    if deadline is None:
+        return seconds
+    return max(0, min(seconds, deadline - time()))
+
+def kill_if_running(proc):
+    '''A cancel function for :meth:`Timeout.guard` that kills the
+    subprocess `proc` if it has not exited.'''
+    def cancel():
+        if proc.poll() is None:
+            proc.kill()
+    return cancel